@@ -0,0 +1,399 @@
+import os
+import re
+import sys
+import time
+import shutil
+import threading
+import subprocess
+from tempfile import gettempdir, mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+
+# optional. without ffmpeg, animated GIFs are assembled with Pillow if it's around
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+if sys.version_info < (3,):
+    from PySide.QtCore import Qt
+else:
+    from PyQt5.QtCore import Qt
+
+from .Encoder import encodeImage
+from .Deadline import DeadlineExceeded, Cancelled
+
+
+# file extension, mime type and ffmpeg arguments per animation format
+ANIMATIONFORMATS = {
+    'mp4':  ('.mp4',  'video/mp4',  ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-movflags', '+faststart']),
+    'webm': ('.webm', 'video/webm', ['-c:v', 'libvpx-vp9', '-b:v', '0']),
+    'gif':  ('.gif',  'image/gif',  []),
+}
+
+
+# frames of an animation are encoded here, side by side
+_frameexecutor = None
+
+def getFrameExecutor():
+    """
+    Returns the pool animation frames are encoded on.
+
+    Threads rather than processes, as with encode races (see Encoder.getEncodeExecutor):
+    Krita can't spawn Python worker processes, and QImage encoders release the GIL.
+    """
+
+    global _frameexecutor
+
+    if _frameexecutor is None:
+        _frameexecutor = ThreadPoolExecutor(max_workers=max(2, min(8, (os.cpu_count() or 2))))
+
+    return _frameexecutor
+
+
+def findFFmpeg(location=None):
+    """
+    pathname of the ffmpeg binary: location if given (e.g. the one set up for
+    Krita's own animation render), otherwise the first on PATH. None if not found
+    """
+
+    if location and os.path.isfile(location):
+        return location
+
+    if hasattr(shutil, 'which'):
+        return shutil.which('ffmpeg')
+
+    return None
+
+
+def _fitFrame(image, maxpixels):
+    """
+    a rendered frame scaled down to fit maxpixels, if it doesn't
+    """
+
+    if maxpixels and image.width() * image.height() > maxpixels:
+        scale = (float(maxpixels) / (image.width() * image.height())) ** 0.5
+        image = image.scaled(max(2, int(image.width() * scale)), max(2, int(image.height() * scale)), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    return image
+
+
+def _encodeFrame(image, pathname):
+    """
+    write one frame as a PNG. Runs on the frame pool
+    """
+
+    # intermediate frames: low compression, fast
+    data = encodeImage(image, 'PNG', 90)
+
+    if data is None:
+        return False
+
+    with open(pathname, 'wb') as fd:
+        fd.write(data)
+
+    return True
+
+
+
+
+class AnimationMedia:
+    """
+    A doc's animation, assembled into an MP4, WebM or animated GIF (see exportAnimation).
+
+    Frames are rendered by the caller on the main thread, and handed to the frame pool
+    to be encoded as they are rendered. Assembly only happens when getData() is first
+    called, which is meant to be done from a worker thread (it waits on the frames and
+    runs ffmpeg). Upload functions accept it wherever they accept a pathname, as with
+    TempMedia.MemoryMedia.
+
+    If the result is over maxbytes, it is assembled again at lower quality and/or size
+    (up to 4 times).
+
+    maxqueued - frames handed to the pool but not yet encoded, at most. Rendering
+                waits for the pool beyond that, so a long animation never holds more
+                than this many frames in memory
+    timeout   - seconds an ffmpeg run may take before it is stopped
+
+    stats (dict) frames, attempts, seconds spent in 'render' and 'assemble', bytes
+    """
+
+    def __init__(self, name, framedir, fps, animationformat='mp4', maxbytes=None, ffmpeg=None, maxqueued=16, timeout=300.0):
+
+        self.name = os.path.splitext(name)[0] + ANIMATIONFORMATS[animationformat][0]
+        self.framedir = framedir
+        self.fps = fps
+        self.animationformat = animationformat
+
+        self.maxbytes = maxbytes
+        self.ffmpeg = ffmpeg
+
+        self.maxqueued = maxqueued
+        self.timeout = timeout
+
+        # one future per frame, in order (see addFrame)
+        self.frames = []
+
+        self.data = None
+        self.lock = threading.Lock()
+
+        self.stats = {'frames': 0, 'attempts': 0}
+
+    def addFrame(self, image, maxpixels=None):
+        """
+        queue a rendered frame (QImage) for encoding, scaled down to maxpixels first
+        so that only the smaller copy waits in the queue. Call on the main thread, in
+        order. Waits while maxqueued frames are already queued
+        """
+
+        if len(self.frames) >= self.maxqueued:
+            self.frames[-self.maxqueued].result()
+
+        pathname = os.path.join(self.framedir, 'frame%05i.png' % len(self.frames))
+
+        self.frames.append(getFrameExecutor().submit(_encodeFrame, _fitFrame(image, maxpixels), pathname))
+
+    def getName(self):
+
+        return self.name
+
+    def getMimeType(self):
+
+        return ANIMATIONFORMATS[self.animationformat][1]
+
+    def _ffmpeg(self, output, quality, scale, deadline=None):
+        """
+        assemble the frames with ffmpeg. quality 0 (best) to 3, scale (0-1] of the frame size.
+        ffmpeg is stopped if it runs longer than timeout, or once deadline passes or
+        is cancelled (which is then raised, see Deadline.check)
+        """
+
+        filters = 'scale=trunc(iw*%.3f/2)*2:trunc(ih*%.3f/2)*2' % (scale, scale)
+
+        if self.animationformat == 'gif':
+            # a palette of the animation's own colours, fewer of them at lower quality
+            filters += ',split[a][b];[a]palettegen=max_colors=%i[p];[b][p]paletteuse' % (256 >> quality)
+            codec = []
+        else:
+            # constant quality; higher crf is smaller
+            codec = ANIMATIONFORMATS[self.animationformat][2] + ['-crf', str(23 + 6 * quality)]
+
+        command = [self.ffmpeg, '-y', '-loglevel', 'error', '-framerate', '%g' % self.fps,
+                   '-i', os.path.join(self.framedir, 'frame%05d.png'), '-vf', filters] + codec + [output]
+
+        process = subprocess.Popen(command)
+
+        expires = time.time() + self.timeout
+
+        try:
+            while True:
+                try:
+                    return process.wait(timeout=0.1) == 0
+                except subprocess.TimeoutExpired:
+                    pass
+
+                if deadline:
+                    deadline.check()
+
+                if time.time() > expires:
+                    print('ffmpeg still running after %.0f s; stopped' % self.timeout)
+                    return False
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def _pillow(self, output, quality, scale):
+        """
+        assemble an animated GIF with Pillow (no ffmpeg)
+        """
+
+        frames = []
+
+        for index in range(len(self.frames)):
+            frame = Image.open(os.path.join(self.framedir, 'frame%05i.png' % index))
+
+            if scale < 1.0:
+                frame = frame.resize((max(1, int(frame.width * scale)), max(1, int(frame.height * scale))))
+
+            frames.append(frame.convert('P', palette=Image.ADAPTIVE, colors=256 >> quality))
+
+        frames[0].save(output, save_all=True, append_images=frames[1:], duration=int(1000.0 / self.fps), loop=0, optimize=True)
+
+        return True
+
+    def getData(self, deadline=None):
+        """
+        The assembled animation (bytes), or None if it could not be assembled.
+        Raises DeadlineExceeded or Cancelled if deadline (a Deadline.Deadline) passes
+        or is cancelled while ffmpeg runs
+        """
+
+        with self.lock:
+
+            if self.data is not None or not self.frames:
+                return self.data
+
+            if deadline:
+                deadline.check()
+
+            started = time.time()
+
+            if not all(frame.result() for frame in self.frames):
+                print('failed to encode the frames of %s' % self.name)
+                return None
+
+            output = os.path.join(self.framedir, self.name)
+
+            quality, scale = 0, 1.0
+
+            for attempt in range(5):
+
+                self.stats['attempts'] += 1
+
+                try:
+                    if self.ffmpeg:
+                        ok = self._ffmpeg(output, quality, scale, deadline)
+                    elif self.animationformat == 'gif' and Image is not None:
+                        ok = self._pillow(output, quality, scale)
+                    else:
+                        print('ffmpeg not found; cannot make an %s' % self.animationformat)
+                        ok = False
+                except (DeadlineExceeded, Cancelled):
+                    raise
+                except Exception:
+                    print('failed to assemble %s' % self.name)
+                    ok = False
+
+                if not ok:
+                    break
+
+                size = os.path.getsize(output)
+
+                if not self.maxbytes or size <= self.maxbytes:
+                    with open(output, 'rb') as fd:
+                        self.data = fd.read()
+                    break
+
+                print('%s is %i bytes, over %i; trying again smaller' % (self.name, size, self.maxbytes))
+
+                # first lower the quality, then the size
+                if quality < 3:
+                    quality += 1
+                else:
+                    scale *= 0.75
+
+            self.stats['assemble'] = time.time() - started
+            self.stats['bytes'] = len(self.data or b'')
+
+            print('assembled %s: %i frames, %i bytes, %i attempts in %.1f ms' % (self.name, len(self.frames), self.stats['bytes'],
+                                                                                   self.stats['attempts'], self.stats['assemble'] * 1000.0))
+
+            # frames are no longer needed
+            self._removeFrames()
+
+            return self.data
+
+    def _removeFrames(self):
+
+        for index in range(len(self.frames)):
+            try:
+                os.remove(os.path.join(self.framedir, 'frame%05i.png' % index))
+            except Exception:
+                pass
+
+    def release(self):
+        """
+        free the data and remove the frames folder
+        """
+
+        with self.lock:
+            self.data = None
+
+            # stragglers still encoding would write into the folder
+            for frame in self.frames:
+                frame.result()
+
+            shutil.rmtree(self.framedir, ignore_errors=True)
+
+
+
+
+def exportAnimation(doc, animationformat='mp4', maxbytes=None, maxpixels=None, maxfps=None, ffmpeg=None):
+    """
+    Render doc's animation (its full clip range) and return an AnimationMedia, or None
+    if the doc is not animated or the format can't be made here.
+
+    Must be called on the main thread: frames are rendered one at a time through
+    Krita's document API, and each is handed to the frame pool (see getFrameExecutor)
+    as soon as it is rendered, so encoding overlaps rendering. The doc's current time
+    is restored afterwards.
+
+    animationformat - 'mp4', 'webm' or 'gif'
+    maxbytes        - size budget of the result (e.g. the instance's video limit)
+    maxpixels       - frames are scaled down to fit this many pixels (as they are
+                      rendered, before they are queued)
+    maxfps          - frames are skipped to stay at or under this frame rate
+    ffmpeg          - pathname of ffmpeg, see findFFmpeg. Needed for mp4 and webm
+    """
+
+    if animationformat not in ANIMATIONFORMATS:
+        print('unknown animation format %s' % animationformat)
+        return None
+
+    ffmpeg = findFFmpeg(ffmpeg)
+
+    if not ffmpeg and not (animationformat == 'gif' and Image is not None):
+        print('ffmpeg not found; animations cannot be exported as %s' % animationformat)
+        return None
+
+    media = None
+
+    try:
+        start = doc.fullClipRangeStartTime()
+        end = doc.fullClipRangeEndTime()
+
+        if end <= start:
+            print('no animation to export')
+            return None
+
+        fps = doc.framesPerSecond() or 24
+
+        # skip frames rather than play too fast
+        step = 1
+
+        while maxfps and fps / float(step) > maxfps:
+            step += 1
+
+        name = os.path.basename(doc.fileName() or 'noname.png')
+        name = re.sub(r"[^\w\-.]+", "_", name)
+
+        media = AnimationMedia(name, mkdtemp(prefix='kritatoot-', dir=gettempdir()), fps / float(step), animationformat,
+                               maxbytes=maxbytes, ffmpeg=ffmpeg)
+
+        started = time.time()
+
+        current = doc.currentTime()
+
+        try:
+            for frame in range(start, end + 1, step):
+                doc.setCurrentTime(frame)
+                doc.waitForDone()
+
+                media.addFrame(doc.projection(0, 0, doc.width(), doc.height()), maxpixels)
+        finally:
+            doc.setCurrentTime(current)
+
+        media.stats['frames'] = len(media.frames)
+        media.stats['render'] = time.time() - started
+
+        print('rendered %i frames of %s in %.1f ms' % (len(media.frames), name, media.stats['render'] * 1000.0))
+
+        return media
+
+    except Exception:
+        print('failed to render the animation')
+
+        if media:
+            media.release()
+
+        return None
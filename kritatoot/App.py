@@ -6,17 +6,19 @@ import threading
 
 if sys.version_info < (3,):
     from urllib import urlencode
-    from urllib2 import urlopen, Request
     from urlparse import urljoin
 else:
     from urllib.parse import urlencode, urljoin
-    from urllib.request import urlopen, Request
 
 
 import webbrowser
 
 
 from .HTTP import KritaTootHTTPServer, HTTPHandler
+from .Connection import getConnectionPool
+from .Deadline import Deadline, DeadlineExceeded, BUDGETS
+from .Transfer import getShaper
+from .Instance import InstanceCache
 
 class KritaTootAccount:
     """
@@ -136,6 +138,9 @@ class KritaToot:
         
         fetching an access token (once authorized)
             requestToken()
+        
+        knowing each instance's limits (toot length, image size, media types)
+            getInstanceLimits()
     
     Functions for uploading and posting media reside in Toot.py module
     """
@@ -164,6 +169,32 @@ class KritaToot:
         # for now, only one account is supported
         self.accounts = []
         
+        # app-wide preferences, kept next to the accounts file
+        self.settingsfile = 'settings'
+        self.settings = {}
+        
+        # (mtime, size) of the accounts and settings files when last read or written,
+        # so that they are only parsed again if something else changed them
+        self.acctstamp = None
+        self.settingsstamp = None
+        
+        # each instance's limits (toot length, image size, ...), kept next to the accounts file
+        self.instancesfile = 'instances'
+        self.instancecache = None
+        
+    
+    def _fileStamp(self, filename):
+        """
+        (mtime, size) of a file, None if it can't be read
+        """
+        
+        try:
+            stat = os.stat(filename)
+        except Exception:
+            return None
+        
+        return (stat.st_mtime, stat.st_size)
+    
     
     def getStorageType(self):
         """
@@ -172,9 +203,12 @@ class KritaToot:
         
         return 'file'
     
-    def loadAccounts(self):
+    def loadAccounts(self, force=False):
         """
         load accounts from file, keyring or other storage. atm only file storage is supported
+        
+        The file is only read again if it changed since it was last read or written
+        (or with force); otherwise the accounts in memory are kept
         """
         
         accounts = []
@@ -195,6 +229,13 @@ class KritaToot:
         if storage_type == 'file':
             filename = os.path.join(self.appdir, self.acctfile)
             
+            stamp = self._fileStamp(filename)
+            
+            if not force and stamp is not None and stamp == self.acctstamp:
+                return
+            
+            self.acctstamp = stamp
+            
             dataform = None
             
             try:
@@ -275,6 +316,9 @@ class KritaToot:
                 with os.fdopen(fd, 'w') as acctfile:
                     acctfile.write(jsontext)
                 
+                # our own write; no need to read it back
+                self.acctstamp = self._fileStamp(filename)
+                
                 return True
                 
             except Exception as e:
@@ -285,6 +329,125 @@ class KritaToot:
     
     
     
+    def loadSettings(self):
+        """
+        load app-wide preferences (a flat json object). Missing file means defaults.
+        As with accounts, the file is only read again if it changed
+        """
+        
+        filename = os.path.join(self.appdir, self.settingsfile)
+        
+        stamp = self._fileStamp(filename)
+        
+        if stamp is not None and stamp == self.settingsstamp:
+            return
+        
+        self.settingsstamp = stamp
+        
+        try:
+            with open(filename, 'r') as settingsfile:
+                self.settings = json.loads(settingsfile.read())
+        except Exception:
+            self.settings = {}
+    
+    
+    def saveSettings(self):
+        """
+        """
+        
+        filename = os.path.join(self.appdir, self.settingsfile)
+        
+        try:
+            if not os.path.exists(self.appdir):
+                os.mkdir(self.appdir)
+            
+            with open(filename, 'w') as settingsfile:
+                settingsfile.write(json.dumps(self.settings))
+            
+            self.settingsstamp = self._fileStamp(filename)
+            
+            return True
+            
+        except Exception:
+            print('Failed to save settings')
+            return False
+    
+    
+    def getSetting(self, name, default=None):
+        
+        return self.settings.get(name, default)
+    
+    def setSetting(self, name, value):
+        """
+        Note: This call does not save settings to storage. Use saveSettings()
+        """
+        
+        self.settings[name] = value
+    
+    
+    
+    
+    def getInstanceCache(self):
+        """
+        Returns the on-disk cache of instance limits (see Instance.InstanceCache).
+        Entries are kept for the 'instancettl' setting's seconds (a day by default)
+        """
+        
+        if self.instancecache is None:
+            self.instancecache = InstanceCache(os.path.join(self.appdir, self.instancesfile))
+        
+        self.instancecache.setTTL(self.getSetting('instancettl', 24 * 60 * 60))
+        
+        return self.instancecache
+    
+    
+    def getInstanceLimits(self, url, fetch=True):
+        """
+        Returns the limits of the instance at url (dict, see Instance.parseInstance).
+        
+        With fetch, they are fetched from the instance if not cached or too old; this
+        blocks on the network, so use fetch=False on the GUI thread (cached or default
+        limits) and refresh them on a worker (see Worker.InstanceWorker)
+        """
+        
+        return self.getInstanceCache().get(url, fetch=fetch)
+    
+    
+    def getDeadlineBudgets(self):
+        """
+        Seconds allowed per stage of a post and for a post as a whole (see
+        Deadline.BUDGETS), as overridden by the 'deadlines' setting, e.g.
+        
+            {"total": 600, "upload": 540}
+        """
+        
+        budgets = dict(BUDGETS)
+        budgets.update(self.getSetting('deadlines', {}))
+        
+        return budgets
+    
+    
+    def configureUploadShaping(self):
+        """
+        Set up each account's upload shaper (see Transfer.Shaper) from the 'uploadshaping'
+        setting: per url, a cap in KB/s (0 for none) and whether to back off when the
+        connection gets congested, e.g.
+        
+            {"https://example.com": {"rate": 200, "adaptive": true}}
+        
+        Accounts not listed upload as fast as they can.
+        """
+        
+        shaping = self.getSetting('uploadshaping', {})
+        
+        for url in set(self.getAccountURLs()) | set(shaping):
+            options = shaping.get(url, {})
+            
+            getShaper(url).configure((options.get('rate') or 0) * 1024, bool(options.get('adaptive')))
+    
+    
+    
+    
     def getAccountsLength(self):
         """
         How many accounts
@@ -418,8 +581,11 @@ class KritaToot:
             * receives an explicit call to terminate with stopHTTPServer()
             * it receives one of the two awaited GET request
             * user denies authorization
-            * times out (not implem)
+            * times out: the 'authorize' deadline budget passes (see getDeadlineBudgets);
+              onerror gets 408
             
+        The server thread is a daemon: it never keeps Krita from exiting.
+        
         
         
         Note: Only one active http server is allowed at a time.
@@ -437,14 +603,12 @@ class KritaToot:
         self.httpd = httpd
         self.httpport = port
         
+        deadline = Deadline(stage='authorize', budgets=self.getDeadlineBudgets())
+        
         def runserver():
             print('Running HTTPd server')
             
-            # TODO check how long server has been running
-            # and cease looping if too long
-            
-            while not httpd.getEOF():
-                httpd.handle_request()
+            httpd.serve(deadline)
             
             # three callbacks are currently supported:
             # onready, onerror, and onabort (see doc string)
@@ -485,7 +649,7 @@ class KritaToot:
         
         # dont stall main thread; run on a separate thread
         server_thread = threading.Thread(target=runserver)
-        server_thread.daemon = False
+        server_thread.daemon = True
         server_thread.start()
         
     
@@ -494,14 +658,12 @@ class KritaToot:
         stops the http server, if present. otherwise does nothing
         """
         
-        if self.httpd:
-            
-            # redundant
-            self.httpd.setCancelled() 
-            self.httpd.setEOF()
+        httpd = self.httpd
+        
+        if httpd:
             
-            urlopen('http://localhost:%i/cancel' % self.httpport) # py2
-            # let the runserver proc handle the rest of the shutdown
+            # wakes the server thread at once; it handles the rest of the shutdown
+            httpd.cancel()
     
     
     def register(self, url):
@@ -530,17 +692,22 @@ class KritaToot:
         
         endpt = urljoin(url, '/api/v1/apps')
         
-        headers = {'Accept':'application/json', 'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+        headers = {'Accept':'application/json', 'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0',
+                   'Content-Type':'application/x-www-form-urlencoded'}
         
         data = urlencode({'client_name': self.client_name, 'scopes':'write', 'redirect_uris':'http://localhost:3000/callback', 'website':self.website})
         
         data_utf8 = data.encode('utf-8')
-        httpreq = Request(endpt, data=data_utf8, headers=headers)
+        
+        deadline = Deadline(stage='connect', budgets=self.getDeadlineBudgets())
         
         try:
-            response = urlopen(httpreq)
+            response = getConnectionPool().request('POST', endpt, body=data_utf8, headers=headers, deadline=deadline)
+        except DeadlineExceeded as e:
+            print('register(): %s' % e)
+            return False
         except Exception as e:
-            print('urlopen in register() encountered an error')
+            print('request in register() encountered an error')
             return False
         
         jsondata = {}
@@ -693,18 +860,23 @@ class KritaToot:
         
         
         # user agent required
-        headers = {'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+        headers = {'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0',
+                   'Content-Type':'application/x-www-form-urlencoded'}
         
         data_utf8 = data.encode('utf-8')
-        httpreq = Request(endpt, data=data_utf8, headers=headers)
         
         #{"access_token":"...","token_type":"bearer","scope":"write","created_at":1519931763}
         
         
+        deadline = Deadline(stage='connect', budgets=self.getDeadlineBudgets())
+        
         try:
-            response = urlopen(httpreq)
+            response = getConnectionPool().request('POST', endpt, body=data_utf8, headers=headers, deadline=deadline)
+        except DeadlineExceeded as e:
+            print('requestToken(): %s' % e)
+            return False
         except Exception as e:
-            print('urlopen in requestToken encountered an error')
+            print('request in requestToken encountered an error')
             return False
         
         jsondata = {}
@@ -736,6 +908,26 @@ class KritaToot:
 
 
 
+_kritatoot = None
+
+def getKritaToot():
+    """
+    Returns the KritaToot that lives for as long as Krita does, shared by every
+    opening of the dialog (see UI.KritaTootUI): accounts, settings and instance
+    limits are read once and kept, and only read again if their files change.
+    Call on the GUI thread.
+    """
+    
+    global _kritatoot
+    
+    if _kritatoot is None:
+        _kritatoot = KritaToot()
+    
+    return _kritatoot
+
+
+
+
 if __name__ == '__main__':
     
     app = App.KritaToot()
@@ -0,0 +1,205 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class ExportCache:
+    """
+    A small in-memory cache of encoded exports (bytes), so that posting an unchanged
+    doc again (a retry, a cross-post, a second toot) skips encoding entirely.
+
+    Keys are chosen by the caller; TempMedia uses the doc's identity plus a
+    fingerprint of its pixels and the image format (see TempMedia.exportMedia).
+
+    Entries are evicted least recently used first once their total size exceeds
+    maxbytes. An entry larger than maxbytes is never kept.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, maxbytes=128 * 1024 * 1024):
+
+        self.maxbytes = maxbytes
+
+        self.entries = OrderedDict()
+        self.totalbytes = 0
+
+        self.lock = threading.Lock()
+
+        self.stats = {'hits': 0, 'misses': 0}
+
+
+    def setMaxBytes(self, maxbytes):
+
+        with self.lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+
+    def get(self, key):
+        """
+        Returns the cached bytes, or None
+        """
+
+        with self.lock:
+            data = self.entries.get(key)
+
+            if data is None:
+                self.stats['misses'] += 1
+                return None
+
+            # most recently used go last
+            self.entries.pop(key)
+            self.entries[key] = data
+
+            self.stats['hits'] += 1
+
+            return data
+
+
+    def put(self, key, data):
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+
+            if old is not None:
+                self.totalbytes -= len(old)
+
+            if len(data) > self.maxbytes:
+                return
+
+            self.entries[key] = data
+            self.totalbytes += len(data)
+
+            self._evict()
+
+
+    def _evict(self):
+
+        while self.totalbytes > self.maxbytes and self.entries:
+            key, data = self.entries.popitem(last=False)
+            self.totalbytes -= len(data)
+
+
+    def clear(self):
+
+        with self.lock:
+            self.entries = OrderedDict()
+            self.totalbytes = 0
+
+
+    def getStats(self):
+        """
+        Returns a dict: hits, misses, entries, bytes
+        """
+
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.totalbytes
+
+            return stats
+
+
+
+
+class MediaIDCache:
+    """
+    Remembers the media ids handed out by each instance, so that a retry (or re-post)
+    of the same image doesn't upload megabytes again.
+
+    Entries are keyed by instance URL and a media key: (image digest, description, focus).
+    See Toot.buildmediabody.
+
+    Mastodon deletes media that are never attached to a toot after about a day,
+    so entries expire after ttl seconds (12 hours by default). A media id can only be
+    attached once: once a toot using it is posted, discard() it.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, ttl=12 * 60 * 60):
+
+        self.ttl = ttl
+
+        # (url, mediakey) -> (media id, time stored)
+        self.entries = {}
+
+        self.lock = threading.Lock()
+
+
+    def setTTL(self, ttl):
+
+        self.ttl = ttl
+
+
+    def get(self, url, mediakey):
+        """
+        Returns a media id, or None
+        """
+
+        with self.lock:
+            entry = self.entries.get((url, mediakey))
+
+            if not entry:
+                return None
+
+            media_id, stored = entry
+
+            if time.time() - stored > self.ttl:
+                del self.entries[(url, mediakey)]
+                return None
+
+            return media_id
+
+
+    def put(self, url, mediakey, media_id):
+
+        with self.lock:
+            self.entries[(url, mediakey)] = (media_id, time.time())
+
+
+    def discard(self, url, media_ids):
+        """
+        Forget the given media ids (a list) of an instance, e.g. because they are now attached to a toot
+        """
+
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if key[0] == url and entry[0] in media_ids:
+                    del self.entries[key]
+
+
+
+
+_exportcache = None
+_mediaidcache = None
+_cachelock = threading.Lock()
+
+def getExportCache():
+    """
+    Returns the export cache shared by all exports
+    """
+
+    global _exportcache
+
+    with _cachelock:
+        if _exportcache is None:
+            _exportcache = ExportCache()
+
+        return _exportcache
+
+
+def getMediaIDCache():
+    """
+    Returns the media-id cache shared by all uploads
+    """
+
+    global _mediaidcache
+
+    with _cachelock:
+        if _mediaidcache is None:
+            _mediaidcache = MediaIDCache()
+
+        return _mediaidcache
@@ -0,0 +1,546 @@
+import sys
+import ssl
+import time
+import base64
+import socket
+import threading
+
+if sys.version_info < (3,):
+    from httplib import HTTPConnection, HTTPSConnection, BadStatusLine as RemoteDisconnected
+    from urlparse import urlsplit
+    from urllib import getproxies, proxy_bypass, unquote
+
+    # errors of a connection the server dropped (py2 has nothing finer)
+    DROPPED = (RemoteDisconnected, socket.error)
+else:
+    from http.client import HTTPConnection, HTTPSConnection, RemoteDisconnected
+    from urllib.parse import urlsplit, unquote
+    from urllib.request import getproxies, proxy_bypass
+
+    DROPPED = (RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+from .RateLimit import getRateLimiter
+from .Deadline import DeadlineExceeded, Cancelled
+from .Transfer import StreamedBody
+
+
+class PooledResponse:
+    """
+    A fully-read HTTP response. Mirrors the bits of urlopen's response object
+    that Toot and App use (getcode(), read(), getheader()) so call sites barely change.
+
+    The body is read in full before the connection goes back to the pool.
+    """
+
+    def __init__(self, status, headers, data):
+
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    def getcode(self):
+
+        return self.status
+
+    def read(self):
+
+        return self.data
+
+    def getheader(self, name, default=None):
+
+        name = name.lower()
+
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+
+        return default
+
+
+
+
+class KritaTootHTTPSConnection(HTTPSConnection):
+    """
+    An HTTPS connection that offers the TLS session of an earlier connection to
+    the same instance, so that the handshake can be resumed rather than repeated.
+    """
+
+    def __init__(self, host, port=None, context=None, session=None, **kwargs):
+        HTTPSConnection.__init__(self, host, port, context=context, **kwargs)
+
+        self.tls_session = session
+        self.tls_context = context
+
+    def connect(self):
+
+        # plain TCP connect (incl. any proxy tunnel), then our own TLS wrap
+        HTTPConnection.connect(self)
+
+        server_hostname = self._tunnel_host if self._tunnel_host else self.host
+
+        self.sock = self.tls_context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.tls_session)
+
+    def sessionReused(self):
+
+        return bool(self.sock is not None and self.sock.session_reused)
+
+    def getSession(self):
+
+        if self.sock is None:
+            return None
+
+        return self.sock.session
+
+
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections shared by every request KritaToot makes (see Toot
+    and App modules), keyed by the account/instance URL (scheme, host, port).
+
+        pool = getConnectionPool()
+        response = pool.request('POST', 'https://example.com/api/v1/statuses', body, headers)
+
+    Upload-then-post sequences against the same instance reuse the same socket,
+    and new sockets to an instance resume the TLS session of a previous one.
+
+    maxsize - max number of idle connections kept per instance
+    maxidle - seconds an idle connection is kept before it is discarded
+
+    getStats() reports how many connections were opened fresh and how many
+    requests reused an idle connection.
+
+    Every request is paced by the instance's rate limits (see RateLimit module).
+    A request refused with 429 is sent again once the limit resets, if that is
+    no more than maxthrottle seconds away.
+
+    No request waits forever on a server that stalls:
+
+        connecttimeout - seconds allowed to open a connection (incl. TLS handshake)
+        stalltimeout   - seconds a socket may sit without sending or receiving
+
+    and a request given a deadline (see Deadline module) is abandoned once it passes.
+
+    Proxies are used as urllib would (HTTP_PROXY, HTTPS_PROXY, NO_PROXY, or the
+    system's settings): HTTPS through a CONNECT tunnel, plain HTTP by handing the
+    proxy the whole URL. See _proxy.
+    """
+
+    def __init__(self, maxsize=4, maxidle=60.0, maxthrottle=60.0, connecttimeout=15.0, stalltimeout=60.0):
+
+        self.maxsize = maxsize
+        self.maxidle = maxidle
+        self.maxthrottle = maxthrottle
+
+        self.connecttimeout = connecttimeout
+        self.stalltimeout = stalltimeout
+
+        # one context for all connections; TLS sessions can only be resumed within a context
+        self.context = ssl.create_default_context()
+
+        # key -> list of (connection, time it went idle)
+        self.idle = {}
+
+        # key -> last TLS session seen for that instance
+        self.sessions = {}
+
+        self.lock = threading.Lock()
+
+        self.stats = {'opened': 0, 'reused': 0, 'resumed': 0}
+
+
+    def setMaxSize(self, maxsize):
+
+        self.maxsize = maxsize
+
+    def setMaxIdle(self, maxidle):
+
+        self.maxidle = maxidle
+
+
+    def getStats(self):
+        """
+        Returns a dict:
+
+            opened  - connections opened fresh
+            reused  - requests sent on an already open (idle) connection
+            resumed - fresh TLS connections that resumed an earlier TLS session
+        """
+
+        with self.lock:
+            return dict(self.stats)
+
+
+    def _key(self, url):
+
+        parts = urlsplit(url)
+
+        scheme = parts.scheme.lower()
+        port = parts.port
+
+        if not port:
+            port = 443 if scheme == 'https' else 80
+
+        return (scheme, parts.hostname, port)
+
+
+    def _proxy(self, scheme, host):
+        """
+        (host, port, headers) of the proxy to reach host through, or None. headers
+        holds a Proxy-Authorization if the proxy URL has credentials
+        """
+
+        try:
+            proxy = getproxies().get(scheme)
+
+            if not proxy or proxy_bypass(host):
+                return None
+        except Exception:
+            return None
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+
+        parts = urlsplit(proxy)
+
+        headers = {}
+
+        if parts.username:
+            credentials = '%s:%s' % (unquote(parts.username), unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+
+        return (parts.hostname, parts.port or 80, headers)
+
+
+    def _acquire(self, key):
+        """
+        Returns (connection, reused)
+        """
+
+        now = time.time()
+
+        stale = []
+        conn = None
+
+        with self.lock:
+            fresh = []
+
+            for candidate, since in self.idle.get(key, []):
+                if now - since > self.maxidle:
+                    stale.append(candidate)
+                else:
+                    fresh.append((candidate, since))
+
+            # most recently used first
+            if fresh:
+                conn, since = fresh.pop()
+
+            self.idle[key] = fresh
+
+            if conn:
+                self.stats['reused'] += 1
+            else:
+                self.stats['opened'] += 1
+
+            session = self.sessions.get(key)
+
+        for candidate in stale:
+            candidate.close()
+
+        if conn:
+            return conn, True
+
+        scheme, host, port = key
+
+        proxy = self._proxy(scheme, host)
+
+        if scheme == 'https':
+            if proxy:
+                conn = KritaTootHTTPSConnection(proxy[0], proxy[1], context=self.context, session=session, timeout=self.connecttimeout)
+                conn.set_tunnel(host, port, proxy[2])
+            else:
+                conn = KritaTootHTTPSConnection(host, port, context=self.context, session=session, timeout=self.connecttimeout)
+        elif proxy:
+            conn = HTTPConnection(proxy[0], proxy[1], timeout=self.connecttimeout)
+
+            # requests go to the proxy with the full URL (see request)
+            conn.proxyheaders = proxy[2]
+        else:
+            conn = HTTPConnection(host, port, timeout=self.connecttimeout)
+
+        return conn, False
+
+
+    def _release(self, key, conn, reused):
+
+        if isinstance(conn, KritaTootHTTPSConnection):
+
+            # TLS 1.3 tickets arrive after the handshake, so grab the session
+            # once a response has been read
+            session = conn.getSession()
+
+            with self.lock:
+                if not reused and conn.sessionReused():
+                    self.stats['resumed'] += 1
+
+                if session:
+                    self.sessions[key] = session
+
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                conn = None
+
+        # pool is full
+        if conn:
+            conn.close()
+
+
+    def _connect(self, conn, deadline):
+        """
+        open a fresh connection within connecttimeout (and what is left of deadline),
+        then give it the stall timeout for everything that follows
+        """
+
+        conn.timeout = deadline.timeout(self.connecttimeout) if deadline else self.connecttimeout
+
+        try:
+            conn.connect()
+        except socket.timeout:
+            if deadline:
+                deadline.check()
+            raise
+
+        conn.sock.settimeout(self.stalltimeout)
+
+
+    def _abort(self, conn):
+        """
+        deadline passed or cancelled: unblock whatever the requesting thread is doing on conn
+        """
+
+        try:
+            if conn.sock is not None:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+
+
+    def request(self, method, url, body=None, headers=None, deadline=None, progress=None, shaper=None):
+        """
+        Send a request on a pooled connection and return a PooledResponse.
+
+        Unlike urlopen, HTTP error statuses (4xx, 5xx) are returned, not raised.
+        Network errors are raised.
+
+        deadline - a Deadline.Deadline. If it passes before the response is in (while
+                   waiting on the rate limit, connecting, sending or receiving), the
+                   connection is shut down and DeadlineExceeded raised. If it is
+                   cancelled, the same happens at once and Cancelled is raised
+        progress - a Transfer.Progress the body's bytes are reported to as they are sent
+        shaper   - a Transfer.Shaper the body is paced by
+
+        If an idle connection turns out to have been closed by the server before
+        it could answer (dropped while sending, or closed without a byte of response),
+        the request is re-sent on a fresh connection. body must therefore be bytes or
+        re-iterable (e.g. a MultipartBody). A connection reset after the request was
+        sent in full only counts for requests that are safe to repeat (GET and the
+        like, or carrying an Idempotency-Key header, see Toot.sendstatus). Timeouts
+        and errors once the response has started are never retried.
+        """
+
+        if headers is None:
+            headers = {}
+
+        if body is not None and (progress or shaper):
+            if isinstance(body, bytes):
+                # streamed in slices from now on; http.client won't count them
+                headers = dict(headers, **{'Content-Length': str(len(body))})
+
+            if progress:
+                progress.expect(len(body))
+
+        key = self._key(url)
+
+        parts = urlsplit(url)
+
+        path = parts.path or '/'
+
+        limiter = getRateLimiter()
+        ratekey = limiter.bucketKey(key[1], method, path, headers)
+
+        if parts.query:
+            path += '?' + parts.query
+
+        throttled = False
+
+        while True:
+            # wait our turn, rather than be refused
+            if deadline:
+                if not limiter.acquire(ratekey, timeout=deadline.timeout(), sleep=deadline.sleep):
+                    raise DeadlineExceeded(deadline.name, deadline.seconds)
+            else:
+                limiter.acquire(ratekey)
+
+            conn, reused = self._acquire(key)
+
+            watchdog = None
+            oncancel = None
+
+            sendbody = body
+
+            target, sendheaders = path, headers
+
+            if getattr(conn, 'proxyheaders', None) is not None:
+                target = '%s://%s:%i%s' % (key[0], key[1], key[2], path)
+                sendheaders = dict(headers, **conn.proxyheaders)
+
+            if body is not None and (progress or shaper):
+                sendbody = StreamedBody(body, conn, progress, shaper, deadline)
+
+            # how far it got, should the connection fail
+            sent = False
+            responded = False
+
+            try:
+                if deadline:
+                    oncancel = deadline.onCancel(lambda conn=conn: self._abort(conn))
+
+                if conn.sock is None:
+                    self._connect(conn, deadline)
+
+                if deadline:
+                    watchdog = threading.Timer(deadline.timeout(), self._abort, (conn,))
+                    watchdog.daemon = True
+                    watchdog.start()
+
+                conn.request(method, target, body=sendbody, headers=sendheaders)
+                sent = True
+
+                response = conn.getresponse()
+                responded = True
+
+                data = response.read()
+
+            except (DeadlineExceeded, Cancelled):
+                conn.close()
+                raise
+
+            except Exception as e:
+                conn.close()
+
+                if deadline and deadline.expired():
+                    print('%s %s abandoned: %s' % (method, url, 'cancelled' if deadline.cancelled() else '%s ran out of time' % deadline.name))
+                    deadline.check()
+
+                dropped = isinstance(e, DROPPED) and not isinstance(e, socket.timeout) and not responded
+
+                if sent and not isinstance(e, RemoteDisconnected):
+                    # reset while the server may have been acting on it
+                    dropped = dropped and (method in ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE') or
+                                           any(name.lower() == 'idempotency-key' for name in headers))
+
+                if reused and dropped:
+                    # the server dropped the idle connection. try a fresh one
+                    if progress and sendbody is not body:
+                        progress.advance(-sendbody.sent)
+
+                    continue
+
+                raise
+
+            finally:
+                if watchdog:
+                    watchdog.cancel()
+
+                if oncancel:
+                    deadline.removeCallback(oncancel)
+
+            result = PooledResponse(response.status, response.getheaders(), data)
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn, reused)
+
+            wait = limiter.update(ratekey, result.status, result.getheader)
+
+            if wait is not None and not throttled and wait <= self.maxthrottle and (not deadline or wait < deadline.remaining()):
+                # refused anyway (e.g. the account is also used elsewhere). try again once the limit resets
+                print('throttled by %s; retrying in %.0f s' % (key[1], wait))
+                throttled = True
+                continue
+
+            return result
+
+
+    def preconnect(self, url, deadline=None):
+        """
+        Open a connection to url's instance ahead of time (DNS lookup, TCP and TLS
+        handshakes) and keep it idle in the pool for the next request, unless one is
+        already idle. Network errors are raised.
+
+        Returns the seconds it took, 0.0 if a connection was already there
+        """
+
+        key = self._key(url)
+
+        now = time.time()
+
+        with self.lock:
+            if any(now - since <= self.maxidle for conn, since in self.idle.get(key, [])):
+                return 0.0
+
+        conn, reused = self._acquire(key)
+
+        if reused:
+            # one turned up in the meantime
+            self._release(key, conn, True)
+            return 0.0
+
+        try:
+            self._connect(conn, deadline)
+        except Exception:
+            conn.close()
+            raise
+
+        self._release(key, conn, False)
+
+        return time.time() - now
+
+
+    def closeAll(self):
+        """
+        Close all idle connections
+        """
+
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+
+        for conns in idle.values():
+            for conn, since in conns:
+                conn.close()
+
+
+
+
+# the pool shared by Toot and App (KritaToot)
+_pool = None
+_poollock = threading.Lock()
+
+def getConnectionPool():
+    """
+    Returns the connection pool shared by all KritaToot network calls
+    """
+
+    global _pool
+
+    with _poollock:
+        if _pool is None:
+            _pool = ConnectionPool()
+
+        return _pool
@@ -0,0 +1,208 @@
+import time
+import threading
+
+
+# seconds each stage of a post may take, and the post as a whole
+#
+#   connect - talking to the instance outside of a post: registering, requesting
+#             a token, fetching its configuration
+#   upload  - uploading the images and waiting for the server to process them
+#   post    - posting the toot
+#   total   - a post, from first upload to toot
+#
+#   authorize - adding an account: the user logging in and authorizing KritaToot in
+#               the browser, until the callback comes in (see App.runHTTPServer)
+BUDGETS = {
+    'total':   300.0,
+    'connect': 30.0,
+    'upload':  240.0,
+    'post':    60.0,
+
+    'authorize': 600.0,
+}
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stage runs out of time. stage names it (see BUDGETS), budget is
+    the seconds it had
+    """
+
+    def __init__(self, stage, budget):
+        Exception.__init__(self, '%s ran out of time (%g s)' % (stage, round(budget, 1)))
+
+        self.stage = stage
+        self.budget = budget
+
+
+
+
+class Cancelled(Exception):
+    """
+    Raised when a deadline is cancelled (e.g. the user pressed Cancel)
+    """
+
+    def __init__(self, stage):
+        Exception.__init__(self, '%s cancelled' % stage)
+
+        self.stage = stage
+
+
+
+
+class Deadline:
+    """
+    A point in time a stage must be done by.
+
+        deadline = Deadline(budgets=app.getDeadlineBudgets())     # a whole post
+        upload = deadline.stage('upload')                           # its upload stage
+
+    A stage gets its own budget (see BUDGETS) but never more than is left of the
+    deadline it is part of.
+
+    Network calls take one as deadline=; requests are abandoned once it passes (see
+    Connection.ConnectionPool.request) and DeadlineExceeded is raised, naming the
+    stage that ran out of time.
+
+    A deadline can also be cancelled, from any thread: it and all its stages are then
+    treated as passed at once, except that Cancelled is raised instead. Whatever is
+    blocked on the network can register a callback (onCancel) to be unblocked.
+    """
+
+    def __init__(self, seconds=None, stage='total', budgets=None, parent=None):
+
+        self.budgets = dict(BUDGETS)
+
+        if budgets:
+            self.budgets.update(budgets)
+
+        if seconds is None:
+            seconds = self.budgets.get(stage, self.budgets['total'])
+
+        self.name = stage
+        self.seconds = seconds
+
+        self.expires = time.time() + seconds
+
+        # cancellation is shared by a deadline and its stages: it lives with the first
+        self.root = parent.root if parent else self
+
+        if not parent:
+            self.event = threading.Event()
+            self.callbacks = []
+            self.lock = threading.Lock()
+
+
+    def stage(self, name):
+        """
+        A deadline for the named stage: its budget, or what is left of this one if less
+        """
+
+        return Deadline(min(self.budgets.get(name, self.seconds), self.remaining()), name, self.budgets, parent=self)
+
+
+    def cancel(self):
+        """
+        Cancel this deadline and its stages, and run the onCancel callbacks
+        """
+
+        root = self.root
+
+        with root.lock:
+            if root.event.is_set():
+                return
+
+            root.event.set()
+            callbacks = list(root.callbacks)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                print('error in cancel callback')
+
+
+    def cancelled(self):
+
+        return self.root.event.is_set()
+
+
+    def onCancel(self, callback):
+        """
+        Have callback() run (on the cancelling thread) if cancelled; at once if already.
+        Returns a handle for removeCallback
+        """
+
+        root = self.root
+
+        with root.lock:
+            if not root.event.is_set():
+                root.callbacks.append(callback)
+                return callback
+
+        callback()
+
+        return None
+
+
+    def removeCallback(self, handle):
+
+        root = self.root
+
+        with root.lock:
+            if handle in root.callbacks:
+                root.callbacks.remove(handle)
+
+
+    def remaining(self):
+        """
+        Seconds left, 0 once passed (or cancelled)
+        """
+
+        if self.cancelled():
+            return 0.0
+
+        return max(0.0, self.expires - time.time())
+
+
+    def expired(self):
+
+        return self.cancelled() or time.time() >= self.expires
+
+
+    def check(self):
+        """
+        Raise Cancelled if cancelled, DeadlineExceeded if passed
+        """
+
+        if self.cancelled():
+            raise Cancelled(self.name)
+
+        if self.expired():
+            raise DeadlineExceeded(self.name, self.seconds)
+
+
+    def sleep(self, seconds):
+        """
+        time.sleep that wakes as soon as cancelled, and never sleeps past the deadline.
+        Raises as check() does if either happens
+        """
+
+        self.check()
+
+        self.root.event.wait(min(seconds, self.remaining()))
+
+        if self.cancelled() or seconds >= self.remaining():
+            self.check()
+
+
+    def timeout(self, cap=None):
+        """
+        Seconds left, at most cap, for a blocking call. Raises DeadlineExceeded if none are
+        """
+
+        self.check()
+
+        remaining = self.remaining()
+
+        return min(remaining, cap) if cap else remaining
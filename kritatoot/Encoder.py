@@ -0,0 +1,398 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# optional. without it, encode races only accept lossless results (see raceImage)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if sys.version_info < (3,):
+    from PySide.QtGui import QImage, QImageWriter, QPainter
+    from PySide.QtCore import Qt, QBuffer, QByteArray, QIODevice
+else:
+    from PyQt5.QtGui import QImage, QImageWriter, QPainter
+    from PyQt5.QtCore import Qt, QBuffer, QByteArray, QIODevice
+
+
+# file extension and mime type per Qt image format
+FORMATS = {
+    'PNG':  ('.png',  'image/png'),
+    'JPEG': ('.jpg',  'image/jpeg'),
+    'WEBP': ('.webp', 'image/webp'),
+}
+
+
+def supportedFormats():
+    """
+    Qt image formats this Krita can write, out of PNG, JPEG and WEBP
+    (WebP needs Qt's optional imageformats plugin)
+    """
+
+    writable = [bytes(name).decode('ascii').upper() for name in QImageWriter.supportedImageFormats()]
+
+    return [name for name in ('PNG', 'JPEG', 'WEBP') if name in writable]
+
+
+def acceptedFormats(mimetypes):
+    """
+    supportedFormats() an instance accepts, given its list of media types
+    (see Instance.parseInstance)
+    """
+
+    return [name for name in supportedFormats() if FORMATS[name][1] in mimetypes]
+
+
+def sniffFormat(data):
+    """
+    The format (PNG, JPEG, WEBP) of encoded image data, judging by its first bytes, or None
+    """
+
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+
+    if data[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+
+    return None
+
+
+def encodeImage(image, imageformat='PNG', quality=-1):
+    """
+    Encode a QImage and return the bytes, or None on failure.
+
+    quality 0-100, -1 for Qt's default. For PNG it sets the compression
+    level instead (lower means smaller and slower); PNG stays lossless.
+
+    Safe to call from a worker thread.
+    """
+
+    buffer = QByteArray()
+    device = QBuffer(buffer)
+    device.open(QIODevice.WriteOnly)
+
+    ok = image.save(device, imageformat, quality)
+
+    device.close()
+
+    if not ok:
+        return None
+
+    return bytes(buffer)
+
+
+def _flatten(image):
+    """
+    JPEG has no alpha. Composite onto white rather than let transparent areas go black
+    """
+
+    if not image.hasAlphaChannel():
+        return image
+
+    flat = QImage(image.size(), QImage.Format_RGB32)
+    flat.fill(Qt.white)
+
+    painter = QPainter(flat)
+    painter.drawImage(0, 0, image)
+    painter.end()
+
+    return flat
+
+
+def _searchQuality(image, imageformat, maxbytes, stats):
+    """
+    Binary search for the highest quality that fits maxbytes.
+    Returns (data, quality) or (None, None) if even the lowest quality is too big
+    """
+
+    best = (None, None)
+
+    low, high = 10, 95
+
+    while low <= high:
+        quality = (low + high) // 2
+
+        data = encodeImage(image, imageformat, quality)
+        stats['attempts'] += 1
+
+        if data is None:
+            break
+
+        if len(data) <= maxbytes:
+            best = (data, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    return best
+
+
+def fitImage(image, maxbytes=None, maxpixels=None, formats=None):
+    """
+    Encode a QImage so that it fits a byte budget (maxbytes) and a pixel budget
+    (maxpixels, width*height). Either budget may be None.
+
+    formats - formats allowed, most preferred first (default: supportedFormats()).
+              Leave PNG out to go straight to lossy formats.
+
+    In order:
+
+        downscale to maxpixels, if needed
+        PNG at the default compression level, then at the highest: used if it fits (lossless)
+        JPEG and WebP (if available), each at the highest quality that fits: the smaller wins
+        if nothing fits, downscale by 25% and try again (up to 4 times)
+
+    Returns (data, imageformat, stats), or (None, None, stats) if no encoding fits.
+
+    stats (dict):
+        width, height - of the encoded image
+        quality       - of the lossy format chosen, if any
+        attempts      - number of encodes tried
+        seconds       - total encode time
+        ratio         - compression ratio (raw 32-bit pixels / encoded bytes)
+    """
+
+    started = time.time()
+
+    if formats is None:
+        formats = supportedFormats()
+
+    stats = {'attempts': 0, 'quality': None}
+
+    width, height = image.width(), image.height()
+
+    if maxpixels and width * height > maxpixels:
+        scale = (float(maxpixels) / (width * height)) ** 0.5
+        image = image.scaled(max(1, int(width * scale)), max(1, int(height * scale)), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    result = (None, None)
+
+    for attempt in range(5):
+
+        if attempt:
+            image = image.scaled(max(1, int(image.width() * 0.75)), max(1, int(image.height() * 0.75)), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+        # no byte budget: the preferred format, as is
+        if not maxbytes:
+            imageformat = formats[0]
+            stats['attempts'] += 1
+
+            result = (encodeImage(_flatten(image) if imageformat == 'JPEG' else image, imageformat), imageformat)
+            break
+
+        # lossless first
+        if 'PNG' in formats:
+
+            for quality in (-1, 0):
+                data = encodeImage(image, 'PNG', quality)
+                stats['attempts'] += 1
+
+                if data is not None and len(data) <= maxbytes:
+                    result = (data, 'PNG')
+                    break
+
+            if result[0] is not None:
+                break
+
+        # then the smallest lossy encoding that fits
+        candidates = []
+
+        if 'JPEG' in formats:
+            data, quality = _searchQuality(_flatten(image), 'JPEG', maxbytes, stats)
+
+            if data is not None:
+                candidates.append((len(data), data, 'JPEG', quality))
+
+        if 'WEBP' in formats:
+            data, quality = _searchQuality(image, 'WEBP', maxbytes, stats)
+
+            if data is not None:
+                candidates.append((len(data), data, 'WEBP', quality))
+
+        if candidates:
+            candidates.sort(key=lambda candidate: candidate[0])
+            size, data, imageformat, quality = candidates[0]
+
+            result = (data, imageformat)
+            stats['quality'] = quality
+            break
+
+    data, imageformat = result
+
+    stats['width'] = image.width()
+    stats['height'] = image.height()
+    stats['seconds'] = time.time() - started
+    stats['ratio'] = (image.width() * image.height() * 4.0 / len(data)) if data else 0.0
+
+    if data is None:
+        print('could not fit image in %s bytes' % maxbytes)
+    else:
+        print('encoded %ix%i %s: %i bytes, ratio %.1f, %i attempts, %.1f ms' % (stats['width'], stats['height'], imageformat, len(data),
+                                                                               stats['ratio'], stats['attempts'], stats['seconds'] * 1000.0))
+
+    return data, imageformat, stats
+
+
+
+# encodes of a race run here, side by side
+_encodeexecutor = None
+
+def getEncodeExecutor():
+    """
+    Returns the pool that encode races run on.
+
+    Threads rather than processes: inside Krita, sys.executable is Krita itself so
+    worker processes can't be spawned, and QImage encoders release the GIL anyway.
+    """
+
+    global _encodeexecutor
+
+    if _encodeexecutor is None:
+        _encodeexecutor = ThreadPoolExecutor(max_workers=3)
+
+    return _encodeexecutor
+
+
+def _grayArray(image, maxside=1024):
+    """
+    QImage to a 2D float numpy array of luma, flattened onto white and
+    downscaled so that its longest side is at most maxside
+    """
+
+    image = _flatten(image)
+
+    if max(image.width(), image.height()) > maxside:
+        image = image.scaled(maxside, maxside, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    image = image.convertToFormat(QImage.Format_Grayscale8)
+
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+
+    # rows are padded to bytesPerLine
+    array = numpy.frombuffer(bits, dtype=numpy.uint8).reshape(image.height(), image.bytesPerLine())
+
+    return array[:, :image.width()].astype(numpy.float64)
+
+
+def _boxMean(array, radius):
+    """
+    mean over a (2*radius+1)^2 window around each pixel (valid region only), using an integral image
+    """
+
+    size = 2 * radius + 1
+
+    integral = numpy.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    integral[1:, 1:] = array.cumsum(0).cumsum(1)
+
+    total = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+
+    return total / (size * size)
+
+
+def ssim(reference, candidate, radius=3):
+    """
+    Mean structural similarity (SSIM) of two equally sized grayscale numpy arrays
+    (0-255), over (2*radius+1)^2 windows. 1.0 means identical
+    """
+
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    mu_x = _boxMean(reference, radius)
+    mu_y = _boxMean(candidate, radius)
+
+    var_x = _boxMean(reference * reference, radius) - mu_x * mu_x
+    var_y = _boxMean(candidate * candidate, radius) - mu_y * mu_y
+    cov = _boxMean(reference * candidate, radius) - mu_x * mu_y
+
+    ssimmap = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+
+    return float(ssimmap.mean())
+
+
+def _encodeCandidate(image, imageformat, quality, reference):
+    """
+    encode, then score the result against reference (a _grayArray). Runs on the encode pool.
+    Returns (data, imageformat, quality, ssim)
+    """
+
+    if imageformat == 'PNG':
+        # lossless
+        return (encodeImage(image, 'PNG', 0), 'PNG', None, 1.0)
+
+    data = encodeImage(_flatten(image) if imageformat == 'JPEG' else image, imageformat, quality)
+
+    if data is None or reference is None:
+        return (data, imageformat, quality, None)
+
+    decoded = QImage.fromData(data)
+
+    if decoded.isNull():
+        return (None, imageformat, quality, None)
+
+    return (data, imageformat, quality, ssim(reference, _grayArray(decoded)))
+
+
+def raceImage(image, maxbytes=None, maxpixels=None, minssim=0.98, quality=85, formats=None):
+    """
+    Encode the same pixels as PNG, JPEG and WebP at once (see getEncodeExecutor) and
+    keep the smallest result that is still good enough: lossless, or lossy with an
+    SSIM against the source of at least minssim. Flat-colour illustrations tend to
+    win as PNG, painterly pieces as JPEG/WebP.
+
+    Without numpy, SSIM can't be computed and only PNG qualifies.
+
+    If no candidate qualifies and fits maxbytes, falls back to fitImage().
+
+    Returns (data, imageformat, stats) like fitImage; stats also holds 'ssim' (of
+    the winner) and 'candidates' (list of (format, bytes, ssim)).
+    """
+
+    started = time.time()
+
+    if formats is None:
+        formats = supportedFormats()
+
+    width, height = image.width(), image.height()
+
+    if maxpixels and width * height > maxpixels:
+        scale = (float(maxpixels) / (width * height)) ** 0.5
+        image = image.scaled(max(1, int(width * scale)), max(1, int(height * scale)), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+    reference = _grayArray(image) if numpy is not None else None
+
+    executor = getEncodeExecutor()
+
+    futures = [executor.submit(_encodeCandidate, image, imageformat, quality, reference) for imageformat in formats]
+
+    results = [future.result() for future in futures]
+
+    stats = {'attempts': len(results), 'candidates': [(imageformat, len(data) if data else 0, score)
+                                                       for data, imageformat, q, score in results]}
+
+    qualified = [result for result in results if result[0] is not None
+                 and result[3] is not None and result[3] >= minssim
+                 and (not maxbytes or len(result[0]) <= maxbytes)]
+
+    if not qualified:
+        print('no encoding qualified (%s); searching for one that fits' % stats['candidates'])
+        return fitImage(image, maxbytes=maxbytes, formats=formats)
+
+    qualified.sort(key=lambda result: len(result[0]))
+    data, imageformat, quality, score = qualified[0]
+
+    stats['quality'] = quality
+    stats['ssim'] = score
+    stats['width'] = image.width()
+    stats['height'] = image.height()
+    stats['seconds'] = time.time() - started
+    stats['ratio'] = image.width() * image.height() * 4.0 / len(data)
+
+    print('encode race won by %s: %i bytes, ssim %.4f, ratio %.1f, %.1f ms' % (imageformat, len(data), score, stats['ratio'], stats['seconds'] * 1000.0))
+
+    return data, imageformat, stats
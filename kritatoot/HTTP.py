@@ -1,12 +1,16 @@
 
 import re
 import sys
+import socket
+import select
 
 if sys.version_info < (3,):
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer #py2
 else:
     from http.server import BaseHTTPRequestHandler, HTTPServer
 
+from .Deadline import DeadlineExceeded
+
 
 
 
@@ -22,15 +26,13 @@ class KritaTootHTTPServer(HTTPServer): # py2
     If an error has occurred, getError() returns a tuple
     
     If no further requests remain, getEOF() returns True
+    
+    serve() handles requests until then, cancel() stops it from any thread
     """
 
     def __init__(self, url, handler):
         HTTPServer.__init__(self, url, handler)
         
-        # time server started. used to control servers duration time
-        self.started = None
-        
-        
         # the OAuth code we are waiting for
         self.authcode = None
         
@@ -44,6 +46,13 @@ class KritaTootHTTPServer(HTTPServer): # py2
         # when True, no futher network I/O
         self.eof = False
         
+        # cancel() writes a byte here to wake serve() up at once
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        
+        # connection being handled, shut down by cancel()
+        self.current = None
+        
         
     
     def hasCode(self):
@@ -107,6 +116,71 @@ class KritaTootHTTPServer(HTTPServer): # py2
         """
         return self.eof
     
+    
+    def serve(self, deadline=None):
+        """
+        Handle requests until EOF: an auth code or an error came in, cancel() was called
+        or deadline (a Deadline.Deadline) passed. A timeout is an error (408).
+        
+        Waits on the listening socket and the cancel() wake-up socket together, so it
+        neither polls nor needs a request of its own to be stopped
+        """
+        
+        while not self.getEOF():
+            
+            try:
+                timeout = deadline.timeout() if deadline else None
+            except DeadlineExceeded:
+                self.setError(408, 'Timed out waiting for authorization')
+                self.setEOF()
+                break
+            
+            # (select rather than selectors, which py2 doesn't have; two sockets are all there is)
+            readable, writable, failed = select.select([self.socket, self.wakeup], [], [], timeout)
+            
+            if self.socket in readable and not self.getEOF():
+                self._handle_request_noblock()
+    
+    
+    def cancel(self):
+        """
+        Stop serve(), from any thread. Does nothing once the server is closed
+        """
+        
+        self.setCancelled()
+        self.setEOF()
+        
+        try:
+            self.waker.send(b'\0')
+        except Exception:
+            pass
+        
+        # a browser that is slow to send its request
+        current = self.current
+        
+        try:
+            if current is not None:
+                current.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+    
+    
+    def process_request(self, request, client_address):
+        
+        self.current = request
+        
+        try:
+            HTTPServer.process_request(self, request, client_address)
+        finally:
+            self.current = None
+    
+    
+    def server_close(self):
+        HTTPServer.server_close(self)
+        
+        self.wakeup.close()
+        self.waker.close()
+    
 
 
 
@@ -138,7 +212,11 @@ class HTTPHandler(BaseHTTPRequestHandler):
     
     
     """
-
+    
+    # a browser that connects but doesn't send its request can't hold up the server
+    # (or a cancel) for longer than this
+    timeout = 5
+    
 
     def do_GET(self):
         self.send_response(200)
@@ -2,6 +2,7 @@
 import os
 import sys
 import inspect
+import threading
 
 if sys.version_info < (3,):
     from PySide.QtGui import *  # py2
@@ -18,6 +19,128 @@ class ChangedSignal(QObject):
     changed = pyqtSignal()
 
 
+class PixmapCache:
+    
+    """
+    The wizard's images (see ImageBox), decoded the first time one is asked for
+    rather than all of them whenever a dialog is built, and kept for every ImageBox
+    (and every opening of the dialog) after that.
+    
+    QPixmaps may only be made on the main thread; prefetch() decodes the images into
+    QImages on a worker thread instead, so that get() only has to convert them.
+    """
+    
+    def __init__(self):
+        
+        thisscript = inspect.getfile(PixmapCache)
+        parentfolder = os.path.dirname(thisscript)
+        
+        self.paths = {
+        
+        'homepage': os.path.join(parentfolder, "images/all/homepage.png"),
+        
+        'add01': os.path.join(parentfolder, "images/en/add01.png"),
+        'add02': os.path.join(parentfolder, "images/en/add02.png"),
+        'add03': os.path.join(parentfolder, "images/en/add03.png"),
+        
+        'complete': os.path.join(parentfolder, "images/en/complete.png"),
+        
+        'error01': os.path.join(parentfolder, "images/en/error01.png"),
+        'error02': os.path.join(parentfolder, "images/en/error02.png")
+        
+        }
+        
+        # keyword -> QPixmap, main thread only
+        self.pixmaps = {}
+        
+        # keyword -> QImage decoded by prefetch(), not yet made into a pixmap
+        self.images = {}
+        
+        self.lock = threading.Lock()
+        
+        self.prefetching = False
+        
+    
+    def get(self, keyword):
+        """
+        The pixmap for keyword, decoded now if it hasn't been. None for an unknown
+        keyword. Call on the main thread
+        """
+        
+        pixmap = self.pixmaps.get(keyword)
+        
+        if pixmap is not None:
+            return pixmap
+        
+        path = self.paths.get(keyword)
+        
+        if path is None:
+            return None
+        
+        with self.lock:
+            image = self.images.pop(keyword, None)
+        
+        if image is not None:
+            pixmap = QPixmap.fromImage(image)
+        else:
+            pixmap = QPixmap(path)
+        
+        self.pixmaps[keyword] = pixmap
+        
+        return pixmap
+    
+    
+    def prefetch(self):
+        """
+        Decode the images not yet decoded on a worker thread, so that the first get()
+        of each is quick. Returns at once
+        """
+        
+        with self.lock:
+            if self.prefetching:
+                return
+            
+            pending = [(keyword, path) for keyword, path in self.paths.items() if keyword not in self.pixmaps and keyword not in self.images]
+            
+            if not pending:
+                return
+            
+            self.prefetching = True
+        
+        def decode():
+            
+            try:
+                for keyword, path in pending:
+                    image = QImage(path)
+                    
+                    with self.lock:
+                        self.images[keyword] = image
+            finally:
+                with self.lock:
+                    self.prefetching = False
+        
+        thread = threading.Thread(target=decode)
+        thread.daemon = True
+        thread.start()
+
+
+
+_pixmapcache = None
+
+def getPixmapCache():
+    """
+    Returns the pixmap cache shared by all ImageBoxes. Call on the main thread
+    """
+    
+    global _pixmapcache
+    
+    if _pixmapcache is None:
+        _pixmapcache = PixmapCache()
+    
+    return _pixmapcache
+
+
+
 class ImageBox(QWidget):
     
     """
@@ -26,14 +149,19 @@ class ImageBox(QWidget):
     slot-ed callback.
     
     This custom widgets emits a 'changed' signal whenever a keyword is set
+    
+    Images come from a shared PixmapCache, and aren't decoded until the box is first
+    shown: building a dialog with an ImageBox in a tab the user never opens costs nothing
     """
     
     def __init__(self, parent=None):
         super(ImageBox, self).__init__(parent) # Py2
         
         
-        self.pixmaps = {}
-        self._loadImages()
+        self.pixmapcache = getPixmapCache()
+        
+        # set while hidden, shown once visible
+        self.pending = None
         
         self.ibkeyword = ''
         
@@ -48,31 +176,6 @@ class ImageBox(QWidget):
         
     
     
-    def _loadImages(self):
-        """
-        encapsulate image loading so that we can later handle
-        locales and missing images
-        """
-        
-        thisscript = inspect.getfile(ImageBox)
-        parentfolder = os.path.dirname(thisscript)
-        
-        self.pixmaps = {
-        
-        'homepage': QPixmap( os.path.join(parentfolder, "images/all/homepage.png") ),
-        
-        'add01': QPixmap( os.path.join(parentfolder, "images/en/add01.png") ),
-        'add02': QPixmap( os.path.join(parentfolder, "images/en/add02.png") ),
-        'add03': QPixmap( os.path.join(parentfolder, "images/en/add03.png") ),
-        
-        'complete': QPixmap( os.path.join(parentfolder, "images/en/complete.png") ),
-        
-        'error01': QPixmap( os.path.join(parentfolder, "images/en/error01.png") ),
-        'error02': QPixmap( os.path.join(parentfolder, "images/en/error02.png") )
-        
-        }
-    
-    
     def setKeyword(self, keyword):
         """
         """
@@ -91,10 +194,28 @@ class ImageBox(QWidget):
         """
         encapsulate image setting so that we can later handle
         locales and missing images
+        
+        While the box is hidden, the image is only decoded once it is shown
         """
         
-        pixmap = self.pixmaps.get(keyword)
-        self.label.setPixmap(pixmap)
+        if not self.isVisible():
+            self.pending = keyword
+            return
+        
+        self.pending = None
+        
+        pixmap = self.pixmapcache.get(keyword)
+        
+        if pixmap is not None:
+            self.label.setPixmap(pixmap)
+    
+    
+    def showEvent(self, event):
+        
+        super(ImageBox, self).showEvent(event)
+        
+        if self.pending is not None:
+            self.setImage(self.pending)
 
 
 
@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import threading
+
+if sys.version_info < (3,):
+    from urlparse import urljoin
+else:
+    from urllib.parse import urljoin
+
+from .Connection import getConnectionPool
+from .Deadline import Deadline
+
+
+# what is assumed of an instance until its configuration is known
+# (Mastodon's own defaults)
+DEFAULTS = {
+    'maxchars':       500,
+    'maxattachments': 4,
+    'maxdescription': 1500,
+    'maxbytes':       8 * 1024 * 1024,
+    'maxpixels':      4096 * 4096,
+    'maxvideobytes':  40 * 1024 * 1024,
+    'maxvideopixels': 2304000,
+    'maxframerate':   60,
+    'mimetypes':      ['image/png', 'image/jpeg', 'image/gif', 'image/webp', 'video/mp4', 'video/webm'],
+}
+
+
+def parseInstance(jsondata):
+    """
+    Pull the limits KritaToot cares about out of an /api/v1/instance reply.
+    Anything the instance doesn't say (older Mastodon, other servers) keeps its
+    default (see DEFAULTS). Returns a dict:
+
+        maxchars       - max chars in a toot
+        maxattachments - max images per toot
+        maxdescription - max chars of an image description (alt-text)
+        maxbytes       - max size of an uploaded image, in bytes
+        maxpixels      - max width*height of an uploaded image
+        maxvideobytes  - max size of an uploaded video, in bytes
+        maxvideopixels - max width*height of an uploaded video
+        maxframerate   - max frames per second of an uploaded video
+        mimetypes      - list of accepted image and video types
+    """
+
+    limits = dict(DEFAULTS)
+
+    configuration = jsondata.get('configuration') or {}
+
+    statuses = configuration.get('statuses') or {}
+    media = configuration.get('media_attachments') or {}
+
+    # glitch-soc and pleroma report the toot length at the top level
+    maxchars = statuses.get('max_characters') or jsondata.get('max_toot_chars')
+
+    if maxchars:
+        limits['maxchars'] = int(maxchars)
+
+    if statuses.get('max_media_attachments'):
+        limits['maxattachments'] = int(statuses['max_media_attachments'])
+
+    if media.get('description_limit'):
+        limits['maxdescription'] = int(media['description_limit'])
+
+    if media.get('image_size_limit'):
+        limits['maxbytes'] = int(media['image_size_limit'])
+
+    if media.get('image_matrix_limit'):
+        limits['maxpixels'] = int(media['image_matrix_limit'])
+
+    if media.get('video_size_limit'):
+        limits['maxvideobytes'] = int(media['video_size_limit'])
+
+    if media.get('video_matrix_limit'):
+        limits['maxvideopixels'] = int(media['video_matrix_limit'])
+
+    if media.get('video_frame_rate_limit'):
+        limits['maxframerate'] = int(media['video_frame_rate_limit'])
+
+    if media.get('supported_mime_types'):
+        limits['mimetypes'] = [mimetype for mimetype in media['supported_mime_types'] if mimetype.startswith(('image/', 'video/'))]
+
+    return limits
+
+
+def combineLimits(limitslist):
+    """
+    Limits every given instance can live with (e.g. when cross-posting): the
+    smallest of each limit, and the media types they all accept
+    """
+
+    if not limitslist:
+        return dict(DEFAULTS)
+
+    combined = dict(limitslist[0])
+
+    for limits in limitslist[1:]:
+        for name in ('maxchars', 'maxattachments', 'maxdescription', 'maxbytes', 'maxpixels', 'maxvideobytes', 'maxvideopixels', 'maxframerate'):
+            combined[name] = min(combined[name], limits[name])
+
+        combined['mimetypes'] = [mimetype for mimetype in combined['mimetypes'] if mimetype in limits['mimetypes']]
+
+    return combined
+
+
+def fetchInstanceLimits(url, deadline=None):
+    """
+    GET the instance's configuration (/api/v1/instance, no account needed) and
+    return its limits (see parseInstance), or None on failure. Gives up after
+    the 'connect' budget (see Deadline.BUDGETS) unless given a deadline
+    """
+
+    endpt = urljoin(url, '/api/v1/instance')
+
+    headers = {'Accept':'application/json', 'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+
+    try:
+        response = getConnectionPool().request('GET', endpt, headers=headers, deadline=deadline or Deadline(stage='connect'))
+    except Exception as e:
+        print('request in fetchInstanceLimits() encountered an error (%s)' % e)
+        return None
+
+    statuscode = response.getcode()
+
+    if statuscode != 200:
+        print('Failed to fetch instance configuration (%i)' % statuscode)
+        return None
+
+    try:
+        jsondata = json.loads(response.read().decode('utf-8'))
+        return parseInstance(jsondata)
+    except Exception:
+        print('Invalid instance configuration')
+        return None
+
+
+
+
+class InstanceCache:
+    """
+    Per-instance limits (see parseInstance), fetched once and kept on disk
+    (a json file next to the accounts file) for ttl seconds, one day by default.
+
+        cache = InstanceCache('~/.kritatoot/instances')
+        limits = cache.get('https://example.com')
+
+    If an instance can't be reached its last known limits are used, however
+    old, and failing that the defaults (see DEFAULTS).
+
+    Safe to use from several threads. get() may block on the network unless
+    fetch=False; don't call it that way on the GUI thread.
+    """
+
+    def __init__(self, pathname, ttl=24 * 60 * 60):
+
+        self.pathname = pathname
+        self.ttl = ttl
+
+        # url -> {'fetched': time, 'limits': dict}, loaded on first use
+        self.entries = None
+
+        self.lock = threading.Lock()
+
+
+    def setTTL(self, ttl):
+
+        self.ttl = ttl
+
+
+    def _load(self):
+
+        if self.entries is not None:
+            return
+
+        try:
+            with open(self.pathname, 'r') as cachefile:
+                self.entries = json.loads(cachefile.read())
+        except Exception:
+            self.entries = {}
+
+
+    def _save(self):
+
+        try:
+            folder = os.path.dirname(self.pathname)
+
+            if folder and not os.path.exists(folder):
+                os.mkdir(folder)
+
+            with open(self.pathname, 'w') as cachefile:
+                cachefile.write(json.dumps(self.entries))
+
+        except Exception:
+            print('Failed to save instance configuration')
+
+
+    def isFresh(self, url):
+        """
+        True if url's limits are cached and younger than ttl
+        """
+
+        with self.lock:
+            self._load()
+
+            entry = self.entries.get(url)
+
+            return bool(entry and time.time() - entry['fetched'] <= self.ttl)
+
+
+    def get(self, url, fetch=True):
+        """
+        Returns url's limits (dict, see parseInstance). With fetch, stale or
+        missing limits are fetched from the instance first
+        """
+
+        if fetch and not self.isFresh(url):
+            self.refresh(url)
+
+        with self.lock:
+            self._load()
+
+            entry = self.entries.get(url)
+
+            limits = dict(DEFAULTS)
+
+            if entry:
+                limits.update(entry['limits'])
+
+            return limits
+
+
+    def refresh(self, url):
+        """
+        Fetch url's limits now. Returns True if they could be fetched
+        """
+
+        limits = fetchInstanceLimits(url)
+
+        if limits is None:
+            return False
+
+        with self.lock:
+            self._load()
+
+            self.entries[url] = {'fetched': time.time(), 'limits': limits}
+            self._save()
+
+        print('%s: %i chars, %i images of up to %i bytes/%i pixels' % (url, limits['maxchars'], limits['maxattachments'],
+                                                                        limits['maxbytes'], limits['maxpixels']))
+
+        return True
+
+
+    def discard(self, url):
+
+        with self.lock:
+            self._load()
+
+            if self.entries.pop(url, None):
+                self._save()
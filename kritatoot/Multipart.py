@@ -0,0 +1,368 @@
+import os
+import sys
+import re
+import binascii
+
+
+def randomBoundary():
+    """
+    A fresh, high-entropy boundary (128 random bits). The odds of it appearing in
+    a payload are negligible, so payloads no longer need to be scanned for it.
+    """
+    
+    return '------------------------kritatoot' + binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class MultipartBody:
+    """
+    A multipart/form-data request body (see RFC2046 section 5) that is streamed
+    rather than concatenated in memory.
+
+    Field headers are built once, when a part is added, and the total length is
+    known up front (getLength()) so that a Content-Length header can be sent.
+
+    Iterating over the body yields it in chunks of at most chunksize bytes. Files
+    are read from disk as they are sent, so memory use stays flat no matter how
+    large the image is.
+
+    The body can be iterated more than once (e.g. on a retry); each pass opens
+    its own file handles.
+
+    Unless one is given, each body gets its own random boundary (see randomBoundary()).
+
+        body = MultipartBody()
+        body.addFile('file', '/tmp/image.png')
+        body.addField('description', 'alt-text')
+
+        headers['Content-Type']   = body.getContentType()
+        headers['Content-Length'] = body.getLength()
+    """
+
+    def __init__(self, boundary=None, chunksize=65536):
+
+        if not boundary:
+            boundary = randomBoundary()
+
+        self.boundary = boundary
+        self.chunksize = chunksize
+
+        # list of (header bytes, source) pairs where source is either bytes
+        # or the pathname of a file to stream
+        self.parts = []
+
+        # the closing delimiter
+        self.tail = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+
+        # running total, excluding the closing delimiter
+        self.length = 0
+
+        # optional. identifies the content for caching purposes (see Toot.buildmediabody)
+        self.mediakey = None
+
+
+    def _partHeader(self, disposition, content_type=None):
+
+        # every part but the first is preceded by a CRLF (belongs to the delimiter)
+        header = '\r\n' if self.parts else ''
+
+        header += '--%s\r\nContent-Disposition: %s\r\n' % (self.boundary, disposition)
+
+        if content_type:
+            header += 'Content-Type: %s\r\n' % content_type
+
+        header += '\r\n'
+
+        return header.encode('utf-8')
+
+
+    def addField(self, name, value):
+        """
+        Add a plain form field. value is a str (encoded as utf-8) or bytes
+        """
+
+        if not isinstance(value, bytes):
+            value = ('%s' % value).encode('utf-8')
+
+        header = self._partHeader('form-data; name="%s"' % name)
+
+        self.parts.append((header, value))
+        self.length += len(header) + len(value)
+
+
+    def addFile(self, name, pathname, filename=None, content_type='application/octet-stream'):
+        """
+        Add a file field. The file is not read until the body is sent.
+
+        filename defaults to the basename of pathname
+
+        Returns False if the file cannot be accessed, otherwise True
+        """
+
+        if not filename:
+            filename = os.path.basename(pathname)
+
+        try:
+            size = os.path.getsize(pathname)
+        except Exception:
+            print('Failed to read "%s"' % pathname)
+            return False
+
+        header = self._partHeader('form-data; name="%s"; filename="%s"' % (name, filename), content_type)
+
+        self.parts.append((header, pathname))
+        self.length += len(header) + size
+
+        return True
+
+
+    def addData(self, name, data, filename, content_type='application/octet-stream'):
+        """
+        Add a file field whose content is already in memory (bytes)
+        """
+
+        header = self._partHeader('form-data; name="%s"; filename="%s"' % (name, filename), content_type)
+
+        self.parts.append((header, data))
+        self.length += len(header) + len(data)
+
+
+    def getContentType(self):
+        """
+        Value for the Content-Type header
+        """
+
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+
+    def getLength(self):
+        """
+        Total number of bytes the body will yield. Value for the Content-Length header
+        """
+
+        return self.length + len(self.tail)
+
+
+    def __len__(self):
+
+        return self.getLength()
+
+
+    def __iter__(self):
+
+        chunksize = self.chunksize
+
+        for header, source in self.parts:
+
+            yield header
+
+            if isinstance(source, bytes):
+
+                view = memoryview(source)
+
+                for offset in range(0, len(view), chunksize):
+                    yield view[offset:offset + chunksize]
+
+            else:
+
+                with open(source, 'rb') as fd:
+
+                    while True:
+                        chunk = fd.read(chunksize)
+
+                        if not chunk:
+                            break
+
+                        yield chunk
+
+        yield self.tail
+
+
+
+
+def _legacyencode(filename, description, focus):
+    """
+    The body as uploadmedia() used to build it: whole file in memory plus
+    repeated concatenation. Kept for the benchmark below.
+    """
+
+    data_head = '''--------------------------d74496d66958873e
+Content-Disposition: form-data; name="file"; filename="%s"
+Content-Type: application/octet-stream
+
+''' % os.path.basename(filename)
+
+    data_head = re.sub('\n', '\r\n', data_head)
+
+    with open(filename, 'rb') as fd:
+        imgdata = fd.read()
+
+    re.search(b'd74496d66958873e', imgdata)
+
+    data_utf8 = data_head.encode('utf-8') + imgdata
+
+    data_utf8 += ('\r\n--------------------------d74496d66958873e\r\nContent-Disposition: form-data; name="description"\r\n\r\n%s' % description).encode('utf-8')
+    data_utf8 += ('\r\n--------------------------d74496d66958873e\r\nContent-Disposition: form-data; name="focus"\r\n\r\n%.2f,%.2f' % focus).encode('utf-8')
+    data_utf8 += '\r\n--------------------------d74496d66958873e--\r\n'.encode('utf-8')
+
+    return data_utf8
+
+
+def _benchmark(mode, filename):
+    """
+    Encode (and consume) a body in this process; print encode time and peak RSS.
+    Run in a fresh interpreter per measurement since peak RSS never goes down.
+    """
+
+    import time
+    import resource
+
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    started = time.time()
+
+    nbytes = 0
+
+    if mode == 'legacy':
+        data = _legacyencode(filename, 'Uploaded using kritatoot', (0.0, 0.0))
+        nbytes = len(data)
+    else:
+        body = MultipartBody()
+        body.addFile('file', filename)
+        body.addField('description', 'Uploaded using kritatoot')
+        body.addField('focus', '%.2f,%.2f' % (0.0, 0.0))
+
+        for chunk in body:
+            nbytes += len(chunk)
+
+    elapsed = time.time() - started
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    print('%-7s %10i bytes %8.1f ms  peak RSS +%.1f MB' % (mode, nbytes, elapsed * 1000.0, (peak - baseline) / 1048576.0))
+
+
+def _selftest():
+    """
+    Upload payloads crafted to contain the old fixed boundary (and other
+    delimiter look-alikes) to a local stand-in server and check that every
+    part arrives intact.
+    """
+
+    import json
+    import tempfile
+    import threading
+
+    from email.parser import BytesParser
+    from email.policy import HTTP
+
+    if sys.version_info < (3,):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from urllib2 import urlopen, Request
+    else:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from urllib.request import urlopen, Request
+
+    class StandInHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers['Content-Length'])
+            data = self.rfile.read(length)
+
+            message = BytesParser(policy=HTTP).parsebytes(('Content-Type: %s\r\n\r\n' % self.headers['Content-Type']).encode('utf-8') + data)
+
+            self.server.received = dict((part.get_param('name', header='content-disposition'), part.get_payload(decode=True))
+                                        for part in message.iter_parts())
+
+            reply = json.dumps({'id': '1'}).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+    httpd = HTTPServer(('127.0.0.1', 0), StandInHandler)
+
+    server_thread = threading.Thread(target=httpd.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    oldboundary = b'--------------------------d74496d66958873e'
+
+    payloads = [
+        oldboundary,
+        os.urandom(1000) + b'\r\n' + oldboundary + b'\r\n' + os.urandom(1000),
+        os.urandom(200000) + oldboundary + b'--\r\n' + os.urandom(200000),
+        (b'\r\n' + oldboundary) * 5000,
+    ]
+
+    failures = 0
+
+    for index, payload in enumerate(payloads):
+
+        fd, filename = tempfile.mkstemp(suffix='.png')
+
+        with os.fdopen(fd, 'wb') as tmpfile:
+            tmpfile.write(payload)
+
+        body = MultipartBody(chunksize=4096)
+        body.addFile('file', filename)
+        body.addField('description', oldboundary.decode('utf-8'))
+
+        headers = {'Content-Type': body.getContentType(), 'Content-Length': body.getLength()}
+
+        urlopen(Request('http://127.0.0.1:%i/api/v1/media' % httpd.server_port, data=body, headers=headers)).read()
+
+        os.remove(filename)
+
+        received = httpd.received
+
+        ok = received.get('file') == payload and received.get('description') == oldboundary
+
+        if not ok:
+            failures += 1
+
+        print('payload %i (%i bytes): %s' % (index, len(payload), 'ok' if ok else 'FAILED'))
+
+    httpd.shutdown()
+    httpd.server_close()
+
+    return failures == 0
+
+
+if __name__ == '__main__':
+
+    # python Multipart.py            - compare legacy vs streaming body for 1, 20 and 100 MB files
+    # python Multipart.py test       - upload boundary look-alike payloads to a local stand-in server
+    # python Multipart.py MODE FILE  - single measurement (used internally)
+
+    if len(sys.argv) == 2 and sys.argv[1] == 'test':
+        sys.exit(0 if _selftest() else 1)
+
+    if len(sys.argv) == 3:
+        _benchmark(sys.argv[1], sys.argv[2])
+        sys.exit(0)
+
+    import subprocess
+    import tempfile
+
+    for megs in (1, 20, 100):
+
+        fd, filename = tempfile.mkstemp(suffix='.png')
+
+        with os.fdopen(fd, 'wb') as tmpfile:
+            for x in range(megs):
+                tmpfile.write(os.urandom(1048576))
+
+        print('%i MB' % megs)
+
+        for mode in ('legacy', 'stream'):
+            subprocess.call([sys.executable, os.path.abspath(__file__), mode, filename])
+
+        os.remove(filename)
@@ -0,0 +1,385 @@
+import os
+import json
+import time
+import random
+import shutil
+import binascii
+import threading
+
+
+class Outbox:
+    """
+    A journal of posts that haven't gone out yet, kept on disk so that a dropped
+    connection or closing Krita mid-upload doesn't lose them.
+
+    Each post (an entry) gets its own folder holding entry.json and its images:
+
+        <folder>/<entry id>/entry.json
+        <folder>/<entry id>/<image>...
+
+    entry.json records the message, visibility, sensitivity, description, focus,
+    the images and, per account (url), the media ids once they are known and
+    whether the toot is posted. It is rewritten atomically after every step, so a
+    retry picks up where the last attempt stopped: images already uploaded are not
+    uploaded again (unless their media ids have likely expired), accounts already
+    posted to are skipped.
+
+    Images are journaled when the entry is added: in-memory ones are written to the
+    entry's folder, exported temp files are journaled by their path (the export
+    path) and only copied in if an attempt fails (see keepMedia). The first attempt
+    still sends the images it was given as they are. An entry whose first attempt
+    never finished (Krita closed mid-upload) is retried from its journaled images.
+
+    Failed entries are retried with exponential backoff (basedelay, doubling up to
+    maxdelay, with some jitter), up to maxattempts times. After that they are no
+    longer retried, and removed once they have been given up on for keep seconds
+    (see prune). Entries never attempted are kept for as long as they have
+    something to post.
+
+    Entries being worked on are claimed (see claim/release) so that two workers in
+    this process never send the same post twice.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, folder, maxattempts=8, basedelay=30.0, maxdelay=3600.0, keep=7 * 24 * 3600.0):
+
+        self.folder = folder
+
+        self.maxattempts = maxattempts
+        self.basedelay = basedelay
+        self.maxdelay = maxdelay
+
+        self.keep = keep
+
+        # ids of entries a worker is busy with
+        self.claimed = set()
+
+        self.lock = threading.Lock()
+
+
+    def _entryFolder(self, entryid):
+
+        return os.path.join(self.folder, entryid)
+
+
+    def add(self, urls, media, message=None, visibility='public', sensitive=False, description=None, focus=(0.0,0.0),
+            media_ids=None):
+        """
+        Journal a new post to the given accounts (urls) and return it, claimed.
+
+        media - pathnames or in-memory images (see Toot.buildmediabody). In-memory
+                images are written to the entry's folder (encoded first if they
+                weren't yet, so call it from a worker thread); pathnames are
+                journaled as they are. The entry's 'media' are these same objects,
+                to be sent as they are. See keepMedia
+        media_ids - {url: [media id, ...]} of images already uploaded, if any
+
+        If the entry can't be written to disk it is still returned, unjournaled
+        ('journaled' False), so the post can go ahead without the safety net.
+        """
+
+        entryid = '%i-%s' % (int(time.time() * 1000), binascii.hexlify(os.urandom(4)).decode('ascii'))
+
+        entry = {'id':entryid, 'created':time.time(), 'message':message, 'visibility':visibility, 'sensitive':sensitive,
+                 'description':description, 'focus':list(focus), 'files':[], 'attempts':0, 'nextattempt':0.0,
+                 'lastattempt':None, 'error':None, 'accounts':{}}
+
+        for url in urls:
+            ids = (media_ids or {}).get(url)
+            entry['accounts'][url] = {'media_ids':ids, 'uploaded':time.time() if ids else None, 'posted':False}
+
+        entry['journaled'] = True
+        entry['media'] = list(media)
+
+        entryfolder = self._entryFolder(entryid)
+
+        try:
+            os.makedirs(entryfolder)
+        except Exception:
+            pass
+
+        try:
+            # names in the entry's folder, or export paths (absolute)
+            for index, item in enumerate(entry['media']):
+                if hasattr(item, 'getData'):
+                    name = '%i-%s' % (index, item.getName())
+                    data = item.getData()
+
+                    if data is None:
+                        raise ValueError('Failed to encode "%s"' % item.getName())
+
+                    with open(os.path.join(entryfolder, name), 'wb') as fd:
+                        fd.write(data)
+                else:
+                    name = os.path.abspath(item)
+
+                entry['files'].append(name)
+
+        except Exception as e:
+            print('Failed to journal the images of outbox entry %s (%s)' % (entryid, e))
+            entry['journaled'] = False
+
+        if not entry['journaled'] or not self.save(entry):
+            print('Failed to journal post in outbox; sending it without')
+            shutil.rmtree(self._entryFolder(entryid), ignore_errors=True)
+
+            entry['journaled'] = False
+
+        with self.lock:
+            self.claimed.add(entryid)
+
+        return entry
+
+
+    def keepMedia(self, entry):
+        """
+        Copy the entry's journaled exports (see add) to its folder, so that it can be
+        retried once they are gone (temp files removed). Images already in the folder
+        are left as they are.
+
+        Returns False if some could not be kept; the entry then still points at them.
+        """
+
+        if not entry.get('journaled'):
+            return False
+
+        entryfolder = self._entryFolder(entry['id'])
+
+        kept = True
+
+        for index, name in enumerate(entry['files']):
+            if not os.path.isabs(name):
+                continue
+
+            copyname = '%i-%s' % (index, os.path.basename(name))
+
+            try:
+                shutil.copyfile(name, os.path.join(entryfolder, copyname))
+            except Exception as e:
+                print('Failed to keep %s in outbox entry %s (%s)' % (name, entry['id'], e))
+                kept = False
+                continue
+
+            entry['files'][index] = copyname
+
+        # retries read them from the folder
+        entry['media'] = [os.path.join(entryfolder, name) for name in entry['files']]
+
+        return kept
+
+
+    def save(self, entry):
+        """
+        Write an entry back to disk (atomically). Unjournaled entries are ignored.
+        Returns False if it could not be written
+        """
+
+        if not entry.get('journaled'):
+            return False
+
+        record = dict((key, value) for key, value in entry.items() if key not in ('media', 'journaled'))
+
+        pathname = os.path.join(self._entryFolder(entry['id']), 'entry.json')
+
+        try:
+            # a cross-post's accounts save the same entry from several threads
+            with self.lock:
+                with open(pathname + '.tmp', 'w') as entryfile:
+                    entryfile.write(json.dumps(record))
+                    entryfile.flush()
+                    os.fsync(entryfile.fileno())
+
+                os.replace(pathname + '.tmp', pathname)
+
+        except Exception:
+            print('Failed to update outbox entry %s' % entry['id'])
+            return False
+
+        return True
+
+
+    def load(self, entryid):
+        """
+        Returns the entry with the given id, or None
+        """
+
+        entryfolder = self._entryFolder(entryid)
+
+        try:
+            with open(os.path.join(entryfolder, 'entry.json'), 'r') as entryfile:
+                entry = json.loads(entryfile.read())
+        except Exception:
+            return None
+
+        entry['journaled'] = True
+        entry['media'] = [os.path.join(entryfolder, name) for name in entry['files']]
+
+        return entry
+
+
+    def entries(self):
+        """
+        Every journaled entry, oldest first
+        """
+
+        try:
+            entryids = sorted(os.listdir(self.folder))
+        except Exception:
+            return []
+
+        entries = [self.load(entryid) for entryid in entryids]
+
+        return [entry for entry in entries if entry]
+
+
+    def isGivenUp(self, entry):
+        """
+        Retried too often, or can't be retried: it has no images and some account
+        it is still to be posted to has no media ids
+        """
+
+        if entry['attempts'] >= self.maxattempts:
+            return True
+
+        return not entry['files'] and any(not state['posted'] and not state['media_ids'] for state in entry['accounts'].values())
+
+
+    def claimDue(self, now=None):
+        """
+        Claim and return the entries due for a retry (not claimed, not given up, and
+        past their next attempt time). release() each once done with it
+        """
+
+        if now is None:
+            now = time.time()
+
+        self.prune(now)
+
+        due = []
+
+        with self.lock:
+            for entry in self.entries():
+                if entry['id'] in self.claimed or self.isGivenUp(entry) or entry['nextattempt'] > now:
+                    continue
+
+                self.claimed.add(entry['id'])
+                due.append(entry)
+
+        return due
+
+
+    def release(self, entry):
+
+        with self.lock:
+            self.claimed.discard(entry['id'])
+
+
+    def nextDue(self):
+        """
+        Time (epoch) the next entry is due for a retry, or None if nothing is waiting
+        """
+
+        times = [entry['nextattempt'] for entry in self.entries() if not self.isGivenUp(entry)]
+
+        return min(times) if times else None
+
+
+    def pending(self):
+        """
+        Number of posts waiting to be retried
+        """
+
+        return len([entry for entry in self.entries() if not self.isGivenUp(entry)])
+
+
+    def failed(self, entry, error):
+        """
+        Record a failed attempt and schedule the next one. Returns the delay in
+        seconds, or None if the entry has been given up on
+        """
+
+        entry['attempts'] += 1
+        entry['error'] = error
+        entry['lastattempt'] = time.time()
+
+        self.keepMedia(entry)
+
+        delay = min(self.maxdelay, self.basedelay * 2 ** (entry['attempts'] - 1))
+        delay *= random.uniform(0.8, 1.2)
+
+        entry['nextattempt'] = time.time() + delay
+
+        self.save(entry)
+        self.release(entry)
+
+        if self.isGivenUp(entry):
+            print('giving up on outbox entry %s after %i attempts: %s' % (entry['id'], entry['attempts'], error))
+            return None
+
+        print('outbox entry %s failed (%s); retrying in %.0f s' % (entry['id'], error, delay))
+
+        return delay
+
+
+    def remove(self, entry):
+        """
+        The post went out: forget the entry and its images
+        """
+
+        if entry.get('journaled'):
+            shutil.rmtree(self._entryFolder(entry['id']), ignore_errors=True)
+
+        self.release(entry)
+
+
+    def prune(self, now=None):
+        """
+        Remove the entries given up on (see isGivenUp) more than keep seconds ago,
+        and at once those that can't be retried at all (nothing left to post them
+        from). An entry never attempted that has something to post is never removed.
+        Returns how many
+        """
+
+        if now is None:
+            now = time.time()
+
+        removed = 0
+
+        for entry in self.entries():
+
+            with self.lock:
+                if entry['id'] in self.claimed or not self.isGivenUp(entry):
+                    continue
+
+                # never retried, or the last attempt was a while ago
+                lastattempt = entry.get('lastattempt') or entry['created']
+
+                if entry['attempts'] < self.maxattempts or now - lastattempt > self.keep:
+                    print('removing outbox entry %s (%i attempts): %s' % (entry['id'], entry['attempts'], entry['error'] or 'nothing to post it from'))
+                    shutil.rmtree(self._entryFolder(entry['id']), ignore_errors=True)
+                    removed += 1
+
+        if removed:
+            print('removed %i outbox entries given up on' % removed)
+
+        return removed
+
+
+
+
+_outbox = None
+_outboxlock = threading.Lock()
+
+def getOutbox():
+    """
+    Returns the outbox shared by all posts (~/.kritatoot/outbox)
+    """
+
+    global _outbox
+
+    with _outboxlock:
+        if _outbox is None:
+            _outbox = Outbox(os.path.join(os.path.expanduser('~'), '.kritatoot', 'outbox'))
+
+        return _outbox
@@ -0,0 +1,227 @@
+import re
+import time
+import hashlib
+import calendar
+import threading
+
+
+def parseResetTime(value):
+    """
+    X-RateLimit-Reset (ISO 8601, e.g. 2018-03-01T20:00:00.123Z) to seconds since
+    the epoch, or None
+    """
+
+    if not value:
+        return None
+
+    match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})", value)
+
+    if not match:
+        return None
+
+    try:
+        return calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+
+
+class RateBucket:
+    """
+    What is known of one rate limit: how many requests it allows per window
+    (limit), how many are left (remaining) and when the window resets.
+
+    remaining is counted down locally as requests are sent, so concurrent workers
+    don't all rush through the last few slots; the server's headers correct it
+    whenever a response comes back.
+    """
+
+    def __init__(self):
+
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+
+
+
+
+class RateLimiter:
+    """
+    Keeps requests under each instance's rate limits, before the server has to
+    refuse them (429).
+
+    Mastodon reports its limits on every response (X-RateLimit-Limit, -Remaining,
+    -Reset), per account and per kind of request; media uploads have their own,
+    tighter limit. A bucket is kept per (instance, account, kind):
+
+        kind - 'media'    POST /api/v1/media, /api/v2/media
+               'statuses' POST /api/v1/statuses
+               'default'  anything else
+
+    Before a request is sent, acquire() takes a slot from its bucket. If none are
+    left (but reserve), the calling thread waits until the window resets; callers
+    are worker threads, so waiting queues the work rather than freezing Krita. Until
+    an instance has reported its limits, requests go straight through.
+
+    After a response, update() records what the server said. See ConnectionPool.
+
+    getStats() reports how many requests had to wait and for how long in all.
+    """
+
+    def __init__(self, reserve=1):
+
+        # slots kept back for the user's own use of the account elsewhere
+        self.reserve = reserve
+
+        self.buckets = {}
+
+        self.lock = threading.Lock()
+
+        self.stats = {'waits': 0, 'waited': 0.0, 'throttled': 0}
+
+
+    def getStats(self):
+        """
+        Returns a dict: waits, waited (seconds in all), throttled (429s seen)
+        """
+
+        with self.lock:
+            return dict(self.stats)
+
+
+    def bucketKey(self, host, method, path, headers):
+        """
+        (instance, account, kind) of a request. The account is told apart by a
+        digest of its access token
+        """
+
+        authorization = (headers or {}).get('Authorization') or ''
+
+        account = hashlib.sha1(authorization.encode('utf-8')).hexdigest()[:12] if authorization else None
+
+        kind = 'default'
+
+        if method == 'POST':
+            if re.match(r"/api/v[12]/media/?$", path):
+                kind = 'media'
+            elif re.match(r"/api/v1/statuses/?$", path):
+                kind = 'statuses'
+
+        return (host, account, kind)
+
+
+    def acquire(self, key, timeout=None, sleep=None):
+        """
+        Take a slot for a request, waiting for the window to reset if there are none
+        left. Returns False if that would take longer than timeout seconds.
+
+        sleep - called to wait, time.sleep by default (e.g. Deadline.sleep, to stop
+                waiting when cancelled)
+        """
+
+        waited = 0.0
+
+        while True:
+
+            with self.lock:
+                bucket = self.buckets.setdefault(key, RateBucket())
+
+                now = time.time()
+
+                if bucket.reset is not None and now >= bucket.reset:
+                    # a new window; the next response will say more
+                    bucket.remaining = bucket.limit
+                    bucket.reset = None
+
+                if bucket.remaining is None or bucket.remaining > self.reserve or bucket.reset is None:
+                    if bucket.remaining is not None:
+                        bucket.remaining -= 1
+
+                    if waited:
+                        self.stats['waits'] += 1
+                        self.stats['waited'] += waited
+
+                    return True
+
+                delay = bucket.reset - now
+
+            if timeout is not None and waited + delay > timeout:
+                print('rate limit of %s: %.0f s to wait, more than %.0f s allowed' % (key[0], delay, timeout))
+                return False
+
+            print('rate limit of %s (%s) reached; waiting %.1f s' % (key[0], key[2], delay))
+
+            (sleep or time.sleep)(delay)
+            waited += delay
+
+
+    def update(self, key, status, getheader):
+        """
+        Record the limits reported by a response. getheader(name) returns a header
+        value or None. On a 429, the bucket is emptied until the reset time (or
+        Retry-After). Returns the seconds until then on a 429, otherwise None
+        """
+
+        limit = getheader('X-RateLimit-Limit')
+        remaining = getheader('X-RateLimit-Remaining')
+        reset = parseResetTime(getheader('X-RateLimit-Reset'))
+
+        with self.lock:
+            bucket = self.buckets.setdefault(key, RateBucket())
+
+            try:
+                if limit is not None:
+                    bucket.limit = int(limit)
+
+                if remaining is not None:
+                    remaining = int(remaining)
+
+                    # same window: responses to earlier requests may still be arriving,
+                    # don't give back slots counted down since
+                    if reset is not None and reset == bucket.reset and bucket.remaining is not None:
+                        remaining = min(remaining, bucket.remaining)
+
+                    bucket.remaining = remaining
+
+            except ValueError:
+                pass
+
+            if reset is not None:
+                bucket.reset = reset
+
+            if status != 429:
+                return None
+
+            self.stats['throttled'] += 1
+
+            retryafter = getheader('Retry-After')
+
+            if retryafter and retryafter.isdigit():
+                bucket.reset = time.time() + int(retryafter)
+
+            if bucket.reset is None:
+                bucket.reset = time.time() + 60
+
+            bucket.remaining = 0
+
+            return max(0.0, bucket.reset - time.time())
+
+
+
+
+_ratelimiter = None
+_ratelimiterlock = threading.Lock()
+
+def getRateLimiter():
+    """
+    Returns the rate limiter shared by all KritaToot network calls
+    """
+
+    global _ratelimiter
+
+    with _ratelimiterlock:
+        if _ratelimiter is None:
+            _ratelimiter = RateLimiter()
+
+        return _ratelimiter
@@ -1,15 +1,189 @@
 
 import os
+import sys
+import time
 import inspect
-from tempfile import gettempdir
+import hashlib
+import threading
+from tempfile import gettempdir, mkdtemp
 import re
 
 
 from krita import *
 
-def saveTempMedia():
+from .Cache import getExportCache
+from .Encoder import FORMATS, encodeImage, fitImage, raceImage, sniffFormat, supportedFormats
+from .Animation import exportAnimation
+
+if sys.version_info < (3,):
+    from PySide.QtGui import QImage, QImageReader
+else:
+    from PyQt5.QtGui import QImage, QImageReader
+
+
+class MemoryMedia:
+    """
+    A copy of a doc kept in memory rather than exported to a temp file (see exportMedia).
+    
+    Holds the doc's projection as a QImage, grabbed on the main thread. The image is
+    only encoded when getData() is first called, which is safe to do from a worker
+    thread. Upload functions accept it wherever they accept a pathname.
+    
+    Without a budget the image is encoded as imageformat (PNG or JPEG). With a byte
+    and/or pixel budget (maxbytes, maxpixels) it is downscaled and/or re-encoded to
+    fit (see Encoder.fitImage), in which case the name's extension follows the format
+    picked. With minssim, PNG, JPEG and WebP are encoded at once and the smallest
+    result that is similar enough to the source wins (see Encoder.raceImage).
+    
+    formats limits the formats picked from (e.g. to those the instance accepts). If
+    imageformat is not among them, the image is re-encoded as one that is.
+    
+    If a cachekey is given, the encoded image is added to the export cache (see Cache
+    module). A MemoryMedia can also be made straight from already encoded data.
+    
+    digest  hex digest of the source image (see documentFingerprint), if known
+    timings (dict) seconds spent in 'projection' and 'encode'
+    stats   (dict) see Encoder.fitImage (budgeted encodes only)
+    """
+    
+    def __init__(self, name, image, imageformat='PNG', data=None, cachekey=None, maxbytes=None, maxpixels=None, minssim=None, formats=None,
+                 digest=None):
+        
+        self.name = name
+        self.image = image
+        self.imageformat = imageformat
+        self.digest = digest
+        
+        self.maxbytes = maxbytes
+        self.maxpixels = maxpixels
+        self.minssim = minssim
+        self.formats = formats
+        
+        self.data = data
+        self.cachekey = cachekey
+        self.lock = threading.Lock()
+        
+        self.timings = {}
+        self.stats = {}
+        
+        if data is not None:
+            self._setFormat(sniffFormat(data) or imageformat)
+    
+    def _setFormat(self, imageformat):
+        
+        self.imageformat = imageformat
+        self.name = os.path.splitext(self.name)[0] + FORMATS[imageformat][0]
+    
+    def getName(self):
+        
+        return self.name
+    
+    def getMimeType(self):
+        
+        return FORMATS[self.imageformat][1]
+    
+    def getData(self, deadline=None):
+        """
+        The encoded image (bytes), or None if it could not be encoded. Raises as
+        deadline.check() does if deadline (a Deadline.Deadline) has passed or is
+        cancelled before the encode starts
+        """
+        
+        with self.lock:
+            
+            if deadline and self.data is None:
+                deadline.check()
+            
+            if self.data is None and self.image is not None:
+                
+                started = time.time()
+                
+                formats = supportedFormats()
+                
+                # (if the instance accepts none of them, the upload is refused later, see Toot.buildmediabody)
+                if self.formats:
+                    formats = [name for name in formats if name in self.formats] or formats
+                
+                if self.minssim:
+                    data, imageformat, self.stats = raceImage(self.image, maxbytes=self.maxbytes, maxpixels=self.maxpixels, minssim=self.minssim,
+                                                              formats=formats)
+                    
+                    if data is not None:
+                        self._setFormat(imageformat)
+                
+                elif self.maxbytes or self.maxpixels or self.imageformat not in formats:
+                    # keep jpeg docs lossy; png docs try lossless first
+                    if self.imageformat != 'PNG' and formats != ['PNG']:
+                        formats = [name for name in formats if name != 'PNG']
+                    
+                    data, imageformat, self.stats = fitImage(self.image, maxbytes=self.maxbytes, maxpixels=self.maxpixels, formats=formats)
+                    
+                    if data is not None:
+                        self._setFormat(imageformat)
+                else:
+                    data = encodeImage(self.image, self.imageformat)
+                
+                self.data = data
+                
+                if self.data is not None and self.cachekey:
+                    getExportCache().put(self.cachekey, self.data)
+                
+                self.timings['encode'] = time.time() - started
+                
+                print('encoded %s in memory: %i bytes in %.1f ms' % (self.name, len(self.data or b''), self.timings['encode'] * 1000.0))
+                
+                # no longer needed
+                self.image = None
+            
+            return self.data
+    
+    def release(self):
+        
+        with self.lock:
+            self.image = None
+            self.data = None
+
+
+def _imageDigest(image):
+    """
+    hex digest of a QImage's size, format and pixels
+    """
+    
+    digest = hashlib.sha1()
+    digest.update(('%i|%i|%i|' % (image.width(), image.height(), image.format())).encode('utf-8'))
+    
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    
+    digest.update(bits)
+    
+    return digest.hexdigest()
+
+
+def _exportName(doc):
+    """
+    name of the exported copy of doc: the doc's own name, unless it cannot be
+    uploaded to mastodon as is, in which case it is exported as a png
+    """
+    
+    docname = doc.fileName()
+    
+    if not docname:
+        docname = 'noname.png'
+    
+    # Check if the file in question is one that can be uploaded to mastodon
+
+    match = re.search(r"\w+\.(png|jpeg|gif|jpg)$", docname)
+
+    # If not, save as a png.
+    if match is None:
+        docname = re.sub(r"(\.\w+)", ".png", docname, flags=re.IGNORECASE)
+    
+    return os.path.basename(docname)
+
+def saveTempMedia(doc=None):
     """
-    exports the current doc in Krita to a temp location and returns the file's
+    exports the current (or given) doc in Krita to a temp location and returns the file's
     pathname, or None on failure
     """
     #thisscript = inspect.getfile(saveTempMedia)
@@ -18,7 +192,8 @@ def saveTempMedia():
     #return os.path.join(parentfolder, 'images/all/homepage.png')
     
     try:
-        doc =  Krita.instance().activeDocument()
+        if not doc:
+            doc =  Krita.instance().activeDocument()
         
         if not doc:
             print('no active doc')
@@ -26,28 +201,20 @@ def saveTempMedia():
         
         tempdir = gettempdir()
         
-        docname = doc.fileName()
+        tempbase = _exportName(doc)
         
-        if not docname:
-            docname = 'noname.png'
+        started = time.time()
         
-        # Check if the file in question is one that can be uploaded to mastodon
-
-        match = re.search(r"\w+\.(png|jpeg|gif|jpg)$", docname)
-
-        # If not, save as a png.
-        if match is None:
-            docname = re.sub(r"(\.\w+)", ".png", docname, flags=re.IGNORECASE)
-
-        tempbase = os.path.basename(docname)
-        pathname = os.path.join(tempdir, tempbase)
+        # a private folder per export, so that an export never overwrites
+        # one that is still being uploaded
+        pathname = os.path.join(mkdtemp(prefix='kritatoot-', dir=tempdir), tempbase)
         
         batchmode = doc.batchmode()
         doc.setBatchmode(True)
         doc.exportImage(pathname, InfoObject())
         doc.setBatchmode(batchmode)
         
-        print('export current doc as %s' % pathname)
+        print('export current doc as %s in %.1f ms' % (pathname, (time.time() - started) * 1000.0))
         
         if not os.path.exists(pathname):
             print('temp file not found')
@@ -61,13 +228,274 @@ def saveTempMedia():
     return pathname
     
     
+def exportMedia(doc=None, inmemory=True, maxbytes=None, maxpixels=None, minssim=None, formats=None):
+    """
+    exports the current (or given) doc for uploading. Returns a MemoryMedia, a temp
+    file's pathname (see saveTempMedia), or None on failure
+    
+    With inmemory, the doc's projection is encoded straight into memory, skipping the
+    write to and read back from disk. Docs saved in other formats than png or jpeg
+    (e.g. gif), or any failure, fall back to exporting a temp file.
+    
+    In-memory exports are cached by doc and pixel content (see Cache.ExportCache):
+    exporting an unchanged doc again reuses the encoded image instead of re-encoding.
+    
+    maxbytes, maxpixels - size budget, if any (e.g. the instance's limits). The export
+    is downscaled/re-encoded to fit, see MemoryMedia and fitTempMedia
+    
+    minssim - if given, race PNG/JPEG/WebP and keep the smallest encoding at least
+    this similar to the source (see MemoryMedia)
+    
+    formats - formats the instance accepts (see Encoder.acceptedFormats), if known.
+    Exports in other formats are re-encoded
+    """
+    
+    if not inmemory:
+        return fitTempMedia(saveTempMedia(doc), maxbytes, maxpixels, minssim, formats)
+    
+    try:
+        if not doc:
+            doc =  Krita.instance().activeDocument()
+        
+        if not doc:
+            print('no active doc')
+            return None
+        
+        name = _exportName(doc)
+        
+        if re.search(r"\.png$", name, flags=re.IGNORECASE):
+            imageformat = 'PNG'
+        elif re.search(r"\.(jpg|jpeg)$", name, flags=re.IGNORECASE):
+            imageformat = 'JPEG'
+        else:
+            return fitTempMedia(saveTempMedia(doc), maxbytes, maxpixels, minssim, formats)
+        
+        started = time.time()
+        
+        image = doc.projection(0, 0, doc.width(), doc.height())
+        
+        if image is None or image.isNull():
+            print('no projection. exporting to disk instead')
+            return fitTempMedia(saveTempMedia(doc), maxbytes, maxpixels, minssim, formats)
+        
+        elapsed = time.time() - started
+        
+        # hashed once: also the doc's fingerprint (see documentFingerprint)
+        digest = _imageDigest(image)
+        
+        # the doc's identity + what it looks like + how it is encoded
+        cachekey = (doc.fileName() or doc.name(), digest, imageformat, maxbytes, maxpixels, minssim,
+                    tuple(formats) if formats else None)
+        
+        data = getExportCache().get(cachekey)
+        
+        if data is not None:
+            print('export cache hit for %s; skipping encode' % name)
+            return MemoryMedia(name, None, imageformat, data=data, digest=digest)
+        
+        media = MemoryMedia(name, image, imageformat, cachekey=cachekey, maxbytes=maxbytes, maxpixels=maxpixels, minssim=minssim,
+                            formats=formats, digest=digest)
+        media.timings['projection'] = elapsed
+        
+        print('copied current doc to memory as %s in %.1f ms' % (name, media.timings['projection'] * 1000.0))
+        
+        return media
+        
+    except Exception:
+        print('failed to copy the current doc to memory. exporting to disk instead')
+        return fitTempMedia(saveTempMedia(doc), maxbytes, maxpixels, minssim, formats)
+
+
+def fitTempMedia(pathname, maxbytes=None, maxpixels=None, minssim=None, formats=None):
+    """
+    If an exported temp file is over budget (bytes or pixels), load it and return a
+    MemoryMedia that is downscaled/re-encoded to fit (the temp file is removed).
+    Otherwise returns pathname as is. GIFs are left alone (they may be animated)
+    
+    With minssim the file is always re-encoded, racing formats (see MemoryMedia).
+    So is a file whose format is not among formats, if given
+    """
+    
+    if not pathname or not (maxbytes or maxpixels or minssim or formats):
+        return pathname
+    
+    if re.search(r"\.gif$", pathname, flags=re.IGNORECASE):
+        return pathname
+    
+    try:
+        size = QImageReader(pathname).size()
+        
+        with open(pathname, 'rb') as fd:
+            accepted = not formats or sniffFormat(fd.read(16)) in formats
+        
+        if not minssim and accepted and (not maxbytes or os.path.getsize(pathname) <= maxbytes) and (not maxpixels or size.width() * size.height() <= maxpixels):
+            return pathname
+        
+        image = QImage(pathname)
+        
+        if image.isNull():
+            return pathname
+        
+        print('re-encoding %s' % pathname)
+        
+        media = MemoryMedia(os.path.basename(pathname), image, 'PNG', maxbytes=maxbytes, maxpixels=maxpixels, minssim=minssim,
+                            formats=formats)
+        
+    except Exception:
+        print('failed to re-encode %s' % pathname)
+        return pathname
+    
+    removeTempMedia(pathname)
+    
+    return media
+
+
+def saveTempLayer(doc, node):
+    """
+    exports a single layer (node) of doc as a PNG to a temp location and returns
+    the file's pathname, or None on failure
+    """
+    
+    try:
+        tempbase = re.sub(r"[^\w\-]+", "_", node.name()) + '.png'
+        
+        pathname = os.path.join(mkdtemp(prefix='kritatoot-', dir=gettempdir()), tempbase)
+        
+        try:
+            node.save(pathname, doc.xRes(), doc.yRes(), InfoObject())
+        except TypeError:
+            # Krita < 4.2
+            node.save(pathname, doc.xRes(), doc.yRes())
+        
+        print('export layer %s as %s' % (node.name(), pathname))
+        
+        if not os.path.exists(pathname):
+            print('temp file not found')
+            return None
+        
+    except Exception:
+        print('failed to export/create a temp copy of a layer')
+        pathname = None
+    
+    return pathname
+
+
+def saveTempMediaList(source='document', limit=4, inmemory=True, maxbytes=None, maxpixels=None, minssim=None, formats=None):
+    """
+    exports the images for one toot and returns a list of pathnames or MemoryMedia
+    (see exportMedia), possibly empty
+    
+    source - 'document'  the current doc
+             'documents' every open doc, the current one first
+             'layers'    each selected layer of the current doc, as separate images
+    limit  - max number of images (the server's attachment limit)
+    inmemory - docs are copied to memory instead of temp files (layers are always
+             exported to temp files)
+    maxbytes, maxpixels - size budget per image, if any (see exportMedia)
+    minssim  - race formats, see exportMedia
+    formats  - formats the instance accepts, see exportMedia
+    
+    on any failure, files exported so far are removed and an empty list is returned
+    """
+    
+    pathnames = []
+    
+    try:
+        krita = Krita.instance()
+        current = krita.activeDocument()
+        
+        if not current:
+            print('no active doc')
+            return []
+        
+        if source == 'documents':
+            
+            # Document wrappers compare equal when they refer to the same doc
+            docs = [current] + [doc for doc in krita.documents() if not doc == current]
+            
+            for doc in docs[:limit]:
+                pathnames.append(exportMedia(doc, inmemory=inmemory, maxbytes=maxbytes, maxpixels=maxpixels, minssim=minssim, formats=formats))
+        
+        elif source == 'layers':
+            
+            nodes = krita.activeWindow().activeView().selectedNodes()
+            
+            for node in nodes[:limit]:
+                pathnames.append(fitTempMedia(saveTempLayer(current, node), maxbytes, maxpixels, minssim, formats))
+        
+        else:
+            pathnames.append(exportMedia(current, inmemory=inmemory, maxbytes=maxbytes, maxpixels=maxpixels, minssim=minssim, formats=formats))
+        
+    except Exception:
+        print('failed to export the images for a toot')
+        pathnames.append(None)
+    
+    if None in pathnames or not pathnames:
+        for pathname in pathnames:
+            if pathname:
+                removeTempMedia(pathname)
+        return []
+    
+    return pathnames
+
+
+def saveTempAnimation(doc=None, animationformat='mp4', maxbytes=None, maxpixels=None, maxfps=None, ffmpeg=None):
+    """
+    renders the current (or given) doc's animation for uploading and returns an
+    Animation.AnimationMedia, or None if the doc is not animated or on failure.
+    See Animation.exportAnimation for the params. Must be called on the main thread
+    """
+    
+    if not doc:
+        doc = Krita.instance().activeDocument()
+    
+    if not doc:
+        print('no active doc')
+        return None
+    
+    return exportAnimation(doc, animationformat=animationformat, maxbytes=maxbytes, maxpixels=maxpixels, maxfps=maxfps, ffmpeg=ffmpeg)
+
+
+def documentFingerprint(doc=None):
+    """
+    returns a hex digest of the current (or given) doc's projection pixels and size,
+    or None on failure. Two equal fingerprints mean an export would produce the same
+    image. In-memory exports carry the same digest (MemoryMedia.digest), so a doc that
+    was just exported needn't be hashed again. Must be called on the main thread
+    """
+    
+    try:
+        if not doc:
+            doc = Krita.instance().activeDocument()
+        
+        if not doc:
+            return None
+        
+        return _imageDigest(doc.projection(0, 0, doc.width(), doc.height()))
+        
+    except Exception:
+        print('failed to fingerprint the current doc')
+        return None
+    
+    
 def removeTempMedia(pathname):
     """
-    remove a temp file
+    remove a temp file (or free a MemoryMedia or AnimationMedia)
     """
     
+    if hasattr(pathname, 'release'):
+        pathname.release()
+        return True
+    
     try:
         os.remove(pathname)
+        
+        # and the per-export folder it was saved in, if any
+        folder = os.path.dirname(pathname)
+        
+        if os.path.basename(folder).startswith('kritatoot-'):
+            os.rmdir(folder)
+        
         return True
         
     except Exception:
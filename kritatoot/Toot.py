@@ -1,92 +1,94 @@
 
 import os
 import sys
-import re
 import json
+import time
+import hashlib
+import binascii
+import threading
 
 if sys.version_info < (3,):
     from urllib import urlencode
-    from urllib2 import urlopen, Request
     from urlparse import urljoin
 else:
     from urllib.parse import urlencode, urljoin
-    from urllib.request import urlopen, Request
 
+from .Multipart import MultipartBody
+from .Connection import getConnectionPool
+from .Deadline import DeadlineExceeded, Cancelled
+from .Transfer import getShaper
+from .Cache import getMediaIDCache
+from .Instance import DEFAULTS
 
-def uploadmedia(url, access_token, filename, description=None, focus=(0.0,0.0)):
+
+def _filedigest(filename):
     """
-    url         - e.g. https://example.com
-    description - up to 420 chars
-    focus       - normalized coordinates, where (0,0) is image center, top-left corner is (-1.0,1.0)
-                  bottom right corner is (1.0,-1.0)
-                  
-    returns a media id (numeric string) if successful, otherwise returns None
+    hex digest of a file's content, read a chunk at a time. None on failure
     """
-    # see RFC2046 section 5 multipart form
-    # TODO gen rand 16 char hex string instead of using a fixed one
-    boundary = 'd74496d66958873e'
     
-    # POST
-    # file (req) (multipart/form-data)
-    # description
+    digest = hashlib.sha1()
     
-    endpt = urljoin(url, '/api/v1/media')
-    
-    headers = {'Accept':'application/json', 'Authorization':'Bearer ' + access_token,
-               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0',
-               'Content-Type': 'multipart/form-data; boundary=------------------------d74496d66958873e'}
+    try:
+        with open(filename, 'rb') as fd:
+            while True:
+                chunk = fd.read(65536)
+                
+                if not chunk:
+                    break
+                
+                digest.update(chunk)
+    except Exception:
+        return None
     
-    data_head = '''--------------------------d74496d66958873e
-Content-Disposition: form-data; name="file"; filename="%s"
-Content-Type: application/octet-stream
+    return digest.hexdigest()
+
 
-''' % os.path.basename(filename)
+def _mimetype(filename):
+    """
+    media type of an image file, judging by its extension
+    """
     
-    data_head = re.sub('\n', '\r\n', data_head)
+    extension = os.path.splitext(filename)[1].lower()
     
-    data_head_utf8 = data_head.encode('utf-8')
+    return {'.png':'image/png', '.jpg':'image/jpeg', '.jpeg':'image/jpeg', '.gif':'image/gif',
+            '.webp':'image/webp', '.mp4':'video/mp4', '.webm':'video/webm'}.get(extension, 'application/octet-stream')
+
+
+def buildmediabody(filename, description=None, focus=(0.0,0.0), limits=None, deadline=None):
+    """
+    Build the multipart body of a media upload (see uploadmedia for the params).
     
-    try:
-        fd = open(filename, 'rb')
-        imgdata = fd.read()
-    except Exception:
-        print('Failed to read "%s"' % filename)
-        return None
+    filename is the pathname of the image, or an image held in memory: any object
+    with getName(), getMimeType() and getData() (see TempMedia.MemoryMedia)
     
-    fd.close()
+    limits - the instance's limits (see Instance.parseInstance), Mastodon's defaults
+             if None. Images the instance would reject (too large, unsupported type)
+             are refused here, before any bytes are sent
+    deadline - passed on to an in-memory image's getData(), which may take a while
+               (e.g. assembling an animation, see Animation.AnimationMedia)
     
-    # validate image
-    if re.search(boundary.encode('utf8'), imgdata):
-        print('Boundary collision')
-        return None
+    The body is read-only once built and can be sent any number of times, even
+    concurrently (e.g. to several instances, see uploadbody)
     
-    data_utf8 = data_head_utf8 + imgdata
+    returns a MultipartBody, or None if the params are invalid
+    """
+    # see RFC2046 section 5 multipart form
+    
+    # POST
+    # file (req) (multipart/form-data)
+    # description
     
     # validate description, if any
+    # (no need to scan the image or description for the boundary; each body gets a random one)
+    if not limits:
+        limits = DEFAULTS
+    
     if description:
         
-        if re.search(boundary, description):
-            print('Boundary collision')
-            return None
-        
-        if len(description) > 420:
+        if len(description) > limits['maxdescription']:
             print('Alt-Text/Description too long.')
             return None
     
-    # Add a description, if any
-    if description:
-        
-        data_alt_text ='''\r\n--------------------------d74496d66958873e
-Content-Disposition: form-data; name="description"
-
-%s''' % description
-        
-        data_alt_text = re.sub('\n', '\r\n', data_alt_text)
-    
-        data_alt_text_utf8 = data_alt_text.encode('utf-8')
-        
-        data_utf8 += data_alt_text_utf8
-    
     # validate focus/focal point
     if not focus:
         focus = (0.0,0.0)
@@ -99,39 +101,147 @@ Content-Disposition: form-data; name="description"
         print('Focal point out of range. Setting to (0,0)')
         focus = (0.0,0.0)
     
+    # the body streams the file from disk when sent; nothing is read here
+    body = MultipartBody()
+    
+    if hasattr(filename, 'getData'):
+        
+        data = filename.getData(deadline=deadline)
+        
+        if data is None:
+            print('Failed to encode "%s"' % filename.getName())
+            return None
+        
+        mimetype = filename.getMimeType()
+        
+        body.addData('file', data, filename.getName(), mimetype)
+        
+        # the source's pixels were already hashed on export (see TempMedia.exportMedia)
+        if getattr(filename, 'digest', None):
+            digest = '%s|%s|%i' % (filename.digest, mimetype, len(data))
+        else:
+            digest = hashlib.sha1(data).hexdigest()
+        
+    elif not body.addFile('file', filename, content_type=_mimetype(filename)):
+        return None
+    
+    else:
+        mimetype = _mimetype(filename)
+        digest = _filedigest(filename)
+    
+    # the part holding the image
+    size = len(body.parts[0][1]) if isinstance(body.parts[0][1], bytes) else os.path.getsize(filename)
+    
+    if mimetype not in limits['mimetypes']:
+        print('%s images are not accepted by this instance' % mimetype)
+        return None
+    
+    # animations (see Animation module) have their own limit
+    maxbytes = limits['maxvideobytes'] if mimetype.startswith('video/') else limits['maxbytes']
+    
+    if size > maxbytes:
+        print('Image too large (%i bytes, %i allowed)' % (size, maxbytes))
+        return None
+    
+    # Add a description, if any
+    if description:
+        body.addField('description', description)
+    
     # Add a focal point, default is dead-center: (0,0)
-    data_focus = '''\r\n--------------------------d74496d66958873e
-Content-Disposition: form-data; name="focus"
+    body.addField('focus', '%.2f,%.2f' % focus)
+    
+    # same image, alt-text and focus: same media (see uploadbody)
+    if digest:
+        body.mediakey = (digest, description or '', '%.2f,%.2f' % focus)
+    
+    return body
+
 
-%.2f,%.2f''' % focus
+# media the server is still processing: (url, media id) -> time the upload finished
+# (see uploadbody, waitmedia)
+_processing = {}
+
+# instances without /api/v2/media (older servers), and how long each instance
+# usually takes to process an upload (seconds, a running average)
+_nov2 = set()
+_processingtime = {}
+
+_processinglock = threading.Lock()
+
+
+def uploadbody(url, access_token, body, wait=True, deadline=None, progress=None):
+    """
+    Upload a media body built by buildmediabody()
     
-    data_focus = re.sub('\n', '\r\n', data_focus)
+    Uses /api/v2/media, falling back to /api/v1/media on servers without it. v2 may
+    answer before the server is done processing the image (202); such media can't
+    be attached to a toot yet. With wait, this call polls until processing is done
+    (see waitmedia). Without, the media id is returned straight away and the caller
+    must waitmedia() before posting, leaving it free to encode and upload the next
+    image in the meantime.
     
-    data_focus_utf8 = data_focus.encode('utf-8')
+    If the same image (with the same description and focus) was uploaded to this
+    instance recently and not posted since, its media id is returned instead of
+    uploading again (see Cache.MediaIDCache)
     
-    data_utf8 += data_focus_utf8
+    deadline - a Deadline.Deadline for the upload (and the wait); raises
+               DeadlineExceeded if it passes, Cancelled if it is cancelled (the
+               upload stops mid-send)
+    progress - a Transfer.Progress to report the bytes sent to
     
-    # Add mutipart footer
-    data_tail = '''\r\n--------------------------d74496d66958873e--\r\n'''
-    data_tail_utf8 = data_head.encode('utf-8')
+    The upload is paced by the account's shaper, if set up (see Transfer.getShaper)
     
-    data_utf8 += data_tail_utf8
+    returns a media id (numeric string) if successful, otherwise returns None
+    """
     
+    if body.mediakey:
+        media_id = getMediaIDCache().get(url, body.mediakey)
+        
+        if media_id:
+            print('reusing media id %s; skipping upload' % media_id)
+            
+            if wait and not waitmedia(url, access_token, media_id, deadline=deadline):
+                return None
+            
+            return media_id
     
+    headers = {'Accept':'application/json', 'Authorization':'Bearer ' + access_token,
+               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0',
+               'Content-Type':body.getContentType(), 'Content-Length':body.getLength()}
     
-    headers['Content-Length'] = len(data_utf8)
+    shaper = getShaper(url)
     
-    try:
-        httpreq = Request(endpt, data=data_utf8, headers=headers)
-        response = urlopen(httpreq)
-    except Exception:
-        print('urlopen in uploadmedia() encountered an error')
-        return None
+    if not shaper.isActive():
+        shaper = None
     
-    statuscode = response.getcode()
-    print(statuscode)
+    while True:
+        version = 'v1' if url in _nov2 else 'v2'
+        
+        endpt = urljoin(url, '/api/%s/media' % version)
+        
+        try:
+            response = getConnectionPool().request('POST', endpt, body=body, headers=headers, deadline=deadline, progress=progress,
+                                                   shaper=shaper)
+        except (DeadlineExceeded, Cancelled):
+            raise
+        except Exception:
+            print('request in uploadmedia() encountered an error')
+            return None
+        
+        statuscode = response.getcode()
+        print(statuscode)
+        
+        if statuscode == 404 and version == 'v2':
+            print('no /api/v2/media on %s; using v1' % url)
+            
+            with _processinglock:
+                _nov2.add(url)
+            
+            continue
+        
+        break
     
-    if statuscode == 200:
+    if statuscode in (200, 202):
         jsontext = response.read().decode('utf-8')
         jsondata = json.loads(jsontext)
     
@@ -141,21 +251,200 @@ Content-Disposition: form-data; name="focus"
         except:
             # harmless error
             pass
-    
-        return jsondata['id']
+        
+        media_id = jsondata['id']
+        
+        # accepted, but still being processed
+        if statuscode == 202:
+            with _processinglock:
+                _processing[(url, media_id)] = time.time()
+        
+        if body.mediakey:
+            getMediaIDCache().put(url, body.mediakey, media_id)
+        
+        if wait and not waitmedia(url, access_token, media_id, deadline=deadline):
+            return None
+        
+        return media_id
     else:
         print('Failed to upload media')
         return None
+
+
+def waitmedia(url, access_token, media_id, timeout=120.0, deadline=None):
+    """
+    Wait until the server is done processing an uploaded image (see uploadbody),
+    polling /api/v1/media/:id. Returns at once if it was never pending.
+    
+    Polling is adaptive: the first poll comes when processing is expected to be done,
+    judging by how long this instance took before; after that the interval grows
+    by half each time, up to 5 seconds.
+    
+    returns True once the media can be attached to a toot, False if processing failed
+    or did not finish within timeout seconds. Raises DeadlineExceeded if deadline (a
+    Deadline.Deadline) passes first, Cancelled if it is cancelled
+    """
     
+    with _processinglock:
+        uploaded = _processing.get((url, media_id))
+        estimate = _processingtime.get(url, 1.0)
     
+    if uploaded is None:
+        return True
+    
+    endpt = urljoin(url, '/api/v1/media/%s' % media_id)
+    
+    headers = {'Accept':'application/json', 'Authorization':'Bearer ' + access_token,
+               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+    
+    expires = time.time() + timeout
+    
+    delay = min(max(uploaded + estimate - time.time(), 0.1), 5.0)
+    
+    polls = 0
+    
+    while True:
+        
+        remaining = expires - time.time()
+        
+        if remaining <= 0:
+            print('media %s still processing after %.0f seconds; giving up' % (media_id, timeout))
+            return False
+        
+        if deadline:
+            deadline.sleep(min(delay, remaining))
+        else:
+            time.sleep(min(delay, remaining))
+        
+        delay = min(delay * 1.5, 5.0)
+        polls += 1
+        
+        try:
+            response = getConnectionPool().request('GET', endpt, headers=headers, deadline=deadline)
+        except (DeadlineExceeded, Cancelled):
+            raise
+        except Exception:
+            print('request in waitmedia() encountered an error')
+            continue
+        
+        statuscode = response.getcode()
+        
+        # 206: still processing
+        if statuscode == 206:
+            continue
+        
+        if statuscode != 200:
+            print('Failed to process media (%i)' % statuscode)
+            
+            with _processinglock:
+                _processing.pop((url, media_id), None)
+            
+            return False
+        
+        try:
+            jsondata = json.loads(response.read().decode('utf-8'))
+        except Exception:
+            jsondata = {}
+        
+        # some servers answer 200 without a url while processing
+        if not jsondata.get('url'):
+            continue
+        
+        elapsed = time.time() - uploaded
+        
+        with _processinglock:
+            _processing.pop((url, media_id), None)
+            _processingtime[url] = 0.7 * _processingtime[url] + 0.3 * elapsed if url in _processingtime else elapsed
+        
+        print('media %s processed in %.1f s (%i polls)' % (media_id, elapsed, polls))
+        
+        return True
+
+
+def uploadmedia(url, access_token, filename, description=None, focus=(0.0,0.0), limits=None, wait=True, deadline=None, progress=None):
+    """
+    url         - e.g. https://example.com
+    filename    - pathname of the image, or an image held in memory (see buildmediabody)
+    description - up to limits['maxdescription'] chars (1500 by default)
+    focus       - normalized coordinates, where (0,0) is image center, top-left corner is (-1.0,1.0)
+                  bottom right corner is (1.0,-1.0)
+    limits      - the instance's limits, if known (see buildmediabody)
+    wait        - wait for the server to finish processing the image (see uploadbody)
+    deadline    - see uploadbody
+    progress    - see uploadbody
+                  
+    returns a media id (numeric string) if successful, otherwise returns None
+    """
+    
+    body = buildmediabody(filename, description=description, focus=focus, limits=limits, deadline=deadline)
+    
+    if not body:
+        return None
+    
+    return uploadbody(url, access_token, body, wait=wait, deadline=deadline, progress=progress)
+
+
+
+
+def idempotencykey():
+    """
+    A fresh key for the Idempotency-Key header of a post (see sendstatus)
+    """
+    
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
 
 
+def sendstatus(endpt, headers, data_utf8, caller, attempts=3, deadline=None):
+    """
+    POST a status, retrying network errors and server errors (5xx) up to attempts
+    times in all (after 1 s, then 2 s).
+    
+    headers must include an Idempotency-Key: Mastodon remembers the key for an hour
+    and answers a repeated request with the toot it already created, so a retry
+    after a lost response never posts twice.
+    
+    No retry is made once deadline (a Deadline.Deadline) has passed or is cancelled;
+    DeadlineExceeded (or Cancelled) is raised instead
+    
+    returns the last response, or None if no response could be had
+    """
+    
+    response = None
+    
+    for attempt in range(attempts):
+        
+        if attempt:
+            if deadline:
+                deadline.sleep(2 ** (attempt - 1))
+            else:
+                time.sleep(2 ** (attempt - 1))
+        
+        try:
+            response = getConnectionPool().request('POST', endpt, body=data_utf8, headers=headers, deadline=deadline)
+        except (DeadlineExceeded, Cancelled):
+            raise
+        except Exception:
+            print('request in %s encountered an error' % caller)
+            continue
+        
+        if response.getcode() < 500:
+            break
+        
+        print('%i from %s; retrying' % (response.getcode(), endpt))
+    
+    return response
+
 
-def postmedia(url, access_token, media_id, message=None, visibility='public', spoiler_text=None, sensitive=False):
+def postmedia(url, access_token, media_id, message=None, visibility='public', spoiler_text=None, sensitive=False, idempotency_key=None,
+              deadline=None):
     """
-    media_id (string) cannot be re-used
+    media_id (string) cannot be re-used. A list of media ids attaches several images,
+             in that order (up to the server's limit, usually 4)
     visibility: 'public', 'unlisted', 'private', 'direct'
     sensitive: True or False
+    idempotency_key: identifies this post across retries (see sendstatus). Pass the
+             same key every time the same post is retried; a fresh one by default
+    deadline: a Deadline.Deadline for the post (see sendstatus)
     """
     
     # visibility must be one of the following: 'public', 'unlisted', 'private', 'direct'
@@ -175,7 +464,9 @@ def postmedia(url, access_token, media_id, message=None, visibility='public', sp
     endpt = urljoin(url, '/api/v1/statuses')
     
     headers = {'Accept':'application/json', 'Authorization':'Bearer ' + access_token,
-               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0',
+               'Content-Type':'application/x-www-form-urlencoded',
+               'Idempotency-Key':idempotency_key or idempotencykey()}
     
     
     params = {'visibility':visibility, 'sensitive':sensitive}
@@ -195,16 +486,16 @@ def postmedia(url, access_token, media_id, message=None, visibility='public', sp
     data = urlencode(params)
     
     # arrays require a perculiar format: array[]=value1&array[]=value2...
-    data += '&media_ids%5B%5D=' + media_id
+    media_ids = [media_id] if not isinstance(media_id, (list, tuple)) else media_id
+    
+    for mid in media_ids:
+        data += '&' + urlencode({'media_ids[]':mid})
     
     #print(data)
     
-    try:
-        data_utf8 = data.encode('utf-8')
-        httpreq = Request(endpt, data=data_utf8, headers=headers)
-        response = urlopen(httpreq)
-    except Exception:
-        print('urlopen in postmedia() encountered an error')
+    response = sendstatus(endpt, headers, data.encode('utf-8'), 'postmedia()', deadline=deadline)
+    
+    if response is None:
         return False
     
     statuscode = response.getcode()
@@ -220,6 +511,9 @@ def postmedia(url, access_token, media_id, message=None, visibility='public', sp
             # harmless error
             pass
         
+        # attached now; these ids can't be used again
+        getMediaIDCache().discard(url, media_ids)
+        
         return True
         
     else:
@@ -227,9 +521,11 @@ def postmedia(url, access_token, media_id, message=None, visibility='public', sp
         return False
 
 
-def post(url, access_token, message, visibility='public', spoiler_text=None):
+def post(url, access_token, message, visibility='public', spoiler_text=None, idempotency_key=None, deadline=None):
     """
     POST-ing with URL-encoded data  (Content-Type: application/x-www-form-urlencoded)
+    
+    idempotency_key, deadline: see postmedia
     """
     
     if not message:
@@ -251,7 +547,9 @@ def post(url, access_token, message, visibility='public', spoiler_text=None):
     endpt = urljoin(url, '/api/v1/statuses')
     
     headers = {'Accept':'application/json', 'Authorization':'Bearer ' + access_token,
-               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0',
+               'Content-Type':'application/x-www-form-urlencoded',
+               'Idempotency-Key':idempotency_key or idempotencykey()}
     params = {'status':message, 'visibility':visibility}
     
     if spoiler_text:
@@ -259,12 +557,9 @@ def post(url, access_token, message, visibility='public', spoiler_text=None):
     
     data = urlencode(params)
     
-    try:
-        data_utf8 = data.encode('utf-8')
-        httpreq = Request(endpt, data=data_utf8, headers=headers)
-        response = urlopen(httpreq)
-    except Exception:
-        print('urlopen in post() encountered an error')
+    response = sendstatus(endpt, headers, data.encode('utf-8'), 'post()', deadline=deadline)
+    
+    if response is None:
         return
     
     
@@ -284,3 +579,183 @@ def post(url, access_token, message, visibility='public', spoiler_text=None):
     
 
 
+def verifytoken(url, access_token, deadline=None):
+    """
+    Check that an access token is still good, without posting anything
+    (GET /api/v1/apps/verify_credentials; works with KritaToot's write-only scope)
+    
+    returns True if it is, False if the instance refused it (401: revoked, app removed),
+    None if that can't be told: no answer, or any other status. A 403 means the token
+    lacks a scope the instance wants for this call (some ask for read), not that it
+    is no good for posting
+    """
+    
+    endpt = urljoin(url, '/api/v1/apps/verify_credentials')
+    
+    headers = {'Accept':'application/json', 'Authorization':'Bearer ' + access_token,
+               'User-Agent':'Mozilla/5.0 (X11; Linux x86_64; rv:10.0) Gecko/20100101 Firefox/10.0'}
+    
+    try:
+        response = getConnectionPool().request('GET', endpt, headers=headers, deadline=deadline)
+    except Exception as e:
+        print('request in verifytoken() encountered an error (%s)' % e)
+        return None
+    
+    statuscode = response.getcode()
+    
+    if statuscode == 200:
+        return True
+    
+    if statuscode == 401:
+        print('access token for %s refused (%i)' % (url, statuscode))
+        return False
+    
+    print('could not verify access token for %s (%i)' % (url, statuscode))
+    return None
+
+
+
+
+
+
+def _selftest(delay=1.5):
+    """
+    Upload three images to a local stand-in server whose /api/v2/media answers 202
+    and only reports them processed delay seconds later, then post them. Checks that
+    polling waits for processing, that the three are processed side by side rather
+    than one after another, and that servers without v2 fall back to v1.
+    
+    Needs neither Krita nor Qt (see __main__ below), or from Krita's Scripter:
+    
+        from kritatoot.Toot import _selftest; _selftest()
+    """
+    
+    import tempfile
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    if sys.version_info < (3,):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    else:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    
+    class StandInServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+    
+    class StandInHandler(BaseHTTPRequestHandler):
+        
+        protocol_version = 'HTTP/1.1'
+        
+        def log_message(self, *args):
+            pass
+        
+        def reply(self, statuscode, jsondata):
+            data = json.dumps(jsondata).encode('utf-8')
+            
+            self.send_response(statuscode)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            
+            server = self.server
+            
+            if self.path == '/api/v2/media' and server.v2:
+                with server.lock:
+                    server.uploaded.append(time.time())
+                    media_id = str(len(server.uploaded))
+                
+                self.reply(202, {'id':media_id, 'url':None})
+            
+            elif self.path == '/api/v1/media':
+                self.reply(200, {'id':'v1', 'url':'http://example.com/v1.png'})
+            
+            elif self.path == '/api/v1/statuses':
+                server.posted = True
+                self.reply(200, {'id':'1'})
+            
+            else:
+                self.reply(404, {'error':'Record not found'})
+        
+        def do_GET(self):
+            server = self.server
+            media_id = self.path.rsplit('/', 1)[-1]
+            
+            with server.lock:
+                server.polls += 1
+            
+            if time.time() - server.uploaded[int(media_id) - 1] < server.delay:
+                self.reply(206, {'id':media_id, 'url':None})
+            else:
+                self.reply(200, {'id':media_id, 'url':'http://example.com/%s.png' % media_id})
+    
+    httpd = StandInServer(('127.0.0.1', 0), StandInHandler)
+    httpd.v2 = True
+    httpd.delay = delay
+    httpd.uploaded = []
+    httpd.polls = 0
+    httpd.posted = False
+    httpd.lock = threading.Lock()
+    
+    server_thread = threading.Thread(target=httpd.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    
+    url = 'http://127.0.0.1:%i' % httpd.server_port
+    
+    filenames = []
+    
+    for index in range(3):
+        fd, filename = tempfile.mkstemp(suffix='.png')
+        
+        with os.fdopen(fd, 'wb') as tmpfile:
+            tmpfile.write(b'\x89PNG\r\n\x1a\n' + os.urandom(1000))
+        
+        filenames.append(filename)
+    
+    results = []
+    
+    started = time.time()
+    
+    # as Worker.uploadall does (which needs Qt): upload side by side, then wait for processing
+    executor = ThreadPoolExecutor(max_workers=len(filenames))
+    media_ids = list(executor.map(lambda filename: uploadmedia(url, 'token', filename, wait=False), filenames))
+    executor.shutdown()
+    
+    if None in media_ids or not all(waitmedia(url, 'token', media_id) for media_id in media_ids):
+        media_ids = None
+    
+    elapsed = time.time() - started
+    
+    results.append(('v2 upload waits for processing', sorted(media_ids or []) == ['1', '2', '3'] and elapsed >= delay))
+    results.append(('processed side by side (%.1f s, %i polls)' % (elapsed, httpd.polls), elapsed < 2 * delay and httpd.polls <= 12))
+    results.append(('post', postmedia(url, 'token', media_ids) and httpd.posted))
+    
+    # (posting forgot the media ids, so this really uploads again)
+    httpd.v2 = False
+    results.append(('v1 fallback', uploadmedia(url, 'token', filenames[0]) == 'v1'))
+    
+    for filename in filenames:
+        os.remove(filename)
+    
+    httpd.shutdown()
+    httpd.server_close()
+    
+    for name, ok in results:
+        print('%s: %s' % (name, 'ok' if ok else 'FAILED'))
+    
+    return all(ok for name, ok in results)
+
+
+if __name__ == '__main__':
+    
+    # python -m kritatoot.Toot test  - upload to a local stand-in server that delays processing
+    #                                  (run from the folder kritatoot is in; Krita isn't needed)
+    
+    if len(sys.argv) == 2 and sys.argv[1] == 'test':
+        sys.exit(0 if _selftest() else 1)
@@ -0,0 +1,303 @@
+import time
+import socket
+import struct
+import threading
+
+
+class Progress:
+    """
+    Bytes sent by the uploads of one job, for a progress display. Several uploads
+    (images, accounts) may report to the same one, from several threads.
+
+        progress = Progress(lambda sent, total, rate: ...)
+
+    callback(sent, total, rate) is called on the sending thread, at most every
+    interval seconds (and once all is sent); rate is in bytes per second since the
+    first byte went out.
+    """
+
+    def __init__(self, callback=None, interval=0.1):
+
+        self.callback = callback
+        self.interval = interval
+
+        self.sent = 0
+        self.total = 0
+
+        self.started = None
+        self.reported = 0.0
+
+        self.lock = threading.Lock()
+
+
+    def expect(self, nbytes):
+        """
+        An upload of nbytes is about to start
+        """
+
+        with self.lock:
+            self.total += nbytes
+
+            if self.started is None:
+                self.started = time.time()
+
+
+    def advance(self, nbytes):
+        """
+        nbytes more went out (negative to take back an attempt that is sent again)
+        """
+
+        with self.lock:
+            self.sent += nbytes
+
+            now = time.time()
+
+            if now - self.reported < self.interval and self.sent < self.total:
+                return
+
+            self.reported = now
+
+            sent, total = self.sent, self.total
+            rate = sent / max(now - self.started, 0.001)
+
+        if self.callback:
+            self.callback(sent, total, rate)
+
+
+    def getRate(self):
+        """
+        bytes per second so far
+        """
+
+        with self.lock:
+            if not self.started:
+                return 0.0
+
+            return self.sent / max(time.time() - self.started, 0.001)
+
+
+
+
+def socketRTT(sock):
+    """
+    The kernel's smoothed round-trip time of a TCP socket, in seconds, or None where
+    it can't be had (TCP_INFO is Linux only)
+    """
+
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except Exception:
+        return None
+
+    if len(info) < 72:
+        return None
+
+    # struct tcp_info: 8 bytes of flags, then 32 bit fields; tcpi_rtt (usec) is the 16th
+    rtt = struct.unpack_from('I', info, 68)[0]
+
+    return rtt / 1000000.0 if rtt else None
+
+
+
+
+class Shaper:
+    """
+    Caps how fast one account uploads, so that posting a large canvas doesn't starve
+    everything else on the uplink (cloud sync, video calls). A token bucket: up to
+    rate bytes per second on average, in bursts of at most a quarter second's worth.
+    Every upload of the account draws from the same bucket.
+
+    rate     - bytes per second, None for no cap
+    adaptive - also back off while the connection's round-trip time rises above the
+               lowest seen (the uplink's queue filling up), and speed up again once it
+               drains: by 15% at a time down to minrate, by 5% of rate (or of 1 MB/s if
+               uncapped) back up. Only where socketRTT works; elsewhere rate holds
+
+    See getShaper
+    """
+
+    def __init__(self, rate=None, adaptive=False, minrate=16 * 1024):
+
+        self.lock = threading.Lock()
+
+        self.minrate = minrate
+
+        # not configured yet
+        self.rate = None
+        self.adaptive = None
+
+        self.configure(rate, adaptive)
+
+
+    def configure(self, rate=None, adaptive=False):
+        """
+        Change the cap. Uploads under way are paced by the new one from their next chunk
+        """
+
+        rate = float(rate) if rate else None
+
+        with self.lock:
+            if rate == self.rate and adaptive == self.adaptive:
+                return
+
+            self.rate = rate
+            self.adaptive = adaptive
+
+            # adaptive mode's current rate, starting at the cap
+            self.current = self.rate if self.rate else (1024 * 1024.0 if adaptive else None)
+
+            self.tokens = 0.0
+            self.refilled = time.time()
+
+            self.baseline = None
+            self.adjusted = 0.0
+
+
+    def isActive(self):
+
+        return bool(self.rate or self.adaptive)
+
+
+    def _adapt(self, sock, now):
+        """
+        adjust the current rate to the connection's round-trip time, every 200 ms at most
+        """
+
+        if now - self.adjusted < 0.2:
+            return
+
+        rtt = socketRTT(sock) if sock is not None else None
+
+        if rtt is None:
+            return
+
+        self.adjusted = now
+
+        if self.baseline is None or rtt < self.baseline:
+            self.baseline = rtt
+
+        # queueing delay: more than half again the quietest RTT seen, and at least 25 ms
+        if rtt > self.baseline * 1.5 + 0.025:
+            self.current = max(self.minrate, self.current * 0.85)
+        else:
+            step = 0.05 * (self.rate or 1024 * 1024.0)
+            self.current = min(self.rate, self.current + step) if self.rate else self.current + step
+
+
+    def consume(self, nbytes, sock=None, deadline=None):
+        """
+        Take nbytes from the bucket, sleeping until they are there. Wakes early (and
+        raises) if deadline is cancelled or passes (see Deadline.sleep)
+        """
+
+        while True:
+
+            with self.lock:
+                now = time.time()
+
+                if self.adaptive:
+                    self._adapt(sock, now)
+
+                rate = self.current
+
+                if not rate:
+                    return
+
+                burst = max(rate * 0.25, nbytes)
+
+                self.tokens = min(burst, self.tokens + (now - self.refilled) * rate)
+                self.refilled = now
+
+                if self.tokens >= nbytes:
+                    self.tokens -= nbytes
+                    return
+
+                delay = (nbytes - self.tokens) / rate
+
+            if deadline:
+                deadline.sleep(delay)
+            else:
+                time.sleep(delay)
+
+
+    def getRate(self):
+        """
+        bytes per second allowed right now, None for no cap
+        """
+
+        with self.lock:
+            return self.current
+
+
+
+
+# one shaper per account, shared by all its uploads
+_shapers = {}
+_shaperslock = threading.Lock()
+
+def getShaper(url):
+    """
+    Returns the upload shaper of the account at url (uncapped until configured,
+    see KritaToot.configureUploadShaping)
+    """
+
+    with _shaperslock:
+        if url not in _shapers:
+            _shapers[url] = Shaper()
+
+        return _shapers[url]
+
+
+
+
+class StreamedBody:
+    """
+    A request body (bytes or an iterable of chunks, e.g. a MultipartBody) as it is
+    handed to http.client: each chunk is paced by shaper and counted by progress once
+    sent. Stops with Cancelled/DeadlineExceeded between chunks if deadline says so.
+
+    sent - bytes sent so far; an attempt that fails can be taken back from progress
+
+    Bytes bodies are cut into 64 KB slices so that they are paced too.
+    """
+
+    def __init__(self, body, conn, progress=None, shaper=None, deadline=None):
+
+        self.body = body
+        self.conn = conn
+
+        self.progress = progress
+        self.shaper = shaper
+        self.deadline = deadline
+
+        self.sent = 0
+
+
+    def __iter__(self):
+
+        body = self.body
+
+        if isinstance(body, bytes):
+            view = memoryview(body)
+            chunks = (view[offset:offset + 65536] for offset in range(0, len(view), 65536))
+        else:
+            chunks = body
+
+        for chunk in chunks:
+
+            if self.deadline:
+                self.deadline.check()
+
+            if self.shaper:
+                self.shaper.consume(len(chunk), self.conn.sock, self.deadline)
+
+            yield chunk
+
+            # resumed: http.client has sent it
+            self.sent += len(chunk)
+
+            if self.progress:
+                self.progress.advance(len(chunk))
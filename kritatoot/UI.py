@@ -1,6 +1,7 @@
 
 import os
 import sys
+import time
 import inspect
 
 if sys.version_info < (3,):
@@ -13,19 +14,26 @@ else:
 
 from .UploadTab import UploadTab
 from .AccountsTab import AccountsTab
+from .ImageBox import getPixmapCache
 
-from .App import KritaToot
+from .App import getKritaToot
 
 
 
 class KritaTootUI(QDialog):
     """
     Main dialog for KritaToot
+    
+    A new dialog is built each time it is opened, but the KritaToot behind it (accounts,
+    settings) lives on (see App.getKritaToot), as do connections and caches, so later
+    openings don't read or fetch anything that hasn't changed
     """
 
     def __init__(self, parent=None):
         super(KritaTootUI, self).__init__(parent) # Py2
         
+        started = time.time()
+        
         thisscript = inspect.getfile(KritaTootUI)
         parentfolder = os.path.dirname(thisscript)
         
@@ -46,14 +54,18 @@ class KritaTootUI(QDialog):
 
         self.setLayout(vertLayout)
         
-        self.mainapp = KritaToot()
+        # only re-read if the files changed since the last opening
+        self.mainapp = getKritaToot()
         self.mainapp.loadAccounts()
+        self.mainapp.loadSettings()
         
         
         # tabs need access to the following objs/props
         self.uploadtab.setApp(self.mainapp)
         self.accountstab.setApp(self.mainapp)
         
+        self.uploadtab.setStatusBar(self.statusbar)
+        
         
         self.uploadtab.refreshURLList()
         
@@ -67,6 +79,28 @@ class KritaTootUI(QDialog):
         # slots
         self.tabwidget.currentChanged.connect(self.updateTab)
         
+        # if enabled, upload while the user writes the toot
+        self.uploadtab.startPreUpload()
+        
+        # the accounts tab's images: decoded in the background once the dialog is up
+        QTimer.singleShot(0, getPixmapCache().prefetch)
+        
+        print('dialog ready in %.1f ms' % ((time.time() - started) * 1000.0))
+        
+    
+    def done(self, result):
+        """
+        dialog closed. throw away any speculative upload, stop warming up connections
+        """
+        
+        self.uploadtab.discardPreUpload()
+        self.uploadtab.stopWarmUp()
+        self.uploadtab.stopOutboxReports()
+        
+        # the app outlives the dialog; don't leave an authorization server behind
+        self.mainapp.stopHTTPServer()
+        
+        super(KritaTootUI, self).done(result)
     
     
     def updateTab(self):
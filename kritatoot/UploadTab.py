@@ -1,6 +1,7 @@
 
 import os
 import sys
+import time
 import inspect
 
 if sys.version_info < (3,):
@@ -12,8 +13,13 @@ else:
     from PyQt5.QtWidgets import *
     from PyQt5.QtCore import *
     
-from .Toot import uploadmedia, postmedia, post
-from .TempMedia import saveTempMedia, removeTempMedia
+from .TempMedia import exportMedia, saveTempMediaList, saveTempAnimation, documentFingerprint
+from .Connection import getConnectionPool
+from .Worker import UploadWorker, MediaUploadWorker, CrossPostWorker, InstanceWorker, WarmUpWorker, getThreadPool, getOutboxDrainer
+from .Outbox import getOutbox
+from .Instance import DEFAULTS, combineLimits
+from .Animation import ANIMATIONFORMATS
+from .Encoder import acceptedFormats
 
 
 
@@ -21,7 +27,7 @@ class UploadTab(QWidget):
     """
     A widget representing the Upload/Toot tab where one can:
     
-        enter a 500-char max toot message (optional)
+        enter a toot message (optional), up to the instance's max chars (500 on most)
         
         specify the toots privacy level (public, unlisted, followers-only, direct)
         
@@ -42,6 +48,32 @@ class UploadTab(QWidget):
         # selected url
         self.activeurl = None
         
+        # where upload progress is reported, if anywhere (see setStatusBar)
+        self.statusbar = None
+        
+        # the running upload job, if any
+        self.worker = None
+        
+        # speculative upload started before Toot is pressed, if any (see startPreUpload)
+        self.preuploadjob = None
+        
+        # post waiting for the speculative upload to finish, if any
+        self.pendingpost = None
+        
+        # limits of the selected instance(s) (see updateLimits), and the fetches of
+        # instance limits in flight, by url
+        self.limits = dict(DEFAULTS)
+        self.instanceworkers = {}
+        
+        # warm-ups in flight and when each site was last warmed up, by url (see warmUp).
+        # Repeated while the dialog is open so the connection stays warm
+        self.warmupworkers = {}
+        self.warmedup = {}
+        
+        self.warmuptimer = QTimer(self)
+        self.warmuptimer.setInterval(50000)
+        self.warmuptimer.timeout.connect(self.warmUp)
+        
         self.icons = {
             'nohide': QIcon( os.path.join(parentfolder, "images/all/nohide.png") ),
             'hide':   QIcon( os.path.join(parentfolder, "images/all/hide.png") ),
@@ -55,12 +87,22 @@ class UploadTab(QWidget):
         self.urllist  = QComboBox()
         
         # max number of chars allowed in a toot
-        self.maxchars = 500
+        self.maxchars = self.limits['maxchars']
+        
+        # max number of images per toot
+        self.maxattachments = self.limits['maxattachments']
         
         
+        # post on several sites at once: pick them from a checkable list instead
+        self.crosspost = QCheckBox('Cross-post')
+        self.crosslist = QListWidget()
+        self.crosslist.setVisible(False)
+        
         urlLayout = QVBoxLayout()
         urlLayout.addWidget(self.urllabel)
         urlLayout.addWidget(self.urllist)
+        urlLayout.addWidget(self.crosslist)
+        urlLayout.addWidget(self.crosspost)
         
         self.textlabel = QLabel('Message')
         
@@ -71,11 +113,22 @@ class UploadTab(QWidget):
         # display the number of chars remaining in a toot
         # message before hitting full capacity
         counterLayout = QHBoxLayout()
-        self.charcount = QLabel('<b>500</B>')
+        self.charcount = QLabel('<b>%i</B>' % self.maxchars)
         
         counterLayout.addWidget(self.charcount)
         counterLayout.insertStretch(0)
         
+        # opt-in: upload the image while the message is being written
+        self.preupload = QCheckBox('Upload while typing')
+        counterLayout.insertWidget(0, self.preupload)
+        
+        # which images to attach
+        self.attach = QComboBox()
+        self.attach.addItem('Current Document',   userData={'value':'document'})
+        self.attach.addItem('All Open Documents', userData={'value':'documents'})
+        self.attach.addItem('Selected Layers',    userData={'value':'layers'})
+        self.attach.addItem('Animation',          userData={'value':'animation'})
+        
         self.privacy = QComboBox()
         self.privacy.addItem('Public',         userData={'value':'public'})
         self.privacy.addItem('Unlisted',       userData={'value':'unlisted'})
@@ -104,12 +157,19 @@ class UploadTab(QWidget):
         
         self.tootimg.setEnabled(False)
         
+        # stop the post in flight (or the speculative upload Toot is waiting on)
+        self.cancelbtn = QToolButton()
+        self.cancelbtn.setText('Cancel')
+        self.cancelbtn.setVisible(False)
+        
         horizLayout = QHBoxLayout()
         
+        horizLayout.addWidget(self.attach)
         horizLayout.addWidget(self.privacy)
         horizLayout.addWidget(self.hidden)
         horizLayout.addWidget(self.focalpoint)
         horizLayout.addWidget(self.tootimg)
+        horizLayout.addWidget(self.cancelbtn)
         
         vertLayout = QVBoxLayout()
         
@@ -129,6 +189,17 @@ class UploadTab(QWidget):
         self.hidden.clicked.connect(self.toggleVisibility)
         
         self.tootimg.clicked.connect(self.upload)
+        self.cancelbtn.clicked.connect(self.cancelUpload)
+        
+        self.preupload.toggled.connect(self.togglePreUpload)
+        self.urllist.activated.connect(self.updateLimits)
+        self.urllist.activated.connect(self.warmUp)
+        self.urllist.activated.connect(self.startPreUpload)
+        self.crosslist.itemChanged.connect(self.updateLimits)
+        self.crosslist.itemChanged.connect(self.warmUp)
+        self.attach.activated.connect(self.startPreUpload)
+        
+        self.crosspost.toggled.connect(self.toggleCrossPost)
     
     
     def setApp(self, app):
@@ -137,6 +208,11 @@ class UploadTab(QWidget):
         """
         
         self.app = app
+        
+        # restore the speculative upload preference without kicking one off
+        self.preupload.blockSignals(True)
+        self.preupload.setChecked(bool(app.getSetting('preupload', False)))
+        self.preupload.blockSignals(False)
     
     
     def refreshURLList(self):
@@ -157,9 +233,19 @@ class UploadTab(QWidget):
             
             self.urllist.clear()
             
+            # keep the sites ticked for cross-posting ticked
+            ticked = self.getCrossPostURLs()
+            
+            self.crosslist.clear()
+            
             for url in urls:
                 self.urllist.addItem(url)
                 nitems += 1
+                
+                item = QListWidgetItem(url)
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(Qt.Checked if url in ticked else Qt.Unchecked)
+                self.crosslist.addItem(item)
         
         
         index = -1
@@ -171,8 +257,177 @@ class UploadTab(QWidget):
             self.urllist.setCurrentIndex(index)
         
         
-        if nitems:
+        # not while an upload is in flight
+        if nitems and not self.isBusy():
             self.tootimg.setEnabled(True)
+        
+        self.updateLimits()
+        self.warmUp()
+    
+    
+    def getCrossPostURLs(self):
+        """
+        urls ticked in the cross-post list
+        """
+        
+        urls = []
+        
+        for row in range(self.crosslist.count()):
+            item = self.crosslist.item(row)
+            
+            if item.checkState() == Qt.Checked:
+                urls.append(item.text())
+        
+        return urls
+    
+    
+    def toggleCrossPost(self, checked):
+        """
+        swap the single-site dropdown for the multi-site list, or back
+        """
+        
+        self.urllist.setVisible(not checked)
+        self.crosslist.setVisible(checked)
+        
+        self.updateLimits()
+        
+        if checked:
+            # speculative uploads are for a single site
+            self.discardPreUpload()
+            
+            # start with the site currently selected
+            if not self.getCrossPostURLs():
+                items = self.crosslist.findItems(self.urllist.currentText(), Qt.MatchExactly)
+                
+                for item in items:
+                    item.setCheckState(Qt.Checked)
+        else:
+            self.startPreUpload()
+    
+    
+    def updateLimits(self):
+        """
+        Adopt the limits of the selected instance (or, when cross-posting, the limits
+        every ticked instance can live with): max chars, max images, image size and
+        accepted formats. Cached limits are used straight away; missing or stale ones
+        are fetched in the background and adopted once they arrive (see fetchLimits)
+        """
+        
+        if not self.app:
+            return
+        
+        if self.crosspost.isChecked():
+            urls = self.getCrossPostURLs()
+        else:
+            urls = [self.urllist.currentText()] if self.urllist.currentText() else []
+        
+        cache = self.app.getInstanceCache()
+        
+        self.limits = combineLimits([cache.get(url, fetch=False) for url in urls])
+        
+        self.maxchars = self.limits['maxchars']
+        self.maxattachments = self.limits['maxattachments']
+        
+        self.updateCharCount()
+        
+        for url in urls:
+            if not cache.isFresh(url):
+                self.fetchLimits(url)
+    
+    
+    def fetchLimits(self, url):
+        """
+        Fetch an instance's limits on a worker thread, unless already underway
+        """
+        
+        if url in self.instanceworkers:
+            return
+        
+        worker = InstanceWorker(self.app, url)
+        worker.signals.finished.connect(self.limitsFetched)
+        
+        self.instanceworkers[url] = worker
+        
+        getThreadPool().start(worker)
+    
+    
+    def limitsFetched(self, result, url):
+        """
+        runs on the main thread once an instance's limits have been fetched (or not)
+        """
+        
+        self.instanceworkers.pop(url, None)
+        
+        if result:
+            self.updateLimits()
+    
+    
+    def warmUp(self):
+        """
+        Connect to the selected site(s) and check their access tokens in the background
+        (see Worker.WarmUpWorker), so that pressing Toot doesn't wait on handshakes and a
+        revoked token shows up early. Sites warmed up in the last 45 seconds are skipped;
+        the timer keeps the connections from going cold while the dialog is open
+        """
+        
+        if not self.app:
+            return
+        
+        if self.crosspost.isChecked():
+            urls = self.getCrossPostURLs()
+        else:
+            urls = [self.urllist.currentText()] if self.urllist.currentText() else []
+        
+        now = time.time()
+        
+        for url in urls:
+            # a post in flight keeps its own connections warm
+            if url in self.warmupworkers or self.isBusy() or now - self.warmedup.get(url, 0.0) < 45.0:
+                continue
+            
+            account = self.app.getAccount(url)
+            
+            if not account:
+                continue
+            
+            worker = WarmUpWorker(url, account.getAccessToken(), budgets=self.app.getDeadlineBudgets())
+            worker.signals.finished.connect(lambda result, message, url=url: self.warmedUp(url, result, message))
+            
+            self.warmupworkers[url] = worker
+            self.warmedup[url] = now
+            
+            getThreadPool().start(worker)
+        
+        if urls and not self.warmuptimer.isActive():
+            self.warmuptimer.start()
+    
+    
+    def warmedUp(self, url, result, message):
+        """
+        runs on the main thread once a site has been warmed up
+        """
+        
+        self.warmupworkers.pop(url, None)
+        
+        if not result and self.statusbar and not self.isBusy():
+            self.statusbar.showMessage(message)
+    
+    
+    def stopWarmUp(self):
+        """
+        dialog closed: stop keeping connections warm. Warm-ups still in flight finish
+        unreported, as the status bar goes with the dialog
+        """
+        
+        self.warmuptimer.stop()
+        
+        for worker in self.warmupworkers.values():
+            try:
+                worker.signals.finished.disconnect()
+            except Exception:
+                pass
+        
+        self.warmupworkers = {}
     
     
     def updateCharCount(self):
@@ -195,7 +450,7 @@ class UploadTab(QWidget):
             if self.app:
                 nurls = self.app.getAccountsLength()
             
-            if nurls:
+            if nurls and not self.isBusy():
                 self.tootimg.setEnabled(True)
                 
         else:
@@ -237,6 +492,9 @@ class UploadTab(QWidget):
             print('No URL chosen')
             return False
         
+        if self.crosspost.isChecked():
+            return self.crossPost()
+        
         message = self.textbox.toPlainText()
         nchars = len(message)
         
@@ -280,60 +538,467 @@ class UploadTab(QWidget):
                 QMessageBox.warning(self, 'Post Failed', 'No access token')
                 return
             
-            # export a copy of the current doc to upload before posting
-            filename = saveTempMedia()
+            self.tootimg.setEnabled(False)
             
-            if not filename:
-                QMessageBox.warning(self, 'Post Failed', 'could not export')
-                print('No temp file possible')
-                return
+            # which images: 'document', 'documents', 'layers'
+            source = self.attach.itemData(self.attach.currentIndex())['value']
             
-            self.tootimg.setEnabled(False)
-            QApplication.setOverrideCursor(Qt.WaitCursor)
+            post = {'url':url, 'access_token':access_token, 'message':message, 'visibility':visibility, 'sensitive':hideme,
+                    'source':source}
             
-            # media must be uploaded prior to posting a toot
-            print('uploading media')
+            # can the speculative upload (current doc only), if any, be used?
+            job = self.preuploadjob
             
-            try:
-                media_id = uploadmedia(url, access_token, filename, description="Uploaded using kritatoot", focus=(0.0,0.0))
+            if job and source == 'document' and job['url'] == url and job['fingerprint'] and job['fingerprint'] == documentFingerprint():
                 
-                if not media_id:
-                    QApplication.restoreOverrideCursor()
-                    
-                    removeTempMedia(filename)
-                    
-                    QMessageBox.warning(self, 'Post Failed', 'Media could not be uploaded')
-                    print('Failed to upload media')
+                if not job['done']:
+                    # still uploading. post as soon as it's done (see preUploadFinished)
+                    print('waiting on speculative upload')
+                    self.pendingpost = post
+                    self.cancelbtn.setVisible(True)
                     return
                 
-                # post the toot
-                print('posting media on mastodon')
-                result = postmedia(url, access_token, media_id, message=message, visibility=visibility, spoiler_text=None, sensitive=hideme)
-                
-                removeTempMedia(filename)
-            except Exception:
-                print('uncaught error. restoring cursor and exiting')
-                QApplication.restoreOverrideCursor()
-                return
+                if job['media_id']:
+                    print('using speculatively uploaded media')
+                    self.preuploadjob = None
+                    self.startPost(post, media_id=job['media_id'])
+                    return
+            
+            # no speculative upload, it failed, or the doc has changed since
+            self.discardPreUpload()
+            self.startPost(post)
+    
+    
+    def startPost(self, post, media_id=None):
+        """
+        Start a worker that uploads (unless media_id is given) and posts
+        
+        post (dict) url, access_token, message, visibility, sensitive, source
+        """
+        
+        filename = None
+        
+        if not media_id:
+            # export a copy of the current doc (or docs, or layers) to upload before posting
+            filename = self.exportAttachments(post['source'])
             
-            QApplication.restoreOverrideCursor()
+            if not filename:
+                QMessageBox.warning(self, 'Post Failed', 'could not export')
+                print('No temp file possible')
+                self.tootimg.setEnabled(True)
+                return
+        
+        # upload + post on a worker thread so Krita stays responsive
+        worker = UploadWorker(post['url'], post['access_token'], filename, message=post['message'], visibility=post['visibility'],
+                              sensitive=post['sensitive'], description="Uploaded using kritatoot", focus=(0.0,0.0), media_id=media_id,
+                              limits=self.limits, budgets=self.app.getDeadlineBudgets())
+        
+        worker.signals.stage.connect(self.updateStage)
+        worker.signals.progress.connect(self.updateProgress)
+        worker.signals.finished.connect(self.uploadFinished)
+        
+        # hold on to it until it's done
+        self.worker = worker
+        self.cancelbtn.setVisible(True)
+        
+        self.app.configureUploadShaping()
+        getThreadPool().start(worker)
+    
+    
+    def crossPost(self):
+        """
+        Export once and post the same images and toot on every ticked site, concurrently
+        """
+        
+        message = self.textbox.toPlainText()
+        
+        if len(message) > self.maxchars:
+            print('Max Chars exceeded')
+            return False
+        
+        if not self.app:
+            return False
+        
+        accounts = []
+        
+        for url in self.getCrossPostURLs():
+            account = self.app.getAccount(url)
             
-            if result:
-                # reset certain widgets
-                self.textbox.clear()
-                
-                if self.hidden.toggled:
-                    self.hidden.toggled = False
-                    visibleicon = self.icons['nohide']
-                    self.hidden.setIcon(visibleicon)
-                
-                QMessageBox.information(self, 'Post Completed', 'Image uploaded')
-                print('Post Succeeded')
+            if account and account.getAccessToken():
+                accounts.append((url, account.getAccessToken()))
             else:
-                QMessageBox.warning(self, 'Post Failed', 'Image did not upload')
-                print('Post Failed')
-                
+                print('No access token for ' + url)
+        
+        if not accounts:
+            QMessageBox.warning(self, 'Post Failed', 'No site chosen')
+            return False
+        
+        source = self.attach.itemData(self.attach.currentIndex())['value']
+        visibility = self.privacy.itemData(self.privacy.currentIndex())['value']
+        
+        self.tootimg.setEnabled(False)
+        
+        # one export, shared by every site
+        filenames = self.exportAttachments(source)
+        
+        if not filenames:
+            QMessageBox.warning(self, 'Post Failed', 'could not export')
+            print('No temp file possible')
             self.tootimg.setEnabled(True)
+            return False
+        
+        worker = CrossPostWorker(accounts, filenames, message=message, visibility=visibility, sensitive=self.hidden.toggled,
+                                 description="Uploaded using kritatoot", focus=(0.0,0.0), limits=self.limits,
+                                 budgets=self.app.getDeadlineBudgets())
+        
+        worker.signals.stage.connect(self.updateStage)
+        worker.signals.progress.connect(self.updateProgress)
+        worker.signals.posted.connect(self.crossPosted)
+        worker.signals.finished.connect(self.uploadFinished)
+        
+        self.worker = worker
+        self.cancelbtn.setVisible(True)
+        
+        self.app.configureUploadShaping()
+        getThreadPool().start(worker)
+        
+        return True
+    
+    
+    def crossPosted(self, url, result, status):
+        """
+        runs on the main thread each time a site of a cross-post is done
+        """
+        
+        if self.statusbar:
+            self.statusbar.showMessage('%s: %s' % (url, status))
+    
+    
+    def togglePreUpload(self, checked):
+        """
+        Turn speculative uploads on/off (and remember the choice)
+        """
+        
+        if self.app:
+            self.app.setSetting('preupload', checked)
+            self.app.saveSettings()
+        
+        if checked:
+            self.startPreUpload()
+        else:
+            self.discardPreUpload()
+    
+    
+    def startPreUpload(self):
+        """
+        Speculatively export and upload the current doc to the selected site, so that
+        pressing Toot only has to post. Only if enabled (see preupload checkbox).
+        
+        Mastodon hands out the media id before the toot exists; if the doc changes or
+        the dialog is closed the upload is simply thrown away (the server discards
+        unattached media on its own).
+        """
+        
+        if not self.preupload.isChecked() or self.crosspost.isChecked() or not self.app or self.pendingpost:
+            return
+        
+        self.discardPreUpload()
+        
+        # only the current doc is uploaded ahead of time
+        if self.attach.itemData(self.attach.currentIndex())['value'] != 'document':
+            return
+        
+        url = self.urllist.currentText()
+        account = self.app.getAccount(url) if url else None
+        
+        if not account or not account.getAccessToken():
+            return
+        
+        filename = exportMedia(inmemory=self.inMemoryExport(), **self.getEncodeOptions())
+        
+        # in-memory exports were already hashed for the export cache
+        fingerprint = getattr(filename, 'digest', None) or documentFingerprint()
+        
+        if not fingerprint or not filename:
+            print('speculative upload not possible')
+            return
+        
+        worker = MediaUploadWorker(url, account.getAccessToken(), filename, description="Uploaded using kritatoot", focus=(0.0,0.0),
+                                   limits=self.limits, budgets=self.app.getDeadlineBudgets())
+        
+        job = {'url':url, 'fingerprint':fingerprint, 'worker':worker, 'media_id':None, 'done':False}
+        
+        worker.signals.stage.connect(self.updateStage)
+        worker.signals.progress.connect(self.updateProgress)
+        worker.signals.uploaded.connect(lambda media_id, job=job: self.preUploadFinished(job, media_id))
+        
+        self.preuploadjob = job
+        
+        self.app.configureUploadShaping()
+        getThreadPool().start(worker)
+    
+    
+    def preUploadFinished(self, job, media_id):
+        """
+        runs on the main thread when a speculative upload is done
+        """
+        
+        job['done'] = True
+        job['media_id'] = media_id
+        job['worker'] = None
+        
+        if job is not self.preuploadjob:
+            # discarded in the meantime
+            return
+        
+        post = self.pendingpost
+        
+        if not post:
+            # Toot not pressed yet
+            if self.statusbar:
+                self.statusbar.showMessage('Image uploaded. Ready to post' if media_id else '')
+            return
+        
+        self.pendingpost = None
+        self.preuploadjob = None
+        self.cancelbtn.setVisible(False)
+        
+        # fall back to a regular upload if it failed
+        self.startPost(post, media_id=media_id if media_id else None)
+    
+    
+    def exportAttachments(self, source):
+        """
+        Export the images for one toot (see TempMedia.saveTempMediaList), or the current
+        doc's animation if source is 'animation'. Returns a list, empty on failure
+        """
+        
+        if source == 'animation':
+            media = saveTempAnimation(**self.getAnimationOptions())
+            return [media] if media else []
+        
+        return saveTempMediaList(source, limit=self.maxattachments, inmemory=self.inMemoryExport(), **self.getEncodeOptions())
+    
+    
+    def getAnimationOptions(self):
+        """
+        How animations are exported (see Animation.exportAnimation): as the
+        'animationformat' setting ('mp4' by default, or 'webm', 'gif'), within the
+        instance's video limits (GIFs count as images). ffmpeg is found on PATH unless
+        the 'ffmpeg' setting says where it is
+        """
+        
+        animationformat, ffmpeg = 'mp4', None
+        
+        if self.app:
+            animationformat = self.app.getSetting('animationformat', animationformat)
+            ffmpeg = self.app.getSetting('ffmpeg', None)
+        
+        if animationformat not in ANIMATIONFORMATS:
+            animationformat = 'mp4'
+        
+        # fall back to a gif if the instance won't take the video format
+        if ANIMATIONFORMATS[animationformat][1] not in self.limits['mimetypes']:
+            animationformat = 'gif'
+        
+        if animationformat == 'gif':
+            maxbytes, maxpixels = self.limits['maxbytes'], self.limits['maxpixels']
+        else:
+            maxbytes, maxpixels = self.limits['maxvideobytes'], self.limits['maxvideopixels']
+        
+        return {'animationformat':animationformat, 'maxbytes':maxbytes, 'maxpixels':maxpixels,
+                'maxfps':self.limits['maxframerate'], 'ffmpeg':ffmpeg}
+    
+    
+    def inMemoryExport(self):
+        """
+        True if docs are encoded in memory rather than exported to temp files
+        (the 'memoryexport' setting, on by default)
+        """
+        
+        if self.app:
+            return bool(self.app.getSetting('memoryexport', True))
+        
+        return True
+    
+    
+    def getEncodeOptions(self):
+        """
+        How images are encoded before they are uploaded (see TempMedia.exportMedia):
+        
+            maxbytes, maxpixels - budget each image must fit: the instance's image limits
+                                  (see updateLimits), or the 'maxbytes' and 'maxpixels'
+                                  settings if smaller (0 for the instance's)
+            minssim             - when the 'encoderace' setting is on, PNG, JPEG and WebP
+                                  are encoded at once and the smallest with at least this
+                                  similarity (setting 'minssim', default 0.98) is uploaded
+            formats             - formats the instance accepts
+        """
+        
+        maxbytes, maxpixels = self.limits['maxbytes'], self.limits['maxpixels']
+        minssim = None
+        
+        if self.app:
+            maxbytes = min(self.app.getSetting('maxbytes', 0) or maxbytes, maxbytes)
+            maxpixels = min(self.app.getSetting('maxpixels', 0) or maxpixels, maxpixels)
+            
+            if self.app.getSetting('encoderace', False):
+                minssim = self.app.getSetting('minssim', 0.98)
+        
+        return {'maxbytes':maxbytes, 'maxpixels':maxpixels, 'minssim':minssim, 'formats':acceptedFormats(self.limits['mimetypes'])}
+    
+    
+    def isBusy(self):
+        """
+        True while a post is in flight (or waiting on a speculative upload)
+        """
+        
+        return bool(self.worker or self.pendingpost)
+    
+    
+    def discardPreUpload(self):
+        """
+        Forget the speculative upload, if any (unless Toot is waiting on it).
+        A running upload is cancelled; its result is ignored.
+        """
+        
+        if self.pendingpost:
+            return
+        
+        job = self.preuploadjob
+        self.preuploadjob = None
+        
+        if job and job['worker']:
+            job['worker'].cancel()
+    
+    
+    def cancelUpload(self):
+        """
+        Cancel button: stop the post in flight. An upload stops mid-send; a toot
+        already posted stays posted
+        """
+        
+        if self.worker:
+            print('cancelling post')
+            self.worker.cancel()
+            
+            if self.statusbar:
+                self.statusbar.showMessage('Cancelling...')
+        
+        elif self.pendingpost:
+            # Toot was waiting on the speculative upload
+            print('cancelling post')
+            self.pendingpost = None
+            self.discardPreUpload()
+            
+            self.cancelbtn.setVisible(False)
+            self.tootimg.setEnabled(True)
+            
+            if self.statusbar:
+                self.statusbar.showMessage('Cancelled')
+    
+    
+    def setStatusBar(self, statusbar):
+        """
+        assign a QStatusBar used to report upload progress, if any
+        """
+        
+        self.statusbar = statusbar
+        
+        # failed posts are retried in the background; say so
+        pending = getOutbox().pending()
+        
+        if pending:
+            self.statusbar.showMessage('%i post(s) waiting in the outbox' % pending)
+        
+        getOutboxDrainer().drained.connect(self.outboxDrained)
+    
+    
+    def stopOutboxReports(self):
+        """
+        dialog closed: the outbox drainer outlives this tab
+        """
+        
+        try:
+            getOutboxDrainer().drained.disconnect(self.outboxDrained)
+        except Exception:
+            pass
+    
+    
+    def outboxDrained(self, result, summary):
+        """
+        runs on the main thread each time the outbox has been retried
+        """
+        
+        if self.statusbar and not self.isBusy():
+            self.statusbar.showMessage(summary)
+    
+    
+    def updateStage(self, stage):
+        """
+        runs on the main thread whenever the upload worker enters a new stage
+        """
+        
+        stages = {'uploading':'Uploading image...', 'posting':'Posting toot...'}
+        
+        if self.statusbar:
+            self.statusbar.showMessage(stages.get(stage, stage))
+    
+    
+    def updateProgress(self, sent, total, rate):
+        """
+        runs on the main thread as an upload worker sends its images
+        """
+        
+        if not self.statusbar:
+            return
+        
+        if total >= 1048576:
+            amount = '%.1f of %.1f MB' % (sent / 1048576.0, total / 1048576.0)
+        else:
+            amount = '%i of %i KB' % (sent / 1024, total / 1024)
+        
+        self.statusbar.showMessage('Uploading... %s (%i%%), %i KB/s' % (amount, 100.0 * sent / max(total, 1), rate / 1024))
+    
+    
+    def uploadFinished(self, result, status):
+        """
+        runs on the main thread when the upload worker is done
+        """
+        
+        self.worker = None
+        self.cancelbtn.setVisible(False)
+        
+        if self.statusbar:
+            self.statusbar.clearMessage()
+        
+        stats = getConnectionPool().getStats()
+        print('connections: %i opened, %i reused, %i TLS sessions resumed' % (stats['opened'], stats['reused'], stats['resumed']))
+        
+        if result:
+            # reset certain widgets
+            self.textbox.clear()
+            
+            if self.hidden.toggled:
+                self.hidden.toggled = False
+                visibleicon = self.icons['nohide']
+                self.hidden.setIcon(visibleicon)
+            
+            QMessageBox.information(self, 'Post Completed', status)
+            print('Post Succeeded')
+        elif status.startswith('Cancelled'):
+            print('Post Cancelled')
+            
+            if self.statusbar:
+                self.statusbar.showMessage(status)
+        else:
+            # kept in the outbox, if it could be; retry when due
+            getOutboxDrainer().schedule()
+            
+            QMessageBox.warning(self, 'Post Failed', status)
+            print('Post Failed')
+            
+        self.tootimg.setEnabled(True)
 
 
 
@@ -0,0 +1,839 @@
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+if sys.version_info < (3,):
+    from PySide.QtCore import *  # py2
+    pyqtSignal = Signal
+else:
+    from PyQt5.QtCore import *
+
+from .Toot import uploadmedia, postmedia, buildmediabody, uploadbody, waitmedia, verifytoken
+from .Connection import getConnectionPool
+from .TempMedia import removeTempMedia
+from .Outbox import getOutbox
+from .Cache import getMediaIDCache
+from .Deadline import Deadline, DeadlineExceeded, Cancelled
+from .Transfer import Progress
+
+
+# upload/post jobs run here, never on Krita's GUI thread
+_threadpool = None
+
+def getThreadPool():
+    """
+    Returns the QThreadPool KritaToot runs its network jobs on
+    """
+
+    global _threadpool
+
+    if _threadpool is None:
+        _threadpool = QThreadPool()
+
+    return _threadpool
+
+
+
+
+# media uploads of a single job run here, side by side
+_uploadexecutor = None
+
+def getUploadExecutor():
+    """
+    Returns the (bounded) pool media uploads run on concurrently
+    """
+
+    global _uploadexecutor
+
+    if _uploadexecutor is None:
+        _uploadexecutor = ThreadPoolExecutor(max_workers=4)
+
+    return _uploadexecutor
+
+
+# uploads a cross-post runs at once, at most (see CrossPostWorker)
+MAXCROSSUPLOADS = 16
+
+
+def uploadall(url, access_token, filenames, description=None, focus=(0.0,0.0), limits=None, deadline=None, progress=None):
+    """
+    Upload several images at once (see getUploadExecutor) and return their media ids,
+    in the order given. Returns None if any upload failed.
+
+    Wall-clock time is close to that of the slowest single upload.
+
+    Uploads don't wait for the server to process them (see Toot.uploadbody), so a
+    worker moves on to the next image while the server is still busy with the last;
+    processing is waited on once every image is up.
+
+    limits   - the instance's limits, if known (see Toot.buildmediabody)
+    deadline - for the uploads and the wait (see Deadline module). Raises DeadlineExceeded
+               if it passes, Cancelled if it is cancelled
+    progress - a Transfer.Progress the uploads report to
+    """
+
+    if len(filenames) == 1:
+        media_ids = [uploadmedia(url, access_token, filenames[0], description=description, focus=focus, limits=limits, wait=False,
+                                 deadline=deadline, progress=progress)]
+    else:
+        executor = getUploadExecutor()
+
+        futures = [executor.submit(uploadmedia, url, access_token, filename, description=description, focus=focus, limits=limits, wait=False,
+                                   deadline=deadline, progress=progress)
+                   for filename in filenames]
+
+        media_ids = [future.result() for future in futures]
+
+    if None in media_ids or not waitall(url, access_token, media_ids, deadline=deadline):
+        return None
+
+    return media_ids
+
+
+def encodeall(media, deadline=None):
+    """
+    Encode the in-memory images among media (see TempMedia.MemoryMedia) side by side
+    on the upload pool, so that whatever reads them next finds them encoded.
+    Raises DeadlineExceeded or Cancelled as their getData() does
+    """
+
+    items = [item for item in media if hasattr(item, 'getData')]
+
+    list(getUploadExecutor().map(lambda item: item.getData(deadline=deadline), items))
+
+
+def deliver(entry, access_token, url, limits=None, deadline=None, progress=None, stage=None):
+    """
+    Send an outbox entry (see Outbox module) to one of its accounts: upload its
+    images, unless they already were and their media ids are likely still valid,
+    then post. The entry is updated (and journaled) after each step.
+
+    deadline - of the whole post (see Deadline module). Uploading and posting each
+               get their own stage of it; the message names the one that ran out of time.
+               Once cancelled, nothing more is sent
+    progress - a Transfer.Progress the uploads report to
+    stage    - called with 'uploading' before the images are uploaded (not if they
+               already were) and 'posting' before the toot is posted
+
+    Returns (success, message)
+    """
+
+    try:
+        return _deliver(entry, access_token, url, limits, deadline, progress, stage)
+    except DeadlineExceeded as e:
+        print('%s: %s' % (url, e))
+        return (False, 'Timed out: %s' % e)
+    except Cancelled:
+        print('%s: cancelled' % url)
+        return (False, 'Cancelled')
+
+
+def _deliver(entry, access_token, url, limits, deadline, progress, stage):
+
+    outbox = getOutbox()
+
+    state = entry['accounts'][url]
+
+    if state['posted']:
+        return (True, 'Image uploaded')
+
+    media_ids = state['media_ids']
+
+    # the server drops media that are never attached
+    if media_ids and time.time() - state['uploaded'] > getMediaIDCache().ttl:
+        media_ids = None
+
+    if not media_ids:
+        if not entry['media']:
+            return (False, 'Uploaded media expired')
+
+        print('uploading %i image(s)' % len(entry['media']))
+
+        if stage:
+            stage('uploading')
+
+        media_ids = uploadall(url, access_token, entry['media'], description=entry['description'], focus=tuple(entry['focus']),
+                              limits=limits, deadline=deadline.stage('upload') if deadline else None, progress=progress)
+
+        if not media_ids:
+            return (False, 'Media could not be uploaded')
+
+        state['media_ids'] = media_ids
+        state['uploaded'] = time.time()
+        outbox.save(entry)
+
+    elif not waitall(url, access_token, media_ids, deadline=deadline.stage('upload') if deadline else None):
+        # uploaded earlier (ahead of time, or by a previous attempt), maybe still processing
+        return (False, 'Media could not be uploaded')
+
+    print('posting media on mastodon')
+
+    if stage:
+        stage('posting')
+
+    # the same key on every attempt: a retry after a lost response can't post twice
+    if not postmedia(url, access_token, media_ids, message=entry['message'], visibility=entry['visibility'],
+                     spoiler_text=None, sensitive=entry['sensitive'], idempotency_key=entry['id'],
+                     deadline=deadline.stage('post') if deadline else None):
+        return (False, 'Image did not upload')
+
+    state['posted'] = True
+    outbox.save(entry)
+
+    return (True, 'Image uploaded')
+
+
+def waitall(url, access_token, media_ids, deadline=None):
+    """
+    Wait until the server is done processing all given media (see Toot.waitmedia).
+    They are processed side by side, so the wait is about that of the slowest.
+    Returns False if any failed
+    """
+
+    for media_id in media_ids:
+        if not waitmedia(url, access_token, media_id, deadline=deadline):
+            return False
+
+    return True
+
+
+
+
+class UploadSignals(QObject):
+    """
+    Signals a worker emits. Created on (and so owned by) the GUI thread, which
+    makes the connected slots run on the GUI thread too.
+
+        stage    - (str) name of the stage just started: 'uploading', 'posting'
+        progress - (float, float, float) bytes sent, bytes to send and bytes per second
+                   (see Transfer.Progress)
+        uploaded - (str) media id, or an empty string if the upload failed
+        posted   - (str, bool, str) url, success and message, once per account (cross-posts)
+        finished - (bool, str) success and a message suitable for the user
+    """
+
+    stage = pyqtSignal(str)
+    progress = pyqtSignal(float, float, float)
+    uploaded = pyqtSignal(str)
+    posted = pyqtSignal(str, bool, str)
+    finished = pyqtSignal(bool, str)
+
+
+
+
+class CancellableWorker(QRunnable):
+    """
+    A worker whose network calls run against a deadline (see Deadline module) that
+    cancel() cancels, from the GUI thread. Uploads stop mid-send; nothing further
+    is sent.
+    """
+
+    def __init__(self):
+        super(CancellableWorker, self).__init__()
+
+        self.deadline = None
+        self.cancelrequested = False
+
+        self.lock = threading.Lock()
+
+
+    def startDeadline(self, stage='total', budgets=None):
+        """
+        Call at the start of run(). Returns the job's deadline
+        """
+
+        deadline = Deadline(stage=stage, budgets=budgets)
+
+        with self.lock:
+            self.deadline = deadline
+
+            if self.cancelrequested:
+                deadline.cancel()
+
+        return deadline
+
+
+    def cancel(self):
+
+        with self.lock:
+            self.cancelrequested = True
+            deadline = self.deadline
+
+        if deadline:
+            deadline.cancel()
+
+
+    def isCancelled(self):
+
+        return self.cancelrequested
+
+
+    def reportProgress(self, sent, total, rate):
+
+        self.signals.progress.emit(float(sent), float(total), rate)
+
+
+
+
+class UploadWorker(CancellableWorker):
+    """
+    Uploads an exported image and posts it as a toot, off the GUI thread.
+
+    The export itself (saveTempMedia) must still be done by the caller, on the
+    GUI thread, since Krita's document API is not thread-safe. The temp file is
+    removed once the job is done, whatever the outcome.
+
+    filename may be a list, in which case all images are uploaded concurrently
+    and attached to the one toot, in that order.
+
+        worker = UploadWorker(url, access_token, filename, message=...)
+        worker.signals.finished.connect(onfinished)
+        getThreadPool().start(worker)
+
+    If the media was already uploaded (see MediaUploadWorker), pass its media_id
+    and filename=None; only the toot is posted.
+
+    The post is journaled in the outbox (see Outbox module) before anything is
+    sent. If it fails, it stays there, with a copy of its images, and is retried
+    later (see OutboxDrainer).
+
+    limits - the instance's limits, if known. Images it would reject are not sent
+    budgets - seconds allowed per stage and in all (see KritaToot.getDeadlineBudgets)
+
+    Upload progress is reported by the progress signal. A cancelled post (see cancel)
+    is dropped from the outbox.
+    """
+
+    def __init__(self, url, access_token, filename, message=None, visibility='public', sensitive=False,
+                 description=None, focus=(0.0,0.0), media_id=None, limits=None, budgets=None):
+        super(UploadWorker, self).__init__()
+
+        self.url = url
+        self.access_token = access_token
+
+        if filename and not isinstance(filename, (list, tuple)):
+            filename = [filename]
+
+        self.filenames = filename if filename else []
+
+        self.message = message
+        self.visibility = visibility
+        self.sensitive = sensitive
+
+        self.description = description
+        self.focus = focus
+
+        self.media_id = media_id
+
+        self.limits = limits
+        self.budgets = budgets
+
+        self.signals = UploadSignals()
+
+
+    def run(self):
+
+        success = False
+        message = 'Image did not upload'
+
+        outbox = getOutbox()
+        entry = None
+
+        try:
+            media_ids = None
+
+            if self.media_id:
+                media_ids = {self.url: self.media_id if isinstance(self.media_id, (list, tuple)) else [self.media_id]}
+
+            deadline = self.startDeadline(budgets=self.budgets)
+
+            # side by side, before they are journaled (see Outbox.add)
+            encodeall(self.filenames, deadline=deadline.stage('upload'))
+
+            entry = outbox.add([self.url], self.filenames, message=self.message, visibility=self.visibility, sensitive=self.sensitive,
+                               description=self.description, focus=self.focus, media_ids=media_ids)
+
+            success, message = deliver(entry, self.access_token, self.url, limits=self.limits, deadline=deadline,
+                                       progress=Progress(self.reportProgress), stage=self.signals.stage.emit)
+
+        except DeadlineExceeded as e:
+            message = 'Timed out: %s' % e
+        except Cancelled:
+            message = 'Cancelled'
+        except Exception:
+            print('uncaught error in upload worker')
+            success = False
+
+        if entry and (success or self.isCancelled()):
+            outbox.remove(entry)
+        elif entry:
+            if outbox.failed(entry, message) is not None and entry['journaled']:
+                message += '\n\nThe post was kept and will be retried'
+
+        for filename in self.filenames:
+            removeTempMedia(filename)
+
+        self.signals.finished.emit(success, message)
+
+
+
+
+class MediaUploadWorker(CancellableWorker):
+    """
+    Uploads an exported image without posting it; the media id is reported by
+    the uploaded signal. Used to upload speculatively while the toot is still
+    being written, see UploadTab.
+
+    The temp file is removed once the upload is done, once the 'upload' budget
+    (see Deadline module) runs out, or once cancelled.
+    """
+
+    def __init__(self, url, access_token, filename, description=None, focus=(0.0,0.0), limits=None, budgets=None):
+        super(MediaUploadWorker, self).__init__()
+
+        self.url = url
+        self.access_token = access_token
+        self.filename = filename
+
+        self.description = description
+        self.focus = focus
+
+        self.limits = limits
+        self.budgets = budgets
+
+        self.signals = UploadSignals()
+
+
+    def run(self):
+
+        media_id = None
+
+        try:
+            print('uploading media ahead of posting')
+            self.signals.stage.emit('uploading')
+
+            media_id = uploadmedia(self.url, self.access_token, self.filename, description=self.description, focus=self.focus,
+                                   limits=self.limits, wait=False, deadline=self.startDeadline('upload', self.budgets),
+                                   progress=Progress(self.reportProgress))
+
+        except (DeadlineExceeded, Cancelled) as e:
+            print('media upload abandoned: %s' % e)
+
+        except Exception:
+            print('uncaught error in media upload worker')
+
+        removeTempMedia(self.filename)
+
+        self.signals.uploaded.emit(media_id if media_id else '')
+
+
+
+
+class CrossPostWorker(CancellableWorker):
+    """
+    Posts the same images and toot on several accounts at once.
+
+    The images are exported once (by the caller) and their multipart bodies are
+    built once; the same read-only bodies are then uploaded to every account
+    concurrently, on a pool of the job's own (one thread per upload, up to
+    MAXCROSSUPLOADS). Each account posts as soon as its own uploads are done.
+
+        worker = CrossPostWorker([(url, access_token), ...], filenames, message=...)
+
+    The posted signal reports each account's outcome; finished is emitted once
+    all accounts are done (success only if every account succeeded).
+
+    As with UploadWorker, the post is journaled in the outbox first; accounts that
+    failed are retried later.
+
+    limits - limits every account's instance can live with (see Instance.combineLimits)
+    budgets - see UploadWorker. Accounts share the one deadline
+
+    Progress and cancel() work as with UploadWorker; accounts posted to before the
+    cancel keep their toot.
+    """
+
+    def __init__(self, accounts, filenames, message=None, visibility='public', sensitive=False,
+                 description=None, focus=(0.0,0.0), limits=None, budgets=None):
+        super(CrossPostWorker, self).__init__()
+
+        # list of (url, access_token)
+        self.accounts = accounts
+        self.filenames = filenames
+
+        self.message = message
+        self.visibility = visibility
+        self.sensitive = sensitive
+
+        self.description = description
+        self.focus = focus
+
+        self.limits = limits
+        self.budgets = budgets
+
+        self.signals = UploadSignals()
+
+
+    def _postone(self, entry, url, access_token, futures, deadline):
+        """
+        wait for one account's uploads, then post. Returns (success, message)
+        """
+
+        try:
+            media_ids = [future.result() for future in futures]
+        except DeadlineExceeded as e:
+            return (False, 'Timed out: %s' % e)
+        except Cancelled:
+            return (False, 'Cancelled')
+
+        if None in media_ids:
+            return (False, 'Media could not be uploaded')
+
+        entry['accounts'][url]['media_ids'] = media_ids
+        entry['accounts'][url]['uploaded'] = time.time()
+
+        # waits on processing, posts and journals
+        return deliver(entry, access_token, url, limits=self.limits, deadline=deadline)
+
+
+    def run(self):
+
+        results = []
+
+        outbox = getOutbox()
+        entry = None
+
+        try:
+            deadline = self.startDeadline(budgets=self.budgets)
+
+            upload = deadline.stage('upload')
+
+            bodies, error = None, 'could not read the exported images'
+
+            try:
+                # encoded side by side, once for every account
+                bodies = list(getUploadExecutor().map(lambda filename: buildmediabody(filename, description=self.description, focus=self.focus,
+                                                                                      limits=self.limits, deadline=upload), self.filenames))
+            except DeadlineExceeded as e:
+                error = 'Timed out: %s' % e
+            except Cancelled:
+                error = 'Cancelled'
+
+            if not bodies or None in bodies:
+                results = [(url, False, error) for url, access_token in self.accounts]
+
+            else:
+                # journaled once encoded, so the images are written as they are
+                entry = outbox.add([url for url, access_token in self.accounts], self.filenames, message=self.message,
+                                   visibility=self.visibility, sensitive=self.sensitive, description=self.description, focus=self.focus)
+
+                print('cross-posting %i image(s) to %i accounts' % (len(bodies), len(self.accounts)))
+                self.signals.stage.emit('uploading')
+
+                progress = Progress(self.reportProgress)
+
+                # a pool of its own, sized for the job: on the shared one, accounts
+                # would queue behind each other (and single posts behind them).
+                # A thread per account on top, for the posts
+                executor = ThreadPoolExecutor(max_workers=min(len(self.accounts) * len(bodies), MAXCROSSUPLOADS) + len(self.accounts))
+
+                try:
+                    # every upload of every account, at once
+                    uploads = [[executor.submit(uploadbody, url, access_token, body, wait=False, deadline=upload, progress=progress) for body in bodies]
+                               for url, access_token in self.accounts]
+
+                    # then each account's post, as soon as its own uploads are done. (Queued
+                    # after every upload, so a post never holds a thread an upload waits for)
+                    posts = dict((executor.submit(self._postone, entry, url, access_token, futures, deadline), url)
+                                 for (url, access_token), futures in zip(self.accounts, uploads))
+
+                    for future in as_completed(posts):
+                        url = posts[future]
+                        success, message = future.result()
+
+                        print('%s: %s' % (url, message))
+                        self.signals.posted.emit(url, success, message)
+
+                        results.append((url, success, message))
+                finally:
+                    executor.shutdown(wait=False)
+
+        except Exception:
+            print('uncaught error in cross-post worker')
+
+        failed = [url for url, success, message in results if not success]
+
+        if entry and ((results and not failed) or self.isCancelled()):
+            outbox.remove(entry)
+        elif entry:
+            outbox.failed(entry, 'failed on %i accounts' % len(failed))
+
+        for filename in self.filenames:
+            removeTempMedia(filename)
+
+        if results and not failed:
+            self.signals.finished.emit(True, 'Image posted on %i accounts' % len(results))
+        elif self.isCancelled():
+            self.signals.finished.emit(False, 'Cancelled; posted on %i of %i accounts' % (len(results) - len(failed), len(self.accounts)))
+        elif not results:
+            self.signals.finished.emit(False, 'Image did not upload')
+        else:
+            summary = '\n'.join('%s: %s' % (url, message) for url, success, message in results)
+            self.signals.finished.emit(False, 'Posted on %i of %i accounts\n\n%s' % (len(results) - len(failed), len(results), summary))
+
+
+
+
+class InstanceWorker(QRunnable):
+    """
+    Fetches an instance's limits (see KritaToot.getInstanceLimits) off the GUI
+    thread, so that they are cached by the time they are needed.
+
+    finished is emitted with (True, url) if they could be fetched, (False, url) otherwise
+    """
+
+    def __init__(self, app, url):
+        super(InstanceWorker, self).__init__()
+
+        self.app = app
+        self.url = url
+
+        self.signals = UploadSignals()
+
+
+    def run(self):
+
+        success = False
+
+        try:
+            success = self.app.getInstanceCache().refresh(self.url)
+        except Exception:
+            print('uncaught error in instance worker')
+
+        self.signals.finished.emit(success, self.url)
+
+
+
+
+class WarmUpWorker(QRunnable):
+    """
+    Gets an account ready to post while the toot is still being written: opens a
+    connection to its instance (DNS, TCP and TLS handshakes), left idle in the pool
+    for the upload to reuse, and checks that its access token is still good (see
+    Toot.verifytoken).
+
+    finished is emitted with (False, message) only if the token was refused; a
+    network error is not reported, the post will have its own go.
+
+    budgets - see UploadWorker; the warm-up gets the 'connect' budget
+    """
+
+    def __init__(self, url, access_token, budgets=None):
+        super(WarmUpWorker, self).__init__()
+
+        self.url = url
+        self.access_token = access_token
+
+        self.budgets = budgets
+
+        self.signals = UploadSignals()
+
+
+    def run(self):
+
+        success, message = True, ''
+
+        try:
+            deadline = Deadline(stage='connect', budgets=self.budgets)
+
+            connecting = getConnectionPool().preconnect(self.url, deadline=deadline)
+
+            started = time.time()
+
+            if self.access_token and verifytoken(self.url, self.access_token, deadline=deadline) is False:
+                success, message = False, 'The access token for %s is no longer valid. Remove and re-add the account' % self.url
+
+            print('%s warmed up: connect %.1f ms, token check %.1f ms' % (self.url, connecting * 1000.0, (time.time() - started) * 1000.0))
+
+        except Exception as e:
+            print('warm-up of %s failed (%s)' % (self.url, e))
+
+        self.signals.finished.emit(success, message)
+
+
+
+
+class OutboxWorker(QRunnable):
+    """
+    Retries the outbox entries that are due (see Outbox module), off the GUI thread.
+
+    tokens - {url: access_token} of the accounts posts may go to. Accounts without
+             a token (e.g. removed since) count as failures
+    budgets - see UploadWorker. Each entry gets its own deadline
+
+    finished is emitted with (True, summary) if every due entry went out
+    """
+
+    def __init__(self, tokens, budgets=None):
+        super(OutboxWorker, self).__init__()
+
+        self.tokens = tokens
+        self.budgets = budgets
+
+        self.signals = UploadSignals()
+
+
+    def run(self):
+
+        outbox = getOutbox()
+
+        sent = 0
+        failed = 0
+
+        for entry in outbox.claimDue():
+
+            print('retrying outbox entry %s (attempt %i)' % (entry['id'], entry['attempts'] + 1))
+
+            errors = []
+
+            # temp files of a session that ended mid-upload (see Outbox.add)
+            exports = [name for name in entry['files'] if os.path.isabs(name)]
+
+            deadline = Deadline(budgets=self.budgets)
+
+            try:
+                for url in entry['accounts']:
+                    if not self.tokens.get(url):
+                        errors.append('%s: no access token' % url)
+                        continue
+
+                    success, message = deliver(entry, self.tokens[url], url, deadline=deadline)
+
+                    self.signals.posted.emit(url, success, message)
+
+                    if not success:
+                        errors.append('%s: %s' % (url, message))
+
+            except Exception:
+                print('uncaught error in outbox worker')
+                errors.append('uncaught error')
+
+            if errors:
+                outbox.failed(entry, '; '.join(errors))
+                failed += 1
+            else:
+                outbox.remove(entry)
+                sent += 1
+
+            # once posted, or copied into the outbox
+            for pathname in exports:
+                if not errors or pathname not in entry['files']:
+                    removeTempMedia(pathname)
+
+        self.signals.finished.emit(not failed, '%i posts from the outbox sent, %i failed' % (sent, failed))
+
+
+
+
+class OutboxDrainer(QObject):
+    """
+    Drains the outbox in the background for as long as Krita runs: a timer that
+    fires when the next entry is due and runs an OutboxWorker. Create on the GUI
+    thread (see getOutboxDrainer).
+
+    gettokens  - called on the GUI thread, returns {url: access_token}
+    getbudgets - called on the GUI thread, returns the deadline budgets (see OutboxWorker)
+    """
+
+    drained = pyqtSignal(bool, str)
+
+    def __init__(self, gettokens, getbudgets=None):
+        super(OutboxDrainer, self).__init__()
+
+        self.gettokens = gettokens
+        self.getbudgets = getbudgets
+
+        self.worker = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.drain)
+
+
+    def schedule(self, delay=None):
+        """
+        (Re)arm the timer for the next due entry, or in delay seconds
+        """
+
+        if delay is None:
+            due = getOutbox().nextDue()
+
+            if due is None:
+                self.timer.stop()
+                return
+
+            delay = due - time.time()
+
+        self.timer.start(int(max(0.0, delay) * 1000))
+
+
+    def drain(self):
+
+        if self.worker:
+            return
+
+        worker = OutboxWorker(self.gettokens(), budgets=self.getbudgets() if self.getbudgets else None)
+        worker.signals.finished.connect(self.workerFinished)
+
+        self.worker = worker
+
+        getThreadPool().start(worker)
+
+
+    def workerFinished(self, success, summary):
+
+        self.worker = None
+
+        print(summary)
+
+        self.drained.emit(success, summary)
+
+        self.schedule()
+
+
+
+
+_outboxdrainer = None
+
+def getOutboxDrainer():
+    """
+    Returns the outbox drainer (see OutboxDrainer). Call on the GUI thread.
+    Tokens (and settings) are those of the shared KritaToot (see App.getKritaToot),
+    brought up to date with the accounts file each time the outbox is drained
+    """
+
+    global _outboxdrainer
+
+    if _outboxdrainer is None:
+        from .App import getKritaToot
+
+        def gettokens():
+            app = getKritaToot()
+            app.loadAccounts()
+
+            return dict((url, app.getAccount(url).getAccessToken()) for url in app.getAccountURLs())
+
+        def getbudgets():
+            app = getKritaToot()
+            app.loadSettings()
+
+            # retries are paced like any other upload
+            app.configureUploadShaping()
+
+            return app.getDeadlineBudgets()
+
+        _outboxdrainer = OutboxDrainer(gettokens, getbudgets)
+
+    return _outboxdrainer
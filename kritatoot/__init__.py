@@ -1,2 +1,8 @@
-from .kritatoot import *
+try:
+    import krita
+except ImportError:
+    # outside Krita (e.g. python -m kritatoot.Toot test): only the modules that don't need it
+    krita = None
 
+if krita is not None:
+    from .kritatoot import *
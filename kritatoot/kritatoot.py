@@ -1,8 +1,11 @@
 import sys
 import json
 from krita import *
+from PyQt5.QtCore import QTimer
 
-from .UI import KritaTootUI
+# the dialog (UI) and everything it needs to post (App, Toot, Worker, http.server,
+# webbrowser, ...) are only imported once the menu option is first used, so that
+# KritaToot adds next to nothing to Krita's startup time
 
 
 class MyExtension(Extension):
@@ -17,6 +20,9 @@ class MyExtension(Extension):
     defaults to a PNG.
     
     A toot message, toot privacy, and hiding media content are supported.
+    Instead of the current document, all open documents or the selected layers
+    can be attached (one image each, up to 4 per toot). Images are uploaded concurrently.
+    The doc's animation can be posted as an MP4, WebM or GIF instead (needs ffmpeg).
     Toot message is optional. However when no toot message is given,
     the following text will appear:
     
@@ -24,8 +30,6 @@ class MyExtension(Extension):
     
     Limitations:
     
-    Only one image per toot is supported.
-    
     Specifiying a focal point is currently not supported
     
     File size and file types as set by the Mastodon server
@@ -34,16 +38,27 @@ class MyExtension(Extension):
 
     def __init__(self, parent):
         super().__init__(parent)
+        
+        # parent of the dialog, kept across openings
+        self.main = None
 
     
     def toot(self):
         """
-        Invoked when user selects menu option
+        Invoked when user selects menu option. Accounts, settings, connections and
+        caches are kept from the last opening (see App.getKritaToot)
         """
 
-        self.main = QWidget()
+        from .UI import KritaTootUI
+        
+        if self.main is None:
+            self.main = QWidget()
+        
         dialog = KritaTootUI(self.main)
         dialog.exec_()
+        
+        # self.main outlives it; don't keep every dialog ever opened as its child
+        dialog.deleteLater()
 
         #QMessageBox.information(QWidget(), "Toot", 'toot')
 
@@ -72,6 +87,29 @@ class MyExtension(Extension):
             sys.stdout = open(logfile, 'w')
             sys.stderr = open(logerr, 'w')
         
+        # posts that failed last session (see Outbox module) are retried once Krita has settled
+        QTimer.singleShot(30000, self.drainOutbox)
+        
+    def drainOutbox(self):
+        """
+        Retry the posts left in the outbox, if any. Only the outbox module is read to
+        find out; the modules that post are imported if there is something to retry
+        """
+        
+        from .Outbox import getOutbox
+        
+        outbox = getOutbox()
+        
+        # posts given up on long enough ago
+        outbox.prune()
+        
+        if not outbox.pending():
+            return
+        
+        from .Worker import getOutboxDrainer
+        
+        getOutboxDrainer().schedule()
+        
     def createActions(self, window):
         action = window.createAction("kritatoot", "Post on Mastodon", "tools/scripts")
         action.triggered.connect(self.toot)